@@ -2,6 +2,8 @@
 
 import streamlit as st
 from agent.app_config import AppConfig
+from agent.prompt_utils import PromptUtils
+from agent.llm_clients import LLMClients
 from agent.utils import RefactorMode, Utils, AIService
 
 
@@ -54,6 +56,8 @@ def show_ai_model_picker(st):
 
 if __name__ == "__main__":
     cfg = AppConfig.get_config(None)
+    PromptUtils.warm_system_prompts()
+    LLMClients.get_instance().warm(cfg, cfg.ai_service)
 
     Utils.setup_page(st, cfg, "Quanta: AI Tools")
     show_ai_model_picker(st)
@@ -0,0 +1,132 @@
+"""Parses an AI answer while it streams in, finding the files and blocks in it as soon as each one ends."""
+
+from typing import Callable, List, NamedTuple, Optional
+
+from agent.tag_lexer import TagLexer, TagLine
+from agent.tags import TAG_BLOCK_BEGIN, TAG_BLOCK_END, TAG_FILE_BEGIN, TAG_FILE_END
+
+
+class AnswerSection(NamedTuple):
+    """A complete file or block from the answer. `tag` is TAG_FILE_BEGIN or TAG_BLOCK_BEGIN."""
+
+    tag: str
+    name: str
+    lines: List[str]
+
+    @property
+    def content(self) -> str:
+        """The lines between the begin and end tags."""
+        return "\n".join(self.lines)
+
+
+class AnswerParser:
+    """A push parser for AI answers. Chunks of the answer are passed to `feed` as they arrive, in any sizes, and
+    every line is looked at once, as soon as it's complete.
+
+    Each file (file_begin to the file_end with the same name) and each block outside of a file (block_begin to
+    its block_end) is passed to `on_section` as soon as its end tag arrives, so it can be applied while the rest
+    of the answer is still being generated. A file missing its file_end runs to the end of the answer, which
+    is when `close` is called.
+
+    The parser also builds the answer as we show it on screen, with each file and block replaced by a line
+    saying it was updated (see `display_text`), so it doesn't have to be scanned again for that.
+    """
+
+    def __init__(self, on_section: Optional[Callable[[AnswerSection], None]] = None):
+        self.on_section: Optional[Callable[[AnswerSection], None]] = on_section
+        # The last line, until its newline arrives
+        self.partial: List[str] = []
+        # The section we're in, and its lines so far
+        self.section_tag: Optional[str] = None
+        self.section_name: str = ""
+        self.section_lines: List[str] = []
+        # Blocks can hold blocks, so we count how deep in them we are
+        self.block_depth: int = 0
+        # Lines to show on screen, and how deep in files and blocks we are for that
+        self.display: List[str] = []
+        self.display_depth: int = 0
+        self.closed: bool = False
+
+    def feed(self, chunk: str):
+        """Parses the next piece of the answer."""
+        if "\n" not in chunk:
+            self.partial.append(chunk)
+            return
+        lines: List[str] = chunk.split("\n")
+        lines[0] = "".join(self.partial) + lines[0]
+        self.partial = [lines.pop()]
+        for line in lines:
+            self.parse_line(line[:-1] if line.endswith("\r") else line)
+
+    def close(self):
+        """Called at the end of the answer, to parse the last line, and end any unfinished file."""
+        if self.closed:
+            return
+        self.closed = True
+        last: str = "".join(self.partial)
+        self.partial = []
+        if last:
+            self.parse_line(last)
+        if self.section_tag == TAG_FILE_BEGIN:
+            self.end_section()
+
+    def parse_line(self, line: str):
+        """Parses one complete line."""
+        tag_line: Optional[TagLine] = TagLexer.lex(line)
+        self.add_display_line(line, tag_line)
+
+        if self.section_tag == TAG_FILE_BEGIN:
+            # Only the matching file_end ends a file, so everything else is content
+            if tag_line is not None and tag_line.matches(TAG_FILE_END, self.section_name):
+                self.end_section()
+            else:
+                self.section_lines.append(line)
+        elif self.section_tag == TAG_BLOCK_BEGIN:
+            if tag_line is not None and tag_line.tag == TAG_BLOCK_BEGIN:
+                self.block_depth += 1
+            elif tag_line is not None and tag_line.tag == TAG_BLOCK_END:
+                self.block_depth -= 1
+                if self.block_depth == 0:
+                    self.end_section()
+                    return
+            self.section_lines.append(line)
+        elif (
+            tag_line is not None
+            and tag_line.tag in (TAG_FILE_BEGIN, TAG_BLOCK_BEGIN)
+            and tag_line.name is not None
+        ):
+            self.section_tag = tag_line.tag
+            self.section_name = tag_line.name
+            self.section_lines = []
+            self.block_depth = 1
+
+    def end_section(self):
+        """Hands the section we're in to `on_section`."""
+        assert self.section_tag is not None
+        section = AnswerSection(self.section_tag, self.section_name, self.section_lines)
+        self.section_tag = None
+        self.section_lines = []
+        self.block_depth = 0
+        if self.on_section is not None:
+            self.on_section(section)
+
+    def add_display_line(self, line: str, tag_line: Optional[TagLine]):
+        """Adds the line to what we show on screen. Any end tag closes the innermost file or block."""
+        tag: Optional[str] = tag_line.tag if tag_line is not None else None
+        if tag == TAG_FILE_END or tag == TAG_BLOCK_END:
+            self.display_depth -= 1
+        elif tag == TAG_FILE_BEGIN or tag == TAG_BLOCK_BEGIN:
+            self.display_depth += 1
+            if self.display_depth == 1:
+                assert tag_line is not None
+                kind: str = "File" if tag == TAG_FILE_BEGIN else "Code Block"
+                self.display.append(f"{kind} Updated: {tag_line.name}")
+        elif self.display_depth == 0:
+            self.display.append(line)
+
+    def display_text(self) -> str:
+        """The answer so far as we show it on screen, including the last line if it's not in a file or block."""
+        lines: List[str] = self.display
+        if self.partial and self.display_depth == 0:
+            lines = lines + ["".join(self.partial)]
+        return "\n".join(lines)
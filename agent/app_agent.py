@@ -2,20 +2,32 @@
 
 import time
 import argparse
-from typing import List
-from langchain.schema import BaseMessage
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from langchain.schema import BaseMessage, HumanMessage
 from agent.app_ai import AppAI
 from agent.app_config import AppConfig
 from agent.project_loader import ProjectLoader
+from agent.models import ProjectChangedError, TextBlock
+from agent.content_cache import ContentCache
+from agent.index_service import IndexService
 from agent.project_mutator import ProjectMutator
+from agent.edit_transaction import EditTransaction, CommitStats
+from agent.response_cache import ResponseCache
+from agent.llm_clients import LLMClients
+from agent.prompt_cache import PromptCacheStats
+from agent.stream_handler import QueryTiming
+from agent.answer_parser import AnswerParser
 
 from agent.tags import (
     TAG_BLOCK_BEGIN,
     TAG_BLOCK_END,
-    MORE_INSTRUCTIONS,
 )
-from agent.utils import RefactorMode, Utils
+from agent.utils import AIService, RefactorMode, Utils
+from agent.token_budget import TokenBudget, TokenCounter
+from agent.minifier import ContentMinifier
 from agent.prompt_utils import PromptUtils
+from agent.prompt_tags import PromptTags
+from agent.search_index import SearchIndex, SearchHit
 
 
 class QuantaAgent:
@@ -30,10 +42,43 @@ class QuantaAgent:
         self.mode = RefactorMode.NONE.value
         self.ran: bool = False
         self.prompt: str = ""
+        # With `prompt_cache` the content the prompt's tags refer to goes here, to be sent before the prompt
+        self.context: str = ""
         self.system_prompt: str = ""
         self.has_filename_inject = False
         self.has_folder_inject = False
-        self.prj_loader = ProjectLoader(self.st, self.source_folder_len)
+        # Tags in the prompt that didn't match any block, file, or folder
+        self.unknown_tags: List[str] = []
+        # Files of folders that were truncated or left out to fit the token budget
+        self.context_report: List[str] = []
+        self.prompt_tokens: int = 0
+        # Tokens saved by minifying the files put into the prompt
+        self.tokens_saved: int = 0
+        # All the file edits of the run are staged here, and committed together at the end
+        self.transaction = EditTransaction(
+            self.cfg.source_folder, f"{self.cfg.data_folder}/journal", self.ts
+        )
+        self.commit_stats: Optional[CommitStats] = None
+        self.response_cache: Optional[ResponseCache] = None
+        # Parses the answer while it streams in, and has what we show of it on screen
+        self.parser = AnswerParser()
+        # How long the AI took to answer, once it has
+        self.timing: Optional[QueryTiming] = None
+        ContentCache.configure(self.cfg.content_cache_size)
+        self.prj_loader = ProjectLoader(
+            self.st,
+            self.source_folder_len,
+            f"{self.cfg.data_folder}/scan_manifest.json",
+            self.cfg.scan_workers,
+            self.cfg.scan_pool,
+            self.cfg.max_scan_file_size,
+            search_index_file=(
+                f"{self.cfg.data_folder}/search_index.db" if self.cfg.auto_context else None
+            ),
+            symbol_index_file=(
+                f"{self.cfg.data_folder}/symbol_index.json" if self.cfg.symbol_index else None
+            ),
+        )
 
     def run(
         self,
@@ -44,10 +89,16 @@ class QuantaAgent:
         messages: List[BaseMessage],
         input_prompt: str,
         temperature: float,
+        use_cache: bool = True,
+        on_text: Optional[Callable[[str], None]] = None,
     ):
         """Runs the agent. We assume that if messages is not `None` then we are in the Streamlit GUI mode, and these messages
         represent the chatbot context. If messages is `None` then we are in the CLI mode, and we will use the `prompt` parameter
-        alone without any prior context."""
+        alone without any prior context.
+
+        Responses are cached when the temperature is 0, unless `use_cache` is False, which bypasses the cache. The answer
+        streams in, and `on_text`, if given, is called with the answer so far as it does (and `self.parser` has it
+        parsed for showing on screen)."""
         self.st = st
         if self.ran:
             Utils.fail_app(
@@ -62,31 +113,52 @@ class QuantaAgent:
         if output_file_name == "":
             output_file_name = self.ts
 
-        # Scan the source folder for files with the specified extensions, to build up the 'blocks' dictionary
-        self.prj_loader.scan_directory(self.cfg.source_folder)
+        self.load_project(messages)
 
-        prompt_injects: bool = (
-            self.insert_blocks_into_prompt()
-            or self.insert_files_and_folders_into_prompt()
-        )
+        prompt_injects: bool = self.expand_prompt_tags(ai_service)
 
         if self.st is not None and prompt_injects:
             self.st.session_state.p_source_provided = True
 
-        if len(self.prompt) > int(self.cfg.max_prompt_length):
+        if len(self.context) + len(self.prompt) > int(self.cfg.max_prompt_length):
             Utils.fail_app(
-                f"Prompt length {len(self.prompt)} exceeds the maximum allowed length of {self.cfg.max_prompt_length} characters.",
+                f"Prompt length {len(self.context) + len(self.prompt)} exceeds the maximum allowed length of {self.cfg.max_prompt_length} characters.",
                 st,
             )
 
         self.build_system_prompt()
 
+        # Only a temperature of 0 makes the same query give the same answer
+        if use_cache and temperature == 0 and int(self.cfg.response_cache_size) > 0:
+            self.response_cache = ResponseCache(
+                f"{self.cfg.data_folder}/response_cache", int(self.cfg.response_cache_size)
+            )
+
+        # In refactoring mode the files in the answer get staged as soon as each one has arrived
+        mutator: Optional[ProjectMutator] = None
+        if self.mode == RefactorMode.REFACTOR.value:
+            mutator = ProjectMutator(
+                self.st,
+                self.mode,
+                self.cfg.source_folder,
+                "",
+                self.ts,
+                None,
+                self.prj_loader.blocks,
+                self.transaction,
+            )
+        self.parser = mutator.parser if mutator is not None else AnswerParser()
+
         open_ai = AppAI(
             self.cfg,
             self.mode,
             self.system_prompt,
             self.prj_loader.blocks,
             self.st,
+            self.transaction,
+            self.response_cache,
+            on_text,
+            self.parser,
         )
 
         # Need to be sure the current `self.system_prompt`` is in these messages every time we send
@@ -98,20 +170,56 @@ class QuantaAgent:
             output_file_name,
             self.ts,
             temperature,
+            self.context,
         )
+        self.timing = open_ai.timing
 
-        if (
-            self.mode == RefactorMode.REFACTOR.value
+        if mutator is not None:
+            mutator.run()
+
+            # Everything the tools and the mutator staged lands on disk together, or not at all
+            self.commit_stats = self.transaction.commit()
+
+        print(ContentCache.get_instance().summary())
+        if self.response_cache is not None:
+            print(self.response_cache.summary())
+        print(LLMClients.get_instance().summary())
+        prompt_cache_summary: str = PromptCacheStats.get_instance().summary()
+        if prompt_cache_summary:
+            print(prompt_cache_summary)
+
+    def load_project(self, messages: List[BaseMessage]):
+        """Loads the blocks, files, and folders of the project. The index service keeps all of that current for
+        us if it's enabled. Otherwise, with demand loading, we load only what the prompt refers to, and we only
+        scan the whole source folder (to build up the 'blocks' dictionary) when that isn't possible.
+
+        The symbols the prompt refers to are then added to the blocks, so they can be updated like blocks.
+        """
+        refs = PromptTags.scan(self.prompt)
+        # Blocks inserted into earlier prompts of the conversation can still be updated by the AI
+        if self.mode == RefactorMode.REFACTOR.value and messages:
+            refs.blocks.update(
+                PromptTags.inserted_block_names(
+                    [Utils.get_message_text(m) for m in messages if isinstance(m, HumanMessage)]
+                )
+            )
+
+        if self.cfg.index_service:
+            self.prj_loader.use_snapshot(
+                IndexService.get_instance(self.cfg).get_snapshot()
+            )
+        # With auto context a prompt without tags gets searched for, which needs the search index current
+        elif not (
+            self.cfg.demand_load
+            and not (self.cfg.auto_context and refs.empty())
+            and self.prj_loader.load_referenced(self.cfg.source_folder, refs)
         ):
-            ProjectMutator(
-                self.st,
-                self.mode,
-                self.cfg.source_folder,
-                self.answer,
-                self.ts,
-                None,
-                self.prj_loader.blocks,
-            ).run()
+            self.prj_loader.scan_directory(self.cfg.source_folder)
+
+        # Symbols inserted into earlier prompts look like blocks
+        for name in sorted(refs.symbols | refs.blocks):
+            if name not in self.prj_loader.blocks:
+                self.prj_loader.add_symbol(self.cfg.source_folder, name)
 
     def build_system_prompt(self):
         """Adds all the instructions to the prompt. This includes instructions for inserting blocks, files,
@@ -122,72 +230,235 @@ class QuantaAgent:
         the AI query is made.
         """
 
-        self.system_prompt = PromptUtils.get_template(
-            "prompt_templates/agent_system_prompt.txt"
+        self.system_prompt = PromptUtils.get_system_prompt(
+            self.mode, len(self.prj_loader.blocks) > 0
         )
-        self.system_prompt += MORE_INSTRUCTIONS
-        self.add_file_handling_instructions()
-        self.add_block_handling_instructions()
-
-    def add_block_handling_instructions(self):
-        """Adds instructions for updating blocks. If the prompt contains ${BlockName} tags, then we need to provide
-        instructions for how to provide the new block content."""
-        if self.mode == RefactorMode.REFACTOR.value and len(self.prj_loader.blocks) > 0:
-            self.system_prompt += PromptUtils.get_template(
-                "prompt_templates/block_access_instructions.txt"
-            )
-            
-            self.system_prompt += PromptUtils.get_template(
-                "prompt_templates/block_update_instructions.txt"
-            )
-           
 
-    def add_file_handling_instructions(self):
-        """Adds instructions for inserting files. If the prompt contains ${FileName} or ${FolderName/} tags, then
-        we need to provide instructions for how to provide the new file or folder names.
+    def token_model(self, ai_service: str) -> str:
+        """Returns the name of the model whose tokens we count."""
+        if ai_service == AIService.ANTHROPIC.value:
+            return self.cfg.anth_model
+        return self.cfg.openai_model
+
+    def render_block(self, name: str) -> Optional[str]:
+        """Returns what a block(name) tag expands to, or None if there's no such block."""
+        block: Optional[TextBlock] = self.prj_loader.blocks.get(name)
+        if block is None:
+            return None
+        try:
+            content: str = block.content
+        except ProjectChangedError as e:
+            Utils.fail_app(str(e), self.st)
+            return None
+        return f"""
+{TAG_BLOCK_BEGIN} {name}
+{content}
+{TAG_BLOCK_END}
+"""
+
+    def expand_prompt_tags(self, ai_service: str) -> bool:
+        """Substitutes blocks, symbols, files, and folders into the prompt, in a single pass over it. Prompts can
+        contain block(BlockName), symbol(package.module.Class.method), file(FileName), and folder(FolderName/)
+        tags, which get replaced with the content of the block or symbol, the file, or all the files in the
+        folder. Tags that don't match anything in the project are reported.
+
+        The prompt is kept within `max_prompt_tokens`. The prompt itself and the blocks and files it refers to
+        are counted first, and we fail right away if those alone don't fit. Folders then get packed into
+        whatever room is left, and the files left out of them are reported. File content (but never block
+        content) goes through the `minify` stages first, if any are configured.
+
+        If the prompt has no tags at all and `auto_context` is enabled, the blocks and files that best match the
+        prompt are added to the end of it instead, as far as the budget allows.
+
+        With `prompt_cache` the tags are left in the prompt, and what they refer to goes into `self.context`
+        instead, sorted by kind and name, so asking about the same code again starts with the same context.
+
+        Returns true only if something was inserted.
         """
-        if self.mode == RefactorMode.REFACTOR.value:
-            self.system_prompt += PromptUtils.get_template(
-                "prompt_templates/file_access_instructions.txt"
+        refs = PromptTags.scan(self.prompt)
+        counter = TokenCounter(self.token_model(ai_service))
+        budget = TokenBudget(counter, int(self.cfg.max_prompt_tokens))
+        budget.charge(self.prompt)
+        minifier = ContentMinifier.for_mode(
+            AppConfig.split_list(self.cfg.minify),
+            self.mode == RefactorMode.REFACTOR.value,
+            counter,
+        )
+
+        # What each tag expands to, keyed by kind and name. None for tags that don't match anything.
+        rendered: Dict[Tuple[str, str], Optional[str]] = {}
+        # Files the prompt refers to directly, which take priority when packing folders
+        explicit: Set[str] = set()
+
+        for name in sorted(refs.blocks):
+            content = self.render_block(name)
+            rendered[("block", name)] = content
+            if content is not None:
+                budget.charge(content)
+                explicit.add(self.prj_loader.blocks[name].rel_filename)
+
+        # Symbols were added to the blocks when the project was loaded, and are put in the prompt the same way
+        for name in sorted(refs.symbols):
+            content = self.render_block(name)
+            rendered[("symbol", name)] = content
+            if content is not None:
+                budget.charge(content)
+                explicit.add(self.prj_loader.blocks[name].rel_filename)
+
+        file_names: Set[str] = set(self.prj_loader.file_names)
+        # Files the prompt refers to that aren't UTF-8 any more, which are reported rather than as unknown tags
+        undecodable: List[str] = []
+        for name in sorted(refs.files):
+            content = None
+            if name in file_names:
+                file_content = ContentCache.get_instance().try_read_text(self.cfg.source_folder + name)
+                if file_content is None:
+                    undecodable.append(name)
+                    rendered[("file", name)] = None
+                    continue
+                if minifier is not None:
+                    file_content = minifier.minify(name, file_content)
+                content = PromptUtils.get_file_content_block(name, file_content)
+                budget.charge(content)
+                explicit.add(name)
+            rendered[("file", name)] = content
+
+        if budget.exceeded():
+            Utils.fail_app(
+                f"Prompt is {budget.used} tokens, which exceeds the maximum of {budget.limit} tokens, even before "
+                + "adding any folders.",
+                self.st,
             )
-            
-            self.system_prompt += PromptUtils.get_template(
-                "prompt_templates/file_edit_instructions.txt"
+
+        folder_names: Set[str] = set(self.prj_loader.folder_names)
+        self.context_report = []
+        if undecodable:
+            self.context_report.append(f"Left out as binary, too large, or not UTF-8: {', '.join(undecodable)}")
+        for name in sorted(refs.folders):
+            if name not in folder_names:
+                continue
+            folder = PromptUtils.build_folder_content(
+                self.cfg.source_folder + name,
+                self.source_folder_len,
+                budget,
+                explicit,
+                minifier,
+                file_names,
             )
-           
+            rendered[("folder", name)] = folder.content
+            if folder.skipped:
+                self.context_report.append(
+                    f"Left out as binary, too large, or not UTF-8: {', '.join(folder.skipped)}"
+                )
+            if folder.truncated:
+                self.context_report.append(
+                    f"Truncated to fit the token budget: {', '.join(folder.truncated)}"
+                )
+            if folder.dropped:
+                self.context_report.append(
+                    f"Left out to fit the token budget: {', '.join(folder.dropped)}"
+                )
 
-    def insert_files_and_folders_into_prompt(self) -> bool:
-        """Inserts the file and folder names into the prompt. Prompts can contain ${FileName} and ${FolderName/} tags
+        # What the tags refer to, when it goes into the context rather than in place of them
+        context: Dict[Tuple[str, str], str] = {}
 
-        Returns true only if some files or folders were inserted.
-        """
-        self.prompt, self.has_filename_inject = PromptUtils.insert_files_into_prompt(
-            self.prompt, self.cfg.source_folder, self.prj_loader.file_names
-        )
-        self.prompt, self.has_folder_inject = PromptUtils.insert_folders_into_prompt(
-            self.prompt, self.cfg.source_folder, self.prj_loader.folder_names
-        )
-        return self.has_filename_inject or self.has_folder_inject
+        def render(kind: str, name: str) -> Optional[str]:
+            content: Optional[str] = rendered.get((kind, name))
+            if content is None or not self.cfg.prompt_cache:
+                return content
+            context[(kind, name)] = content
+            return f"{kind}({name}/)" if kind == "folder" else f"{kind}({name})"
 
-    def insert_blocks_into_prompt(self) -> bool:
-        """
-        Substitute blocks into the prompt. Prompts can contain ${BlockName} tags, which will be replaced with the
-        content of the block with the name 'BlockName'
+        expansion = PromptTags.expand(self.prompt, render)
+        self.context = ""
+        if context:
+            self.context = "Code from the project that the prompt below refers to:\n" + "".join(
+                context[key] for key in sorted(context)
+            )
+        self.prompt = expansion.prompt
+        self.has_filename_inject = expansion.files_inserted > 0
+        self.has_folder_inject = expansion.folders_inserted > 0
+        auto_added: int = 0
+        if refs.empty() and self.cfg.auto_context:
+            auto_added = self.add_auto_context(budget, minifier)
+        self.prompt_tokens = budget.used
+        self.tokens_saved = minifier.tokens_saved if minifier is not None else 0
+        if self.tokens_saved > 0:
+            msg = f"Minifying the files saved {self.tokens_saved} prompt tokens"
+            print(msg)
+            if self.st is not None:
+                self.st.info(msg)
+
+        for msg in self.context_report:
+            print(msg)
+            if self.st is not None:
+                self.st.info(msg)
+
+        reported: Set[str] = {f"file({name})" for name in undecodable}
+        self.unknown_tags = [tag for tag in expansion.unknown if tag not in reported]
+        if self.unknown_tags:
+            msg = f"Not found in the project, so left as is: {', '.join(self.unknown_tags)}"
+            print(msg)
+            if self.st is not None:
+                self.st.warning(msg)
+        return expansion.inserted() or auto_added > 0
+
+    def add_auto_context(self, budget: TokenBudget, minifier: Optional[ContentMinifier]) -> int:
+        """Searches the project for the blocks and files that best match the prompt, and adds as many of them
+        as fit in the budget to the end of the prompt (or with `prompt_cache`, to the context). Blocks come
+        first, since they're what the project has marked as the parts worth talking about. Any number of blocks
+        of a file can go in, but a file is left out if one of its blocks is already in.
 
-        Returns true only if someblocks were inserted.
+        Returns the number of blocks and files added.
         """
-        ret = False
-        for key, value in self.prj_loader.blocks.items():
-            k = f"block({key})"
-            if k in self.prompt:
-                ret = True
-
-            self.prompt = self.prompt.replace(
-                k,
-                f"""
-{TAG_BLOCK_BEGIN} {key}
-{value.content}
-{TAG_BLOCK_END}
-""",
+        search_index: Optional[SearchIndex] = self.prj_loader.search_index
+        if search_index is None:
+            return 0
+        top_k: int = int(self.cfg.auto_context_results)
+        hits: List[SearchHit] = search_index.search(self.prompt, top_k, ("block",))
+        hits += search_index.search(self.prompt, top_k, ("file",))
+
+        # The content of each block and file added, by kind and name
+        parts: Dict[Tuple[str, str], str] = {}
+        added: List[str] = []
+        files_added: Set[str] = set()
+        undecodable: List[str] = []
+        file_names: Set[str] = set(self.prj_loader.file_names)
+        for hit in hits:
+            if hit.kind == "file" and hit.rel_filename in files_added:
+                continue
+            content: Optional[str] = None
+            if hit.kind == "block":
+                content = self.render_block(hit.name)
+            elif hit.rel_filename in file_names:
+                file_content = ContentCache.get_instance().try_read_text(
+                    self.cfg.source_folder + hit.rel_filename
+                )
+                if file_content is None:
+                    undecodable.append(hit.rel_filename)
+                    continue
+                if minifier is not None:
+                    file_content = minifier.minify(hit.rel_filename, file_content)
+                content = PromptUtils.get_file_content_block(hit.rel_filename, file_content)
+            # The index can be behind the project, or the content can be too big for what's left
+            if content is None or not budget.try_charge(content):
+                continue
+            parts[(hit.kind, hit.name)] = content
+            added.append(hit.name)
+            files_added.add(hit.rel_filename)
+            if hit.kind == "file":
+                self.has_filename_inject = True
+
+        if undecodable:
+            self.context_report.append(f"Left out as binary, too large, or not UTF-8: {', '.join(undecodable)}")
+        if not parts:
+            return 0
+        if self.cfg.prompt_cache:
+            # Sorted, so it doesn't depend on how well each one matched
+            self.context = "Code from the project that may be relevant:\n" + "".join(
+                parts[key] for key in sorted(parts)
             )
-        return ret
+        else:
+            self.prompt += "\n\nCode from the project that may be relevant:\n" + "".join(parts.values())
+        self.context_report.append(f"Added by searching the project: {', '.join(added)}")
+        return len(parts)
@@ -2,15 +2,23 @@
 
 import argparse
 import os
-from typing import Dict, List
+import time
+from typing import Callable, Dict, List, MutableMapping, Optional, Union
 from langchain.schema import HumanMessage, AIMessage, BaseMessage, SystemMessage
 from langchain.chat_models.base import BaseChatModel
+from langchain_core.runnables import RunnableConfig
 from langgraph.prebuilt import chat_agent_executor
 
 
 from agent.app_config import AppConfig
 from agent.models import TextBlock
-from agent.utils import RefactorMode, Utils
+from agent.edit_transaction import EditTransaction
+from agent.response_cache import ResponseCache
+from agent.llm_clients import LLMClients
+from agent.hedging import HedgedQuery, HedgeResult, LatencyStats
+from agent.answer_parser import AnswerParser
+from agent.stream_handler import StreamHandler, QueryTiming
+from agent.utils import AIService, RefactorMode, Utils
 from agent.tools.refactoring_tools import (
     UpdateBlockTool,
     CreateFileTool,
@@ -28,14 +36,28 @@ class AppAI:
         cfg: argparse.Namespace,
         mode: str,
         system_prompt: str,
-        blocks: Dict[str, TextBlock] = {},
+        blocks: Optional[MutableMapping[str, TextBlock]] = None,
         st=None,
+        transaction: Optional[EditTransaction] = None,
+        response_cache: Optional[ResponseCache] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+        parser: Optional[AnswerParser] = None,
     ):
         self.cfg = cfg
         self.mode = mode
         self.system_prompt: str = system_prompt
-        self.blocks = blocks
+        # The blocks the AI is allowed to update. Updates replace entries in this mapping.
+        self.blocks: MutableMapping[str, TextBlock] = blocks if blocks is not None else {}
         self.st = st
+        # Where the refactoring tools stage their file edits
+        self.transaction: Optional[EditTransaction] = transaction
+        # Where responses get looked up before calling the AI, if caching them is allowed for this query
+        self.response_cache: Optional[ResponseCache] = response_cache
+        # Called with the answer so far, while it streams in
+        self.on_text: Optional[Callable[[str], None]] = on_text
+        # Parses the answer while it streams in
+        self.parser: Optional[AnswerParser] = parser
+        self.timing = QueryTiming()
 
     def query(
         self,
@@ -46,92 +68,176 @@ class AppAI:
         output_file_name: str,
         ts: str,
         temperature: float,
+        context: str = "",
     ) -> str:
-        """Makes a query to AI API and writes the response to a file."""
+        """Makes a query to AI API and writes the response to a file. The answer is streamed, so it's appended to
+        the log file, and passed to `on_text`, as it arrives. The `context`, if any, is the code the query refers
+        to, and is sent just before it."""
         ret: str = ""
+        filename = f"{self.cfg.data_folder}/{output_file_name}.txt"
+        Utils.ensure_folder_exists(filename)
 
-        if self.dry_run:
-            # If dry_run is True, we simulate the AI response by reading from a file
-            # if we canfind that file or else we return a default response.
-            answer_file: str = f"{self.cfg.data_folder}/dry-run-answer.txt"
-
-            if os.path.isfile(answer_file):
-                print(f"Simulating AI Response by reading answer from {answer_file}")
-                ret = Utils.read_file(answer_file)
-            else:
-                ret = "Dry Run: No API call made."
-        else:
-            llm: BaseChatModel = Utils.create_llm(self.cfg, ai_service, temperature)
-
-            # Check the first 'message' to see if it's a SystemMessage and if not then insert one
-            if len(messages) == 0 or not isinstance(messages[0], SystemMessage):
-                messages.insert(0, SystemMessage(content=self.system_prompt))
-            # else we set the first message to the system prompt
-            else:
-                messages[0] = SystemMessage(content=self.system_prompt)
-
-            human_message = HumanMessage(content=query)
-
-            if self.st is not None:
-                self.st.session_state.p_user_inputs[id(human_message)] = input_prompt
-
-            messages.append(human_message)
-
-            if self.mode != RefactorMode.NONE.value:
-                # https://python.langchain.com/v0.2/docs/tutorials/agents/
-                tools = []
-
-                if self.mode == RefactorMode.REFACTOR.value:
-                    tools = [
-                        UpdateBlockTool("Block Updater Tool", self.blocks),
-                        CreateFileTool("File Creator Tool", self.cfg.source_folder),
-                        UpdateFileTool("File Updater Tool", self.cfg.source_folder),
-                    ]
-
-                agent_executor = chat_agent_executor.create_tool_calling_executor(
-                    llm, tools
-                )
-                initial_message_len = len(messages)
-                response = agent_executor.invoke({"messages": list(messages)})
-                # print(f"Response: {response}")
-                resp_messages = response["messages"]
-                new_messages = resp_messages[initial_message_len:]
-                ret = ""
-                ai_response: int = 0
-                for message in new_messages:
-                    if isinstance(message, AIMessage):
-                        ai_response += 1
-                        content = message.content
-                        if not content:
-                            content = Utils.get_tool_calls_str(message)
-                            # print(f"TOOL CALLS:\n{content}")
-                        ret += f"AI Response {ai_response}:\n{content}\n==============\n"  # type: ignore
-
-                # Agents may add multiple new messages, so we need to update the messages list
-                # This [:] syntax is a way to update the list in place
-                messages[:] = resp_messages
-
-            else:
-                response = llm.invoke(list(messages))
-                ret = response.content  # type: ignore
-                messages.append(AIMessage(content=response.content))
-
-        output = f"""AI Model Used: {ai_service}, Mode: {self.mode}, Timestamp: {ts}
+        with open(filename, "w", encoding="utf-8") as log:
+            log.write(
+                f"""AI Model Used: {ai_service}, Mode: {self.mode}, Timestamp: {ts}
 ____________________________________________________________________________________
 Input Prompt: 
 {input_prompt}
 ____________________________________________________________________________________
 LLM Output: 
-{ret}
+"""
+            )
+            log.flush()
+            handler = StreamHandler(log, self.on_text, self.parser)
+
+            if self.dry_run:
+                # If dry_run is True, we simulate the AI response by reading from a file
+                # if we canfind that file or else we return a default response.
+                answer_file: str = f"{self.cfg.data_folder}/dry-run-answer.txt"
+
+                if os.path.isfile(answer_file):
+                    print(f"Simulating AI Response by reading answer from {answer_file}")
+                    ret = Utils.read_file(answer_file)
+                else:
+                    ret = "Dry Run: No API call made."
+                handler.add_text(ret)
+            else:
+                ret = self.ask(
+                    ai_service, messages, query, input_prompt, temperature, handler, context
+                )
+
+            self.timing = handler.finish()
+            final_prompt: str = f"{context}\n{query}" if context else query
+            log.write(
+                f"""
 ____________________________________________________________________________________
 System Prompt: 
 {self.system_prompt}
 ____________________________________________________________________________________
 Final Prompt: 
-{query}
+{final_prompt}
+____________________________________________________________________________________
+{self.timing.summary()}
 """
+            )
 
-        filename = f"{self.cfg.data_folder}/{output_file_name}.txt"
-        Utils.write_file(filename, output)
+        print(self.timing.summary())
         print(f"Wrote Log File: {filename}")
         return ret
+
+    def ask(
+        self,
+        ai_service: str,
+        messages: List[BaseMessage],
+        query: str,
+        input_prompt: str,
+        temperature: float,
+        handler: StreamHandler,
+        context: str = "",
+    ) -> str:
+        """Sends the query to the AI, streaming the answer to `handler`, and returns the answer."""
+        # Anthropic can't stream when tools are used, so we don't ask it to
+        streaming: bool = (
+            ai_service != AIService.ANTHROPIC.value or self.mode == RefactorMode.NONE.value
+        )
+        llm: BaseChatModel = LLMClients.create_llm(
+            self.cfg, ai_service, temperature, self.response_cache, streaming
+        )
+        config: RunnableConfig = {"callbacks": [handler]}
+
+        # Check the first 'message' to see if it's a SystemMessage and if not then insert one
+        if len(messages) == 0 or not isinstance(messages[0], SystemMessage):
+            messages.insert(0, SystemMessage(content=self.system_prompt))
+        # else we set the first message to the system prompt
+        else:
+            messages[0] = SystemMessage(content=self.system_prompt)
+
+        human_message = HumanMessage(content=AppAI.human_content(context, query))
+
+        if self.st is not None:
+            self.st.session_state.p_user_inputs[id(human_message)] = input_prompt
+
+        messages.append(human_message)
+
+        if self.mode != RefactorMode.NONE.value:
+            # https://python.langchain.com/v0.2/docs/tutorials/agents/
+            tools = []
+
+            if self.mode == RefactorMode.REFACTOR.value:
+                if self.transaction is None:
+                    Utils.fail_app("Refactoring requires an edit transaction.", self.st)
+                tools = [
+                    UpdateBlockTool("Block Updater Tool", self.blocks),
+                    CreateFileTool("File Creator Tool", self.transaction),
+                    UpdateFileTool("File Updater Tool", self.transaction),
+                ]
+
+            agent_executor = chat_agent_executor.create_tool_calling_executor(
+                llm, tools
+            )
+            initial_message_len = len(messages)
+            response = agent_executor.invoke({"messages": list(messages)}, config)
+            # print(f"Response: {response}")
+            resp_messages = response["messages"]
+            new_messages = resp_messages[initial_message_len:]
+            ret = ""
+            ai_response: int = 0
+            for message in new_messages:
+                if isinstance(message, AIMessage):
+                    ai_response += 1
+                    content = message.content
+                    if not content:
+                        content = Utils.get_tool_calls_str(message)
+                        # print(f"TOOL CALLS:\n{content}")
+                    ret += f"AI Response {ai_response}:\n{content}\n==============\n"  # type: ignore
+
+            # Agents may add multiple new messages, so we need to update the messages list
+            # This [:] syntax is a way to update the list in place
+            messages[:] = resp_messages
+
+        else:
+            response = self.invoke(ai_service, llm, messages, temperature, handler)
+            ret = response.content  # type: ignore
+            messages.append(AIMessage(content=response.content))
+        return ret
+
+    @staticmethod
+    def human_content(context: str, query: str) -> Union[str, List[Union[str, Dict]]]:
+        """The content of the message asking the query. The context goes first, in a part of its own, so the
+        prompt starts with the parts that stay the same from one question to the next (the system prompt, the
+        messages so far, and the code), which the AI service can then cache. See CachingChatAnthropic."""
+        if not context:
+            return query
+        return [{"type": "text", "text": context}, {"type": "text", "text": query}]
+
+    def invoke(
+        self,
+        ai_service: str,
+        llm: BaseChatModel,
+        messages: List[BaseMessage],
+        temperature: float,
+        handler: StreamHandler,
+    ) -> BaseMessage:
+        """Sends a query without tools, and records how long the service took. With `hedge_service` set the query
+        is also sent to that service if `ai_service` is slow to start answering, and the first answer wins."""
+        hits: int = self.response_cache.hits if self.response_cache is not None else 0
+        hedge_service: str = self.cfg.hedge_service
+        if hedge_service and hedge_service != ai_service:
+            backup: BaseChatModel = LLMClients.create_llm(
+                self.cfg, hedge_service, temperature, self.response_cache, True
+            )
+            result = HedgedQuery(
+                [(ai_service, llm), (hedge_service, backup)], float(self.cfg.hedge_delay)
+            ).run(list(messages), handler)
+            response = result.message
+        else:
+            start = time.perf_counter()
+            response = llm.invoke(list(messages), {"callbacks": [handler]})
+            result = HedgeResult(ai_service, response, (time.perf_counter() - start) * 1000, False, [])
+
+        # Answers from the cache say nothing about the service
+        if self.response_cache is None or self.response_cache.hits == hits:
+            stats = LatencyStats.get_instance()
+            stats.record_result(result)
+            print(stats.summary())
+        return response
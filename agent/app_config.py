@@ -12,6 +12,8 @@ class AppConfig:
 
     ext_list: List[str] = []
     ext_set: Set[str] = set()
+    include_globs: List[str] = []
+    exclude_globs: List[str] = []
 
     @classmethod
     def get_config(cls, config_file: Optional[str] = None) -> argparse.Namespace:
@@ -72,9 +74,131 @@ class AppConfig:
         p.add_argument(
             "--max_prompt_length", required=True, help="Max characters in prompt"
         )
+        p.add_argument(
+            "--max_prompt_tokens",
+            type=int,
+            default=0,
+            help="Max tokens in the prompt, which folders get packed into (0 for no limit)",
+        )
+        p.add_argument(
+            "--minify",
+            default="",
+            help="Comma separated minify stages applied to files put into prompts: duplicates, headers, comments, whitespace",
+        )
+        p.add_argument(
+            "--scan_workers",
+            type=int,
+            default=0,
+            help="Number of workers used to scan the source folder (0 or 1 means a serial scan)",
+        )
+        p.add_argument(
+            "--scan_pool",
+            default="thread",
+            choices=["thread", "process"],
+            help="Kind of worker pool used for parallel scans",
+        )
+        p.add_argument(
+            "--max_scan_file_size",
+            type=int,
+            default=2000000,
+            help="Files larger than this many bytes are skipped by the scan",
+        )
+        p.add_argument(
+            "--content_cache_size",
+            type=int,
+            default=64000000,
+            help="Most bytes of file content kept in memory, so files are read at most once while unchanged (0 disables)",
+        )
+        p.add_argument(
+            "--index_service",
+            action="store_true",
+            help="Keep the project index current in the background from filesystem events, instead of scanning on every query",
+        )
+        p.add_argument(
+            "--demand_load",
+            action="store_true",
+            help="Load only the blocks, files, and folders the prompt refers to, instead of scanning the whole source folder",
+        )
+        p.add_argument(
+            "--response_cache_size",
+            type=int,
+            default=200000000,
+            help="Most bytes of AI responses (to temperature 0 queries) cached in the data folder. Zero disables the cache.",
+        )
+        p.add_argument(
+            "--llm_clients",
+            type=int,
+            default=8,
+            help="Most AI models (by service, model, temperature, and timeout) kept for reuse, with their connections",
+        )
+        p.add_argument(
+            "--llm_timeout",
+            type=float,
+            default=60,
+            help="Timeout in seconds for requests to the AI service",
+        )
+        p.add_argument(
+            "--openai_base_url",
+            default="",
+            help="URL of the OpenAI API, if it's not the default, like for a proxy",
+        )
+        p.add_argument(
+            "--anth_base_url",
+            default="",
+            help="URL of the Anthropic API, if it's not the default, like for a proxy",
+        )
+        p.add_argument(
+            "--hedge_service",
+            default="",
+            help="AI service to also send a question to when the selected one is slow to start answering (empty disables)",
+        )
+        p.add_argument(
+            "--hedge_delay",
+            type=float,
+            default=3.0,
+            help="Seconds to wait for the first token of the answer before also asking hedge_service",
+        )
+        p.add_argument(
+            "--prompt_cache",
+            action="store_true",
+            help="Put the code a prompt refers to before the question, and have the AI service cache the start of prompts",
+        )
+        p.add_argument(
+            "--symbol_index",
+            action="store_true",
+            help="Index the classes, functions, and methods in the project, so prompts can refer to them with symbol() tags",
+        )
+        p.add_argument(
+            "--auto_context",
+            action="store_true",
+            help="When the prompt has no block, file, or folder tags, search the project for the most relevant code and add it to the prompt",
+        )
+        p.add_argument(
+            "--auto_context_results",
+            type=int,
+            default=5,
+            help="Most blocks, and most files, auto_context adds to the prompt",
+        )
+        p.add_argument(
+            "--include_globs",
+            default="",
+            help="Comma separated list of globs (.gitignore syntax). If set, only matching files are included",
+        )
+        p.add_argument(
+            "--exclude_globs",
+            default="",
+            help="Comma separated list of globs (.gitignore syntax) for files and folders to exclude",
+        )
 
         options = p.parse_args()
 
         AppConfig.ext_list = re.split(r"\s*,\s*", options.scan_extensions)
         AppConfig.ext_set = set(AppConfig.ext_list)
+        AppConfig.include_globs = AppConfig.split_list(options.include_globs)
+        AppConfig.exclude_globs = AppConfig.split_list(options.exclude_globs)
         return options
+
+    @staticmethod
+    def split_list(value: str) -> List[str]:
+        """Splits a comma separated config value into a list, dropping empty entries."""
+        return [v for v in re.split(r"\s*,\s*", value.strip()) if v]
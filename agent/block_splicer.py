@@ -0,0 +1,103 @@
+"""Replaces the content of named blocks in a file, all in one pass."""
+
+from typing import Dict, List, Optional, Set, Tuple, Iterable
+
+from agent.tag_lexer import TagLexer, TagLine
+from agent.tags import TAG_BLOCK_BEGIN, TAG_BLOCK_END
+
+
+class BlockSplicer:
+    """Replaces the content of any number of blocks in a file with a single pass over its lines.
+
+    We work on the raw bytes, so everything outside the replaced blocks (including the line endings, and
+    whether the file ends with a newline) is left exactly as it was, and the new content of a block is written
+    with the same line endings as its block_begin line.
+    """
+
+    @staticmethod
+    def newline_of(line: bytes) -> bytes:
+        """Returns the line ending of the line, or b"" for a last line without one."""
+        if line.endswith(b"\r\n"):
+            return b"\r\n"
+        if line.endswith(b"\n") or line.endswith(b"\r"):
+            return line[-1:]
+        return b""
+
+    @staticmethod
+    def encode_content(content: str, newline: bytes) -> bytes:
+        """Encodes the new content of a block, using the given line ending, and ending with one."""
+        if content == "":
+            return b""
+        if not content.endswith("\n"):
+            content += "\n"
+        data: bytes = content.encode("utf-8")
+        if newline != b"\n":
+            data = data.replace(b"\n", newline)
+        return data
+
+    @staticmethod
+    def splice(data: bytes, contents: Dict[str, str]) -> Tuple[bytes, Set[str]]:
+        """Replaces the content of the blocks named in `contents` (everything between their block_begin and
+        block_end lines). In source files the tags are only recognized inside comments, and a block that has
+        no block_end is left alone.
+
+        Returns the new data, and the names of the blocks that were replaced.
+        """
+        out: List[bytes] = []
+        replaced: Set[str] = set()
+
+        # The block we're replacing, the line ending of its block_begin line, and the lines we've dropped so
+        # far, which are put back if the block turns out to have no block_end.
+        name: Optional[str] = None
+        newline: bytes = b"\n"
+        dropped: List[bytes] = []
+
+        for line in data.splitlines(keepends=True):
+            tag_line: Optional[TagLine] = TagLexer.lex_bytes(line.strip())
+            if tag_line is not None and tag_line.prefix == "":
+                tag_line = None
+
+            if name is not None:
+                if tag_line is not None and tag_line.matches(TAG_BLOCK_END, None):
+                    out.append(BlockSplicer.encode_content(contents[name], newline))
+                    out.append(line)
+                    replaced.add(name)
+                    name = None
+                else:
+                    dropped.append(line)
+            else:
+                out.append(line)
+                if (
+                    tag_line is not None
+                    and tag_line.tag == TAG_BLOCK_BEGIN
+                    and tag_line.name in contents
+                ):
+                    name = tag_line.name
+                    newline = BlockSplicer.newline_of(line) or b"\n"
+                    dropped = []
+
+        if name is not None:
+            out.extend(dropped)
+        return b"".join(out), replaced
+
+    @staticmethod
+    def splice_spans(data: bytes, spans: Iterable[Tuple[int, int, str]]) -> bytes:
+        """Replaces the given (start, end) byte ranges, which must not overlap, with new content. This is for
+        symbols, which have no tags to find them by. Each range is whole lines, and its new content is written
+        with the line ending of the range's first line.
+        """
+        out: List[bytes] = []
+        pos: int = 0
+        for start, end, content in sorted(spans):
+            old: bytes = data[start:end]
+            eol: int = old.find(b"\n")
+            newline: bytes = b"\r\n" if eol > 0 and old[eol - 1 : eol] == b"\r" else b"\n"
+            new_data: bytes = BlockSplicer.encode_content(content, newline)
+            # A range at the end of a file that has no final newline stays without one
+            if old and BlockSplicer.newline_of(old) == b"" and new_data.endswith(newline):
+                new_data = new_data[: -len(newline)]
+            out.append(data[pos:start])
+            out.append(new_data)
+            pos = end
+        out.append(data[pos:])
+        return b"".join(out)
@@ -0,0 +1,129 @@
+"""Caches the content of project files, so each file is read from disk at most once while it's unchanged."""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Default for the most bytes of file content the cache holds
+DEFAULT_CACHE_SIZE = 64000000
+
+
+class ContentCache:
+    """A least recently used cache of file content, shared by everything that reads project files: the scan,
+    blocks loading their content, the prompt tags, and the mutator. Entries are keyed by path and are only
+    used while the file's size and modification time (in ns) are the same as when it was read, so a file that
+    changed is always read again.
+
+    The total size of the cached content is capped, and the least recently used files are evicted to stay
+    under the cap. Use `ContentCache.get_instance` to get the one shared instance.
+    """
+
+    instance: Optional["ContentCache"] = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.max_bytes: int = max_bytes
+        # (size, mtime_ns, content) keyed by path, least recently used first
+        self.entries: "OrderedDict[str, Tuple[int, int, bytes]]" = OrderedDict()
+        self.total_bytes: int = 0
+        self.lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        # Bytes actually read from disk on misses
+        self.bytes_read: int = 0
+
+    @staticmethod
+    def get_instance() -> "ContentCache":
+        """Returns the cache for this process."""
+        with ContentCache.instance_lock:
+            if ContentCache.instance is None:
+                ContentCache.instance = ContentCache()
+            return ContentCache.instance
+
+    @staticmethod
+    def configure(max_bytes: int):
+        """Sets the size cap of the shared cache. Zero disables caching."""
+        cache = ContentCache.get_instance()
+        with cache.lock:
+            cache.max_bytes = max_bytes
+            cache.evict()
+
+    def evict(self):
+        """Evicts the least recently used entries until the cache is under its cap. Must hold the lock."""
+        while self.entries and self.total_bytes > self.max_bytes:
+            _, (_, _, data) = self.entries.popitem(last=False)
+            self.total_bytes -= len(data)
+            self.evictions += 1
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        """Returns the cached content of the file, if it's cached and unchanged."""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            return None
+
+    def put(self, path: str, stat: os.stat_result, data: bytes):
+        """Caches content that was read from the file when it had the given stat."""
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.total_bytes -= len(old[2])
+            # A file bigger than the whole cache would just evict everything else
+            if len(data) <= self.max_bytes:
+                self.entries[path] = (stat.st_size, stat.st_mtime_ns, data)
+                self.total_bytes += len(data)
+                self.evict()
+
+    def invalidate(self, path: str):
+        """Drops the file from the cache, for when we're about to change it."""
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.total_bytes -= len(old[2])
+
+    def read_bytes(self, path: str, stat: Optional[os.stat_result] = None) -> bytes:
+        """Returns the content of the file, reading it only if it isn't cached or has changed. `stat` is the
+        file's stat, if the caller already has it."""
+        if stat is None:
+            stat = os.stat(path)
+        data: Optional[bytes] = self.get(path, stat)
+        if data is not None:
+            return data
+
+        with open(path, "rb") as file:
+            data = file.read()
+        with self.lock:
+            self.misses += 1
+            self.bytes_read += len(data)
+        # If the file changed while we read it, the stat we cache it under is already out of date, which just
+        # means the next read misses
+        self.put(path, stat, data)
+        return data
+
+    def read_text(self, path: str) -> str:
+        """Returns the content of a UTF-8 text file, with the same newlines as reading it in text mode."""
+        content: str = self.read_bytes(path).decode("utf-8")
+        if "\r" in content:
+            content = content.replace("\r\n", "\n").replace("\r", "\n")
+        return content
+
+    def try_read_text(self, path: str) -> Optional[str]:
+        """Returns the content of the file like `read_text`, or None if it isn't UTF-8. The scan skips files
+        that aren't, but one can change after the scan, and a prompt shouldn't fail because of it."""
+        try:
+            return self.read_text(path)
+        except UnicodeDecodeError:
+            return None
+
+    def summary(self) -> str:
+        """Returns a one line summary of how well the cache is doing."""
+        with self.lock:
+            return (
+                f"Content Cache: {self.hits} hits, {self.misses} misses, {self.bytes_read} bytes read, "
+                + f"{len(self.entries)} files ({self.total_bytes} bytes) cached, {self.evictions} evicted"
+            )
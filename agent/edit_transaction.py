@@ -0,0 +1,299 @@
+"""Stages all the file edits of one agent run, and commits them together, with a journal to undo them."""
+
+import os
+import json
+import time
+import zlib
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, BinaryIO
+
+from agent.content_cache import ContentCache
+
+# How many runs the journal keeps, so it doesn't grow forever. The oldest runs can no longer be undone.
+JOURNAL_MAX_RUNS = 20
+
+
+@dataclass
+class CommitStats:
+    """What committing a transaction did, and how long it took."""
+
+    run_id: str
+    files_written: int = 0
+    files_deleted: int = 0
+    bytes_written: int = 0
+    elapsed_ms: float = 0.0
+
+    def summary(self) -> str:
+        """Returns a one line summary of the commit."""
+        return (
+            f"Committed {self.files_written} files ({self.bytes_written} bytes"
+            + (f", {self.files_deleted} deleted" if self.files_deleted else "")
+            + f") in {self.elapsed_ms:.1f} ms"
+        )
+
+
+class EditTransaction:
+    """Stages all the file edits of one agent run in memory, so that nothing on disk changes until `commit`,
+    which then applies them all together: every file is written to a temp file next to it, the temp files are
+    fsynced as one batch, and only then are they moved into place with `os.replace`, which is atomic. A crash
+    can't leave a file half written, and only a crash during the final renames can leave some of the files
+    edited and others not.
+
+    Before committing, the previous version of every file is saved in the journal (compressed, and stored by
+    the hash of its content, so unchanged versions are only stored once), which lets `undo` put the whole run
+    back as it was.
+    """
+
+    def __init__(self, source_folder: str, journal_folder: str, run_id: str):
+        self.source_folder: str = source_folder
+        self.journal_folder: str = journal_folder
+        self.run_id: str = run_id
+        # New content keyed by full path. None means the file is to be deleted.
+        self.staged: Dict[str, Optional[bytes]] = {}
+        self.committed: bool = False
+
+    def full_path(self, file_name: str) -> str:
+        """Returns the full path of a file name relative to the source folder."""
+        if not file_name.startswith("/"):
+            file_name = "/" + file_name
+        return self.source_folder + file_name
+
+    def stage(self, path: str, data: Optional[bytes]):
+        """Stages the new content of a file (None to delete it). Staging the same file again replaces the
+        content staged before."""
+        if self.committed:
+            raise RuntimeError(f"Transaction {self.run_id} has already been committed")
+        self.staged[path] = data
+
+    def stage_text(self, path: str, content: str):
+        """Stages the new content of a text file."""
+        self.stage(path, content.encode("utf-8"))
+
+    def read(self, path: str) -> Optional[bytes]:
+        """Returns the content of the file as of this transaction, which is the staged content if there is
+        any, or otherwise what's on disk. Returns None if the file doesn't exist.
+        """
+        if path in self.staged:
+            return self.staged[path]
+        if not os.path.isfile(path):
+            return None
+        return ContentCache.get_instance().read_bytes(path)
+
+    def exists(self, path: str) -> bool:
+        """True if the file exists as of this transaction."""
+        if path in self.staged:
+            return self.staged[path] is not None
+        return os.path.isfile(path)
+
+    @staticmethod
+    def read_disk(path: str) -> Optional[bytes]:
+        """Returns the content of the file on disk, or None if it doesn't exist."""
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        """The content hash we store versions of files by."""
+        return hashlib.sha256(data).hexdigest()
+
+    def object_path(self, digest: str) -> str:
+        """Path of the journal file holding the (compressed) version of a file with the given hash."""
+        return os.path.join(self.journal_folder, "objects", digest + ".z")
+
+    def run_path(self, run_id: str) -> str:
+        """Path of the journal file recording what the run changed."""
+        return os.path.join(self.journal_folder, "runs", run_id + ".json")
+
+    @staticmethod
+    def write_durably(path: str, data: bytes):
+        """Writes a small file with a temp file and `os.replace`, for the journal."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path: str = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def write_journal(self, changes: List[Dict[str, Any]], previous: Dict[str, bytes]):
+        """Saves the previous versions of the files, and the record of the run, before anything changes."""
+        for digest, data in previous.items():
+            object_path = self.object_path(digest)
+            if not os.path.isfile(object_path):
+                EditTransaction.write_durably(object_path, zlib.compress(data))
+
+        record = {"run_id": self.run_id, "time": time.time(), "files": changes}
+        EditTransaction.write_durably(
+            self.run_path(self.run_id), json.dumps(record, indent=1).encode("utf-8")
+        )
+
+    def commit(self) -> CommitStats:
+        """Applies all the staged edits, and journals them so they can be undone."""
+        start = time.perf_counter()
+        stats = CommitStats(self.run_id)
+        self.committed = True
+
+        # Only the files whose content actually changes
+        changes: List[Dict[str, Any]] = []
+        previous: Dict[str, bytes] = {}
+        writes: Dict[str, bytes] = {}
+        deletes: List[str] = []
+        for path in sorted(self.staged):
+            data: Optional[bytes] = self.staged[path]
+            old: Optional[bytes] = EditTransaction.read_disk(path)
+            if data == old:
+                continue
+            before: Optional[str] = None
+            if old is not None:
+                before = EditTransaction.digest(old)
+                previous[before] = old
+            changes.append(
+                {
+                    "path": path[len(self.source_folder) :],
+                    "before": before,
+                    "after": EditTransaction.digest(data) if data is not None else None,
+                }
+            )
+            if data is None:
+                deletes.append(path)
+            else:
+                writes[path] = data
+
+        if changes:
+            self.write_journal(changes, previous)
+            EditTransaction.apply(writes, deletes)
+            self.prune_journal()
+
+        stats.files_written = len(writes)
+        stats.files_deleted = len(deletes)
+        stats.bytes_written = sum(len(data) for data in writes.values())
+        stats.elapsed_ms = (time.perf_counter() - start) * 1000
+        print(stats.summary())
+        return stats
+
+    @staticmethod
+    def apply(writes: Dict[str, bytes], deletes: List[str]):
+        """Writes all the files to temp files, fsyncs them together, and then moves them all into place. A
+        symlink stays a link, and its target is what gets written, and a file keeps its permissions."""
+        temp_paths: Dict[str, str] = {}
+        files: List[BinaryIO] = []
+        try:
+            for path, data in writes.items():
+                # Replacing the link itself would turn it into a copy of the file
+                path = os.path.realpath(path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.quanta-tmp"
+                file = open(temp_path, "wb")
+                files.append(file)
+                temp_paths[path] = temp_path
+                if os.path.isfile(path):
+                    os.chmod(temp_path, os.stat(path).st_mode)
+                file.write(data)
+                file.flush()
+
+            # Syncing only after everything is written lets the OS schedule the disk writes together
+            for file in files:
+                os.fsync(file.fileno())
+                file.close()
+        except BaseException:
+            for file in files:
+                file.close()
+            for temp_path in temp_paths.values():
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
+            raise
+
+        cache = ContentCache.get_instance()
+        for path in writes:
+            cache.invalidate(path)
+        for path, temp_path in temp_paths.items():
+            cache.invalidate(path)
+            os.replace(temp_path, path)
+        for path in deletes:
+            cache.invalidate(path)
+            if os.path.isfile(path):
+                os.remove(path)
+
+        # Makes the renames themselves durable. Windows doesn't support opening folders, nor need this.
+        if os.name == "posix":
+            for folder in {os.path.dirname(p) for p in list(temp_paths) + deletes}:
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def prune_journal(self):
+        """Deletes the oldest runs from the journal, and the versions no remaining run refers to."""
+        runs: List[str] = EditTransaction.list_runs(self.journal_folder)
+        if len(runs) <= JOURNAL_MAX_RUNS:
+            return
+        for run_id in runs[:-JOURNAL_MAX_RUNS]:
+            os.remove(self.run_path(run_id))
+
+        referenced = set()
+        for run_id in runs[-JOURNAL_MAX_RUNS:]:
+            for change in self.load_run(run_id)["files"]:
+                referenced.add(change["before"])
+        objects_folder = os.path.join(self.journal_folder, "objects")
+        for name in os.listdir(objects_folder):
+            if name[: -len(".z")] not in referenced:
+                os.remove(os.path.join(objects_folder, name))
+
+    @staticmethod
+    def list_runs(journal_folder: str) -> List[str]:
+        """Returns the ids of the runs in the journal, oldest first."""
+        runs_folder = os.path.join(journal_folder, "runs")
+        if not os.path.isdir(runs_folder):
+            return []
+        runs = [f[: -len(".json")] for f in os.listdir(runs_folder) if f.endswith(".json")]
+        # Run ids are timestamps, and sorting them as numbers still works if they ever get another digit
+        return sorted(runs, key=lambda r: (len(r), r))
+
+    def load_run(self, run_id: str) -> Dict[str, Any]:
+        """Loads the record of what the run changed."""
+        with open(self.run_path(run_id), "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    @staticmethod
+    def last_run(journal_folder: str) -> Optional[str]:
+        """Returns the id of the most recent run that can be undone, if there is one."""
+        runs = EditTransaction.list_runs(journal_folder)
+        return runs[-1] if runs else None
+
+    @staticmethod
+    def undo(source_folder: str, journal_folder: str, run_id: str) -> List[str]:
+        """Puts the files edited by the run back as they were, as one transaction of its own, and removes the
+        run from the journal. Files that were changed again since the run are left alone.
+
+        Returns a message for every file that couldn't be restored.
+        """
+        tx = EditTransaction(source_folder, journal_folder, f"undo-{run_id}")
+        problems: List[str] = []
+        for change in tx.load_run(run_id)["files"]:
+            path: str = source_folder + change["path"]
+            current: Optional[bytes] = EditTransaction.read_disk(path)
+            current_digest = EditTransaction.digest(current) if current is not None else None
+            if current_digest != change["after"]:
+                problems.append(f"{change['path']} has changed since, so it was not restored")
+                continue
+
+            if change["before"] is None:
+                tx.stage(path, None)
+            else:
+                with open(tx.object_path(change["before"]), "rb") as file:
+                    tx.stage(path, zlib.decompress(file.read()))
+
+        # Undoing doesn't get journaled itself
+        for path in sorted(tx.staged):
+            print(f"Restoring {path}")
+        EditTransaction.apply(
+            {p: d for p, d in tx.staged.items() if d is not None},
+            [p for p, d in tx.staged.items() if d is None],
+        )
+        os.remove(tx.run_path(run_id))
+        return problems
@@ -0,0 +1,266 @@
+"""Scans single files for named blocks. Kept free of any shared state so it can run in worker threads or processes."""
+
+import os
+import mmap
+import hashlib
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Any, Tuple
+
+from agent.models import BlockSpan
+from agent.content_cache import ContentCache
+from agent.tag_lexer import TagLexer, TagLine
+from agent.tags import (
+    TAG_BLOCK_BEGIN,
+    TAG_BLOCK_END,
+    TAG_BLOCK_OFF,
+    TAG_FILE_BEGIN,
+    TAG_FILE_END,
+)
+
+TAG_BLOCK_BEGIN_BYTES: bytes = TAG_BLOCK_BEGIN.encode("utf-8")
+
+# How much of the start of a file we check for NUL bytes, to detect binary files
+BINARY_SNIFF_SIZE = 8192
+
+# The arguments of `scan_file`, as one tuple
+ScanTask = Tuple[str, str, Optional[Dict[str, Any]], int, Optional[ContentCache]]
+
+
+@dataclass
+class FileScanResult:
+    """Everything a scan of one file produces, to be merged into the project by `ProjectLoader`."""
+
+    rel_filename: str
+    # The manifest entry describing the file as it is now
+    entry: Dict[str, Any]
+    blocks: List[BlockSpan] = field(default_factory=list)
+    # True if the file was actually parsed, False if the blocks came from the manifest
+    parsed: bool = False
+    # True if the byte level search showed the file has no blocks, so it didn't need parsing
+    untagged: bool = False
+    # Changed means the manifest entry differs from the one we were given
+    changed: bool = False
+    errors: List[str] = field(default_factory=list)
+    # If the file was skipped (binary, too large, etc) this says why. Skipped files are not part of the project.
+    skipped: Optional[str] = None
+
+
+class FileScanner:
+    """Scans single files for named blocks."""
+
+    @staticmethod
+    def parse_blocks(relative_file_name: str, data: bytes) -> Tuple[List[BlockSpan], List[str]]:
+        """Scans the lines of a file for the block_begin and block_end tags, and records where the content
+        between them is. We work on the raw bytes so we get byte offsets, and only tag lines are ever decoded.
+
+        Returns the block spans found, and any errors encountered. Errors are returned rather than reported,
+        because we may be running on a worker thread.
+        """
+        found: List[BlockSpan] = []
+        errors: List[str] = []
+
+        # State of the block we're currently in, if any
+        name: Optional[str] = None
+        start: int = 0
+        excluded: List[List[int]] = []
+        updateable: bool = True
+        # Where the current block_off region started, if we're in one
+        off_start: Optional[int] = None
+
+        def close_block(name: str, end: int):
+            if off_start is not None:
+                excluded.append([off_start, end])
+            found.append((name, start, end, excluded or None, updateable))
+
+        offset: int = 0
+        for line in data.splitlines(keepends=True):
+            line_start: int = offset
+            offset += len(line)
+
+            tag_line: Optional[TagLine] = TagLexer.lex_bytes(line.strip())
+            # Note: file_begin/file_end lines are just content as far as blocks are concerned
+            if tag_line is None or tag_line.tag in (TAG_FILE_BEGIN, TAG_FILE_END):
+                continue
+
+            if tag_line.tag == TAG_BLOCK_BEGIN:
+                # A block that never got its block_end ends where the next one begins
+                if name is not None:
+                    close_block(name, line_start)
+                name = tag_line.name if tag_line.name is not None else ""
+                start = offset
+                excluded = []
+                updateable = True
+                off_start = None
+            elif tag_line.tag == TAG_BLOCK_END:
+                if name is None:
+                    errors.append(
+                        f"""Encountered {TAG_BLOCK_END} without a corresponding {TAG_BLOCK_BEGIN} in {relative_file_name}"""
+                    )
+                else:
+                    close_block(name, line_start)
+                    name = None
+            elif name is not None:
+                if tag_line.tag == TAG_BLOCK_OFF:
+                    updateable = False
+                    if off_start is None:
+                        off_start = line_start
+                # block_on
+                elif off_start is not None:
+                    excluded.append([off_start, offset])
+                    off_start = None
+                # A block_on that isn't ending a block_off region is still not content
+                else:
+                    excluded.append([line_start, offset])
+
+        # A block that's still open at the end of the file runs to the end of the file
+        if name is not None:
+            close_block(name, offset)
+        return found, errors
+
+    @staticmethod
+    def result_from_entry(
+        relative_file_name: str, entry: Dict[str, Any], changed: bool
+    ) -> FileScanResult:
+        """Builds the scan result for a file straight from its manifest entry, without parsing the file."""
+        return FileScanResult(
+            relative_file_name,
+            entry,
+            entry["blocks"],
+            changed=changed,
+            skipped=entry.get("skipped"),
+        )
+
+    @staticmethod
+    def new_entry(
+        stat: os.stat_result,
+        digest: Optional[str],
+        blocks: List[BlockSpan],
+        skipped: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Creates the manifest entry for a file."""
+        entry: Dict[str, Any] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": digest,
+            "blocks": blocks,
+        }
+        if skipped is not None:
+            entry["skipped"] = skipped
+        return entry
+
+    @staticmethod
+    def scan_file(
+        path: str,
+        relative_file_name: str,
+        entry: Optional[Dict[str, Any]],
+        max_file_size: int,
+        cache: Optional[ContentCache] = None,
+    ) -> FileScanResult:
+        """Scans one file for blocks. `entry` is the manifest entry from the previous scan, if any, and if the
+        file hasn't changed since then we take its blocks from there instead of parsing the file.
+
+        Most files contain no blocks at all, so before decoding anything we memory map the file and search the
+        raw bytes for the block_begin tag. Files without it are recorded without being parsed (or even hashed,
+        since rescanning them is as cheap as checking a hash), once we know they decode. Binary files, files
+        larger than `max_file_size`, and files that aren't UTF-8 are skipped.
+
+        The content of files we parse is put in `cache`, if we're given one, since blocks (and the prompt) will
+        likely need it again.
+        """
+        stat = os.stat(path)
+
+        # Same size and modification time as last time, so we trust the file is unchanged
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return FileScanner.result_from_entry(relative_file_name, entry, False)
+
+        if stat.st_size > max_file_size:
+            skipped = f"larger than {max_file_size} bytes"
+            return FileScanResult(
+                relative_file_name,
+                FileScanner.new_entry(stat, None, [], skipped),
+                changed=True,
+                skipped=skipped,
+            )
+
+        # Empty files can't be memory mapped, but there's nothing in them anyway
+        if stat.st_size == 0:
+            return FileScanResult(
+                relative_file_name,
+                FileScanner.new_entry(stat, None, []),
+                untagged=True,
+                changed=True,
+            )
+
+        with open(path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            # Text files don't contain NUL bytes, and checking only the start of the file is enough
+            if mm.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1:
+                skipped = "binary file"
+                return FileScanResult(
+                    relative_file_name,
+                    FileScanner.new_entry(stat, None, [], skipped),
+                    changed=True,
+                    skipped=skipped,
+                )
+
+            if mm.find(TAG_BLOCK_BEGIN_BYTES) == -1:
+                # Its content still goes into prompts whole, so it has to be text we can decode
+                try:
+                    str(mm, "utf-8")
+                except UnicodeDecodeError:
+                    skipped = "not UTF-8 encoded"
+                    return FileScanResult(
+                        relative_file_name,
+                        FileScanner.new_entry(stat, None, [], skipped),
+                        changed=True,
+                        skipped=skipped,
+                    )
+                return FileScanResult(
+                    relative_file_name,
+                    FileScanner.new_entry(stat, None, []),
+                    untagged=True,
+                    changed=True,
+                )
+
+            data: bytes = mm[:]
+
+        if cache is not None:
+            cache.put(path, stat, data)
+
+        digest: str = hashlib.sha256(data).hexdigest()
+
+        # The file was touched but its content is the same (e.g. a git checkout), so the blocks are too
+        if entry is not None and entry["hash"] == digest:
+            entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            return FileScanner.result_from_entry(relative_file_name, entry, True)
+
+        try:
+            data.decode("utf-8")
+        except UnicodeDecodeError:
+            skipped = "not UTF-8 encoded"
+            return FileScanResult(
+                relative_file_name,
+                FileScanner.new_entry(stat, digest, [], skipped),
+                changed=True,
+                skipped=skipped,
+            )
+
+        found, errors = FileScanner.parse_blocks(relative_file_name, data)
+        return FileScanResult(
+            relative_file_name,
+            FileScanner.new_entry(stat, digest, found),
+            found,
+            parsed=True,
+            changed=True,
+            errors=errors,
+        )
+
+    @staticmethod
+    def scan_file_task(task: ScanTask) -> FileScanResult:
+        """Single argument version of `scan_file`, for use with `Executor.map`."""
+        return FileScanner.scan_file(*task)
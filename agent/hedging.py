@@ -0,0 +1,209 @@
+"""Sends a query to a second AI service when the first is slow to answer, and uses whichever answers first."""
+
+import time
+import queue
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+from uuid import UUID
+
+from langchain.chat_models.base import BaseChatModel
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+
+from agent.stream_handler import StreamHandler
+
+# How many of the latest latencies of each service the percentiles are computed from
+LATENCY_SAMPLES = 500
+
+
+class HedgeCancelled(Exception):
+    """Raised in a request that lost the race, to stop it."""
+
+
+class HedgeResult(NamedTuple):
+    """The answer that won, which service gave it, and how long that service took."""
+
+    service: str
+    message: BaseMessage
+    elapsed_ms: float
+    # True if the request was also sent to the backup service
+    hedged: bool
+    # The service of each request that lost, and how long it had run when it was cancelled, which is less than
+    # it would have taken
+    cancelled: List[Tuple[str, float]]
+
+
+class LatencyStats:
+    """The latest latencies of each AI service, for percentiles. Use `LatencyStats.get_instance` to get the one
+    shared instance."""
+
+    instance: Optional["LatencyStats"] = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: Dict[str, Deque[float]] = {}
+        # How many of the samples of each service are from requests that were cancelled
+        self.cancelled: Dict[str, int] = {}
+
+    @staticmethod
+    def get_instance() -> "LatencyStats":
+        """Returns the stats of this process."""
+        with LatencyStats.instance_lock:
+            if LatencyStats.instance is None:
+                LatencyStats.instance = LatencyStats()
+            return LatencyStats.instance
+
+    def record(self, service: str, elapsed_ms: float):
+        """Adds how long a query to the service took."""
+        with self.lock:
+            self.samples.setdefault(service, deque(maxlen=LATENCY_SAMPLES)).append(elapsed_ms)
+
+    def record_result(self, result: HedgeResult):
+        """Adds the latencies of a hedged query: the winner's, and how long each loser ran before it was
+        cancelled. Those are only lower bounds, but leaving them out would make a service that always loses
+        look as fast as the few times it won."""
+        self.record(result.service, result.elapsed_ms)
+        for service, elapsed_ms in result.cancelled:
+            self.record(service, elapsed_ms)
+            with self.lock:
+                self.cancelled[service] = self.cancelled.get(service, 0) + 1
+
+    def percentile(self, service: str, p: float) -> Optional[float]:
+        """Returns the p-th percentile (0 to 100) of the latencies of the service, or None if there are none."""
+        with self.lock:
+            samples: List[float] = sorted(self.samples.get(service, ()))
+        if not samples:
+            return None
+        # Nearest rank, so with few samples the high percentiles are the slowest query, not an average
+        rank: int = max(int(-(-p * len(samples) // 100)), 1)
+        return samples[rank - 1]
+
+    def summary(self) -> str:
+        """Returns a line per service with its latency percentiles."""
+        with self.lock:
+            counts: Dict[str, int] = {service: len(s) for service, s in self.samples.items()}
+            cancelled: Dict[str, int] = dict(self.cancelled)
+        lines: List[str] = []
+        for service in sorted(counts):
+            p50, p95, p99 = (self.percentile(service, p) for p in (50, 95, 99))
+            lines.append(
+                f"Latency of {service}: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms "
+                + f"({counts[service]} queries"
+                + (f", {cancelled[service]} cancelled" if cancelled.get(service) else "")
+                + ")"
+            )
+        return "\n".join(lines)
+
+
+class AttemptHandler(BaseCallbackHandler):
+    """Passes the tokens of one attempt back to the thread running the race, and stops the attempt if it lost."""
+
+    # Otherwise LangChain would log our HedgeCancelled and carry on
+    raise_error = True
+
+    def __init__(self, index: int, events: "queue.Queue[Tuple[int, str, Any]]"):
+        self.index: int = index
+        self.events: "queue.Queue[Tuple[int, str, Any]]" = events
+        self.cancelled = threading.Event()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if self.cancelled.is_set():
+            raise HedgeCancelled()
+        self.events.put((self.index, "token", token))
+
+
+class HedgedQuery:
+    """Sends a query to the first of `attempts` (service name and model), and if no token of the answer has
+    arrived after `delay` seconds, sends it to the second one too. Whichever of them finishes first wins, and
+    the other is cancelled. The first to send a token is streamed to `handler` as it arrives, so usually that's
+    the winner, but if the other one finishes first (or the first one fails) its answer is added after a note
+    saying so.
+
+    A request that fails before the backup was sent sends it right away. Only use this for queries without
+    tools, since running a tool twice would apply its edits twice.
+
+    Python can't stop a thread, so a request is cancelled by raising HedgeCancelled from its next token, which
+    closes the response. A model that doesn't stream can't be cancelled, and its answer is just ignored.
+    """
+
+    def __init__(self, attempts: List[Tuple[str, BaseChatModel]], delay: float):
+        self.attempts: List[Tuple[str, BaseChatModel]] = attempts
+        self.delay: float = delay
+        self.events: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+        self.handlers: List[AttemptHandler] = []
+        self.started: List[float] = []
+
+    def start(self, messages: List[BaseMessage]):
+        """Sends the query to the next service, in a thread of its own."""
+        index: int = len(self.handlers)
+        service, model = self.attempts[index]
+        handler = AttemptHandler(index, self.events)
+        self.handlers.append(handler)
+        self.started.append(time.perf_counter())
+        if index > 0:
+            print(f"Hedging: also asking {service}")
+
+        def run():
+            try:
+                self.events.put((index, "done", model.invoke(messages, {"callbacks": [handler]})))
+            except HedgeCancelled:
+                pass
+            except Exception as e:  # the race goes on with the other service, so any failure is only reported
+                self.events.put((index, "error", e))
+
+        threading.Thread(target=run, name=f"hedge-{service}", daemon=True).start()
+
+    def run(self, messages: List[BaseMessage], handler: StreamHandler) -> HedgeResult:
+        """Runs the race, and returns the answer that won. Raises the last error if every request failed."""
+        self.start(messages)
+        deadline: Optional[float] = time.perf_counter() + self.delay if len(self.attempts) > 1 else None
+        # The attempt whose tokens we're streaming
+        leader: Optional[int] = None
+        failed: Set[int] = set()
+
+        while True:
+            timeout: Optional[float] = None
+            if deadline is not None:
+                timeout = max(deadline - time.perf_counter(), 0.0)
+            try:
+                index, kind, value = self.events.get(timeout=timeout)
+            except queue.Empty:
+                deadline = None
+                self.start(messages)
+                continue
+
+            if kind == "token":
+                # An answer has started arriving, so there's no need to hedge
+                deadline = None
+                if leader is None:
+                    leader = index
+                if index == leader:
+                    handler.add_text(value)
+
+            elif kind == "error":
+                print(f"Hedging: {self.attempts[index][0]} failed: {value}")
+                failed.add(index)
+                if len(self.handlers) < len(self.attempts):
+                    deadline = None
+                    self.start(messages)
+                elif len(failed) == len(self.handlers):
+                    raise value
+
+            else:
+                now: float = time.perf_counter()
+                elapsed_ms: float = (now - self.started[index]) * 1000
+                cancelled: List[Tuple[str, float]] = []
+                for other in self.handlers:
+                    if other.index != index and other.index not in failed:
+                        other.cancelled.set()
+                        ran_ms: float = (now - self.started[other.index]) * 1000
+                        cancelled.append((self.attempts[other.index][0], ran_ms))
+                if leader is not None and leader != index:
+                    handler.add_text(f"\n[The answer from {self.attempts[index][0]}, which finished first:]\n", False)
+                if leader != index:
+                    handler.add_text(str(value.content))
+                handler.end_text()
+                handler.timing.llm_calls += len(self.handlers)
+                return HedgeResult(self.attempts[index][0], value, elapsed_ms, len(self.handlers) > 1, cancelled)
@@ -0,0 +1,234 @@
+"""Background service that keeps the project index current from filesystem events."""
+
+import os
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+
+from agent.app_config import AppConfig
+from agent.models import ProjectSnapshot
+from agent.project_loader import ProjectLoader
+from agent.project_walker import GITIGNORE_FILE, ProjectWalker
+
+# (event type, path, destination path for moves, is directory, time received)
+QueuedEvent = Tuple[str, str, Optional[str], bool, float]
+
+
+@dataclass
+class IndexStatus:
+    """How fresh the index is, for display in the GUI."""
+
+    version: int
+    file_count: int
+    block_count: int
+    # Seconds since the snapshot was taken
+    age_seconds: float
+    # Time from receiving the last event to having it applied to the index
+    last_event_lag_ms: float
+    events_applied: int
+    events_pending: int
+    errors: List[str]
+
+
+class IndexService(FileSystemEventHandler):
+    """Scans the project once per process, and then keeps the block and file index up to date by applying
+    create, modify, delete, and move events from the filesystem. Every change publishes a new snapshot, so
+    getting the current one is O(1) and never waits for a scan.
+
+    Use `IndexService.get_instance` to get the one shared instance.
+    """
+
+    instance: Optional["IndexService"] = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, cfg: argparse.Namespace):
+        super().__init__()
+        self.cfg = cfg
+        self.source_folder: str = cfg.source_folder
+        self.loader = ProjectLoader(
+            None,
+            len(cfg.source_folder),
+            f"{cfg.data_folder}/scan_manifest.json",
+            cfg.scan_workers,
+            cfg.scan_pool,
+            cfg.max_scan_file_size,
+            collect_errors=True,
+            search_index_file=f"{cfg.data_folder}/search_index.db" if cfg.auto_context else None,
+            symbol_index_file=f"{cfg.data_folder}/symbol_index.json" if cfg.symbol_index else None,
+        )
+        self.walker = self.create_walker()
+        # Guards the loader, which the worker thread updates
+        self.lock = threading.Lock()
+        self.events: "queue.Queue[QueuedEvent]" = queue.Queue()
+        self.observer = Observer()
+        self.version: int = 0
+        self.snapshot: Optional[ProjectSnapshot] = None
+        self.last_event_lag_ms: float = 0.0
+        self.events_applied: int = 0
+
+    @staticmethod
+    def get_instance(cfg: argparse.Namespace) -> "IndexService":
+        """Returns the service for this process, starting it on first use."""
+        with IndexService.instance_lock:
+            if IndexService.instance is None:
+                service = IndexService(cfg)
+                service.start()
+                IndexService.instance = service
+            return IndexService.instance
+
+    def create_walker(self) -> ProjectWalker:
+        """Creates the walker used to decide which paths are part of the project."""
+        return ProjectWalker(
+            self.source_folder,
+            AppConfig.ext_set,
+            AppConfig.include_globs,
+            AppConfig.exclude_globs,
+        )
+
+    def start(self):
+        """Does the initial scan, and starts watching for changes."""
+        with self.lock:
+            self.loader.scan_directory(self.source_folder)
+            self.publish()
+
+        self.observer.schedule(self, self.source_folder, recursive=True)
+        self.observer.daemon = True
+        self.observer.start()
+        threading.Thread(
+            target=self.process_events, name="IndexService", daemon=True
+        ).start()
+        print(f"Index Service watching {self.source_folder}")
+
+    def stop(self):
+        """Stops watching for changes."""
+        self.observer.stop()
+
+    def on_any_event(self, event: FileSystemEvent):
+        """Called by watchdog on its own thread. We just queue the event, so watchdog is never held up."""
+        if event.event_type in ("created", "modified", "deleted", "moved"):
+            self.events.put(
+                (
+                    event.event_type,
+                    str(event.src_path),
+                    str(event.dest_path) if event.event_type == "moved" else None,
+                    event.is_directory,
+                    time.time(),
+                )
+            )
+
+    def process_events(self):
+        """Worker thread that applies queued events to the index. Events that arrive together are applied as
+        one batch, with a single new snapshot at the end.
+        """
+        while True:
+            batch: List[QueuedEvent] = [self.events.get()]
+            while True:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.apply_batch(batch)
+
+    def apply_batch(self, batch: List[QueuedEvent]):
+        """Applies a batch of events, and publishes a new snapshot if they changed anything. A batch that fails
+        is recorded in the loader's errors, which `status` shows, and the worker thread goes on to the next.
+        """
+        with self.lock:
+            try:
+                changed = False
+                for event in batch:
+                    try:
+                        changed = self.apply_event(*event[:4]) or changed
+                    except (IOError, OSError) as e:
+                        # The file may be gone again already. A later event will put things right.
+                        print(f"Index Service: failed to apply {event[0]} {event[1]}: {e}")
+                if changed:
+                    self.publish()
+            except Exception as e:  # if the thread died the index would silently stop being updated
+                msg = f"Index Service: failed to apply {len(batch)} events: {e}"
+                print(msg)
+                self.loader.errors.append(msg)
+
+            self.events_applied += len(batch)
+            self.last_event_lag_ms = (time.time() - batch[0][4]) * 1000
+
+    def apply_event(
+        self, event_type: str, path: str, dest_path: Optional[str], is_directory: bool
+    ) -> bool:
+        """Applies one event to the index. Returns True if the index changed."""
+
+        # A changed .gitignore can change what's in the project in any number of ways, so we start over
+        if os.path.basename(path) == GITIGNORE_FILE or (
+            dest_path is not None and os.path.basename(dest_path) == GITIGNORE_FILE
+        ):
+            self.walker = self.create_walker()
+            self.loader.scan_directory(self.source_folder)
+            return True
+
+        if event_type == "moved":
+            changed = self.remove_path(path, is_directory)
+            if dest_path is not None:
+                changed = self.add_path(dest_path, is_directory) or changed
+            return changed
+        if event_type == "deleted":
+            return self.remove_path(path, is_directory)
+        # A folder being modified just means its entries changed, and we get separate events for those
+        if event_type == "modified" and is_directory:
+            return False
+        return self.add_path(path, is_directory)
+
+    def add_path(self, path: str, is_directory: bool) -> bool:
+        """Adds (or updates) a file or folder, if it's part of the project."""
+        if not self.walker.is_path_included(path, is_directory):
+            return False
+        if is_directory:
+            self.loader.add_folder(path, self.walker)
+        elif os.path.isfile(path):
+            self.loader.update_file(path)
+        else:
+            return False
+        return True
+
+    def remove_path(self, path: str, is_directory: bool) -> bool:
+        """Removes a file or folder from the index."""
+        rel: str = path[len(self.source_folder) :]
+        if is_directory:
+            self.loader.remove_folder(rel)
+        elif rel in self.loader.manifest:
+            self.loader.remove_file(rel)
+        else:
+            return False
+        return True
+
+    def publish(self):
+        """Publishes a new snapshot of the index. Must be called holding the lock."""
+        self.loader.update_indexes()
+        self.version += 1
+        self.snapshot = self.loader.snapshot(self.version)
+
+    def get_snapshot(self) -> ProjectSnapshot:
+        """Returns the current snapshot of the project."""
+        snapshot = self.snapshot
+        assert snapshot is not None
+        return snapshot
+
+    def status(self) -> IndexStatus:
+        """Returns how fresh the index is, and how well it's keeping up with events."""
+        snapshot = self.get_snapshot()
+        return IndexStatus(
+            snapshot.version,
+            len(snapshot.file_names),
+            len(snapshot.blocks),
+            time.time() - snapshot.created,
+            self.last_event_lag_ms,
+            self.events_applied,
+            self.events.qsize(),
+            list(self.loader.errors),
+        )
@@ -0,0 +1,220 @@
+"""Keeps the clients of the AI services for the life of the process, so queries reuse warm connections."""
+
+import functools
+import threading
+import importlib.util
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Set
+
+import httpx
+import anthropic
+from langchain.chat_models.base import BaseChatModel
+from langchain_core.caches import BaseCache
+from langchain_openai import ChatOpenAI
+from pydantic.v1.types import SecretStr
+
+from agent.prompt_cache import CachingChatAnthropic, UsageTap
+from agent.utils import AIService, Utils
+
+# Connections kept open to each service. Idle ones are closed after a while, since the service would close
+# them anyway.
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+
+# HTTP/2 needs the optional `h2` package, and without it we stay on HTTP/1.1 keep-alive connections
+HTTP2: bool = importlib.util.find_spec("h2") is not None
+
+# What we send a request to when warming up the connection to a service
+DEFAULT_BASE_URLS: Dict[str, str] = {
+    AIService.OPENAI.value: "https://api.openai.com/v1",
+    AIService.ANTHROPIC.value: "https://api.anthropic.com",
+}
+
+
+class LLMClientKey(NamedTuple):
+    """What a model is kept by. Anything else about a query is set on the copy made for it."""
+
+    service: str
+    model: str
+    temperature: float
+    timeout: float
+
+
+class LLMClients:
+    """The models we've created, each with its client for the service, kept so the next query with the same
+    settings doesn't have to build them again. All the models of a service share one HTTP connection pool,
+    so after the first query (or after `warm`) a query doesn't have to open a connection, or do a TLS
+    handshake, before sending its request.
+
+    The least recently used models are dropped once there are more than `llm_clients`. The connection pools
+    stay, since there's only one per service. Use `LLMClients.get_instance` to get the one shared instance.
+    """
+
+    instance: Optional["LLMClients"] = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models: OrderedDict[LLMClientKey, BaseChatModel] = OrderedDict()
+        # HTTP connection pools keyed by service
+        self.pools: Dict[str, httpx.Client] = {}
+        # The services we've opened a connection to ahead of the first query
+        self.warmed: Set[str] = set()
+        self.created: int = 0
+        self.reused: int = 0
+
+    @staticmethod
+    def get_instance() -> "LLMClients":
+        """Returns the clients of this process."""
+        with LLMClients.instance_lock:
+            if LLMClients.instance is None:
+                LLMClients.instance = LLMClients()
+            return LLMClients.instance
+
+    # Need to make cfg typesafe so we can get rid of all the `type: ignore` comments
+    @staticmethod
+    def create_llm(
+        cfg,
+        ai_service: str,
+        temperature: float,
+        cache: Optional[BaseCache] = None,
+        streaming: bool = False,
+    ) -> BaseChatModel:
+        """Returns a language model for the AI service, reusing the client of an earlier query if there is one.
+        If a `cache` is given, responses are looked up in it before calling the service. With `streaming` the
+        answer is passed to the callbacks token by token."""
+        model: BaseChatModel = LLMClients.get_instance().get(cfg, ai_service, temperature)
+        update: Dict[str, Any] = {"cache": cache, "streaming": streaming}
+        if streaming and isinstance(model, ChatOpenAI):
+            # Otherwise OpenAI leaves the usage, and so the cached prompt tokens, out of streamed answers
+            update["model_kwargs"] = {**model.model_kwargs, "stream_options": {"include_usage": True}}
+        return LLMClients.copy(model, update)
+
+    @staticmethod
+    def copy(model: BaseChatModel, update: Dict[str, Any]) -> BaseChatModel:
+        """Returns a shallow copy of the model, sharing its client, with the given fields changed."""
+        # `copy` leaves out the fields marked as excluded (like the callbacks, and the client of ChatOpenAI),
+        # so we pass those along ourselves
+        fields: Dict[str, Any] = {
+            name: getattr(model, name)
+            for name, field in model.__fields__.items()
+            if field.field_info.exclude
+        }
+        return model.copy(update={**fields, **update})
+
+    @staticmethod
+    def key(cfg, ai_service: str, temperature: float) -> LLMClientKey:
+        """The key of the model for the query."""
+        model: str = cfg.anth_model if ai_service == AIService.ANTHROPIC.value else cfg.openai_model
+        return LLMClientKey(ai_service, model, temperature, float(cfg.llm_timeout))
+
+    def get(self, cfg, ai_service: str, temperature: float) -> BaseChatModel:
+        """Returns the shared model for the settings, creating it if needed. Don't change it, copy it."""
+        key: LLMClientKey = LLMClients.key(cfg, ai_service, temperature)
+        with self.lock:
+            model: Optional[BaseChatModel] = self.models.get(key)
+            if model is not None:
+                self.models.move_to_end(key)
+                self.reused += 1
+                return model
+
+            model = self.create(cfg, key, self.pool(cfg, ai_service))
+            self.models[key] = model
+            self.created += 1
+            while len(self.models) > max(int(cfg.llm_clients), 1):
+                self.models.popitem(last=False)
+            return model
+
+    def pool(self, cfg, ai_service: str) -> httpx.Client:
+        """Returns the connection pool of the service. Must hold the lock."""
+        pool: Optional[httpx.Client] = self.pools.get(ai_service)
+        if pool is None:
+            pool = httpx.Client(
+                limits=POOL_LIMITS,
+                http2=HTTP2,
+                timeout=float(cfg.llm_timeout),
+                # Records how many prompt tokens the service had cached
+                event_hooks={"response": [functools.partial(UsageTap.attach, ai_service)]},
+            )
+            self.pools[ai_service] = pool
+        return pool
+
+    @staticmethod
+    def base_url(cfg, ai_service: str) -> str:
+        """The URL of the service, which is only configured for a proxy, or a compatible server."""
+        url: str = cfg.anth_base_url if ai_service == AIService.ANTHROPIC.value else cfg.openai_base_url
+        return url or DEFAULT_BASE_URLS.get(ai_service, "")
+
+    @staticmethod
+    def create(cfg, key: LLMClientKey, pool: httpx.Client) -> BaseChatModel:
+        """Creates the model, with a client that sends its requests through `pool`."""
+        if key.service == AIService.OPENAI.value:
+            print("Creating OpenAI service")
+            return ChatOpenAI(
+                model=key.model,
+                temperature=key.temperature,
+                timeout=key.timeout,
+                api_key=cfg.openai_api_key,
+                base_url=cfg.openai_base_url or None,
+                http_client=pool,
+                verbose=True,
+            )
+        if key.service == AIService.ANTHROPIC.value:
+            print("Creating Anthropic service")
+            model = CachingChatAnthropic(
+                model_name=key.model,
+                temperature=key.temperature,
+                timeout=key.timeout,  # timeout in seconds
+                api_key=SecretStr(cfg.anth_api_key),
+                anthropic_api_url=cfg.anth_base_url or None,
+                cache_prompt=bool(cfg.prompt_cache),
+            )
+            # ChatAnthropic can't be given an HTTP client, so we replace the client it made with one that has
+            client = anthropic.Client(
+                api_key=cfg.anth_api_key,
+                base_url=model.anthropic_api_url,
+                max_retries=model.max_retries,
+                timeout=key.timeout,
+                http_client=pool,
+            )
+            return LLMClients.copy(model, {"_client": client})
+        Utils.fail_app(f"Invalid AI Service: {key.service}")
+        raise ValueError(key.service)
+
+    def warm(self, cfg, ai_service: str, temperature: float = 0.0) -> Optional[threading.Thread]:
+        """Creates the model for the settings, and opens a connection to the service in the background, so the
+        first query doesn't wait for either. Any response at all means the connection is open, so we don't
+        need to authenticate, and a failure only means the first query opens the connection itself. Returns
+        the thread opening the connection, or None if the service was warmed already."""
+        self.get(cfg, ai_service, temperature)
+        with self.lock:
+            if ai_service in self.warmed:
+                return None
+            self.warmed.add(ai_service)
+            pool: httpx.Client = self.pool(cfg, ai_service)
+
+        def connect():
+            try:
+                pool.head(LLMClients.base_url(cfg, ai_service))
+            except httpx.HTTPError as e:
+                print(f"Unable to warm up the connection to {ai_service}: {e}")
+
+        thread = threading.Thread(target=connect, name=f"warm-{ai_service}", daemon=True)
+        thread.start()
+        return thread
+
+    def summary(self) -> str:
+        """Returns a one line summary of how often the models were reused."""
+        with self.lock:
+            return (
+                f"LLM Clients: {len(self.models)} kept, {self.created} created, {self.reused} reused, "
+                + f"{'HTTP/2' if HTTP2 else 'HTTP/1.1'}"
+            )
+
+    def close(self):
+        """Drops every model, and closes the connections."""
+        with self.lock:
+            self.models.clear()
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+            self.warmed = set()
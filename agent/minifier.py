@@ -0,0 +1,193 @@
+"""Shrinks the file content we put into prompts, to save tokens."""
+
+import hashlib
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from agent.tag_lexer import TagLexer
+from agent.token_budget import TokenCounter
+
+MINIFY_DUPLICATES = "duplicates"
+MINIFY_HEADERS = "headers"
+MINIFY_COMMENTS = "comments"
+MINIFY_WHITESPACE = "whitespace"
+
+# In the order they're applied. Headers have to be found before comments are stripped.
+MINIFY_STAGES: Tuple[str, ...] = (
+    MINIFY_DUPLICATES,
+    MINIFY_HEADERS,
+    MINIFY_COMMENTS,
+    MINIFY_WHITESPACE,
+)
+
+# The only stage that's safe when the AI may send back whole files, because it doesn't change any content the
+# AI sees. With the others the AI would write the files back without their comments and blank lines.
+REFACTOR_SAFE_STAGES: Set[str] = {MINIFY_DUPLICATES}
+
+# Line comment prefix, by file extension
+LINE_COMMENTS: Dict[str, str] = {
+    ".py": "#",
+    ".sh": "#",
+    ".yaml": "#",
+    ".yml": "#",
+    ".sql": "--",
+    ".java": "//",
+    ".js": "//",
+    ".ts": "//",
+}
+
+# Block comment delimiters, by file extension
+BLOCK_COMMENTS: Dict[str, Tuple[str, str]] = {
+    ".java": ("/*", "*/"),
+    ".js": ("/*", "*/"),
+    ".ts": ("/*", "*/"),
+    ".css": ("/*", "*/"),
+    ".sql": ("/*", "*/"),
+    ".html": ("<!--", "-->"),
+    ".htm": ("<!--", "-->"),
+}
+
+# A header has to be at least this many lines before we bother replacing repeats of it
+MIN_HEADER_LINES = 3
+
+
+class ContentMinifier:
+    """Applies the configured minification stages to the files put into one prompt:
+
+    - duplicates: a file with exactly the same content as one already in the prompt is replaced by a
+      reference to that file.
+    - headers: a comment header at the top of a file (like a license) that's the same as one already in the
+      prompt is replaced by a reference to the file it was in.
+    - comments: lines that are only a comment, and block comments that start a line, are removed. Comments
+      after code on the same line are left alone, since telling them apart from strings would mean parsing
+      every language, and tag lines (block_begin etc.) are always kept.
+    - whitespace: trailing whitespace is removed, and runs of blank lines become a single one.
+      Indentation is left alone.
+
+    A minifier remembers the files it has seen, so use a new one for each prompt.
+    """
+
+    def __init__(self, stages: Set[str], counter: Optional[TokenCounter] = None):
+        self.stages: Set[str] = stages
+        self.counter: Optional[TokenCounter] = counter
+        # The first file with each content (by hash), and with each header
+        self.seen_content: Dict[str, str] = {}
+        self.seen_headers: Dict[str, str] = {}
+        self.tokens_saved: int = 0
+
+    @staticmethod
+    def for_mode(
+        stages: List[str], refactoring: bool, counter: Optional[TokenCounter]
+    ) -> Optional["ContentMinifier"]:
+        """Creates the minifier for the configured stages, or returns None if there aren't any to apply."""
+        selected: Set[str] = set()
+        for stage in stages:
+            if stage not in MINIFY_STAGES:
+                print(f"Ignoring unknown minify stage: {stage}")
+            elif not refactoring or stage in REFACTOR_SAFE_STAGES:
+                selected.add(stage)
+        return ContentMinifier(selected, counter) if selected else None
+
+    def minify(self, file_name: str, content: str) -> str:
+        """Returns the content of the file, minified."""
+        original: str = content
+        _, ext = os.path.splitext(file_name)
+        ext = ext.lower()
+
+        if MINIFY_DUPLICATES in self.stages:
+            digest: str = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            first: Optional[str] = self.seen_content.get(digest)
+            if first is not None:
+                content = f"(identical to {first})"
+                self.count_saved(original, content)
+                return content
+            self.seen_content[digest] = file_name
+
+        if MINIFY_HEADERS in self.stages:
+            header, rest = ContentMinifier.split_header(ext, content)
+            if header.count("\n") >= MIN_HEADER_LINES:
+                first = self.seen_headers.get(header)
+                if first is None:
+                    self.seen_headers[header] = file_name
+                else:
+                    content = f"(same header as {first})\n" + rest
+
+        if MINIFY_COMMENTS in self.stages:
+            content = ContentMinifier.strip_comments(ext, content)
+
+        if MINIFY_WHITESPACE in self.stages:
+            content = ContentMinifier.collapse_whitespace(content)
+
+        self.count_saved(original, content)
+        return content
+
+    def count_saved(self, original: str, content: str):
+        """Adds up the tokens minifying saved."""
+        if self.counter is not None and content != original:
+            self.tokens_saved += self.counter.count(original) - self.counter.count(content)
+
+    @staticmethod
+    def comment_lines(ext: str, lines: List[str]) -> List[bool]:
+        """Returns, for each line, whether it's only a comment (or part of a block comment). Tag lines are
+        never counted as comments, so they always survive.
+        """
+        line_prefix: Optional[str] = LINE_COMMENTS.get(ext)
+        block: Optional[Tuple[str, str]] = BLOCK_COMMENTS.get(ext)
+        result: List[bool] = []
+        in_block: bool = False
+
+        for line in lines:
+            stripped: str = line.strip()
+            if TagLexer.lex(stripped) is not None:
+                result.append(False)
+            elif in_block:
+                assert block is not None
+                end: int = stripped.find(block[1])
+                if end != -1:
+                    in_block = False
+                    # Code after the end of the comment means we have to keep the line
+                    result.append(stripped[end + len(block[1]) :].strip() == "")
+                else:
+                    result.append(True)
+            elif line_prefix is not None and stripped.startswith(line_prefix):
+                result.append(True)
+            elif block is not None and stripped.startswith(block[0]):
+                end = stripped.find(block[1], len(block[0]))
+                if end == -1:
+                    in_block = True
+                    result.append(True)
+                else:
+                    result.append(stripped[end + len(block[1]) :].strip() == "")
+            else:
+                result.append(False)
+        return result
+
+    @staticmethod
+    def strip_comments(ext: str, content: str) -> str:
+        """Removes the lines that are only comments."""
+        lines: List[str] = content.splitlines(keepends=True)
+        comments: List[bool] = ContentMinifier.comment_lines(ext, lines)
+        return "".join(line for line, comment in zip(lines, comments) if not comment)
+
+    @staticmethod
+    def split_header(ext: str, content: str) -> Tuple[str, str]:
+        """Splits the file into its header (the comments and blank lines at the top) and the rest."""
+        lines: List[str] = content.splitlines(keepends=True)
+        comments: List[bool] = ContentMinifier.comment_lines(ext, lines)
+        count: int = 0
+        while count < len(lines) and (comments[count] or lines[count].strip() == ""):
+            count += 1
+        return "".join(lines[:count]), "".join(lines[count:])
+
+    @staticmethod
+    def collapse_whitespace(content: str) -> str:
+        """Removes trailing whitespace, and collapses runs of blank lines into one."""
+        lines: List[str] = []
+        for line in content.splitlines():
+            line = line.rstrip()
+            if line == "" and (not lines or lines[-1] == ""):
+                continue
+            lines.append(line)
+        while lines and lines[-1] == "":
+            lines.pop()
+        return "\n".join(lines)
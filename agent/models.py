@@ -1,23 +1,285 @@
+import os
 from dataclasses import dataclass
-from typing import Optional
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple,
+    Sequence,
+    NamedTuple,
+    Mapping,
+    MutableMapping,
+    Iterator,
+    Set,
+)
+
+from agent.content_cache import ContentCache
+
+
+# Where a block is in its file: (name, start, end, excluded, updateable). The offsets are byte offsets, and
+# `excluded` holds the (start, end) ranges inside the block that are not part of its content (the block_off
+# regions), or None if there are none. This is what the scanner produces and what the manifest stores.
+BlockSpan = Tuple[str, int, int, Optional[Sequence[Sequence[int]]], bool]
+
+# The size and modification time (in ns) of a file when it was scanned. Block offsets are only good for that
+# version of the file.
+FileVersion = Tuple[int, int]
+
+
+class ProjectChangedError(Exception):
+    """Raised when a block is read from a file that changed since it was scanned, so the block's offsets no
+    longer point at its content."""
+
+
+class FileTable:
+    """The files that contain blocks, so blocks can refer to their file by a small integer id, and read
+    their content from disk when it's needed.
+
+    Each id is for one version of a file, as it was when it was scanned. A file that has changed gets a new id
+    when it's scanned again, so the blocks from before keep the old version, and reading them fails instead of
+    returning whatever is at their offsets now.
+    """
+
+    def __init__(self, source_folder: str):
+        self.source_folder: str = source_folder
+        # Relative file names, and the version of each, indexed by file id
+        self.names: List[str] = []
+        self.versions: List[FileVersion] = []
+        # The id of the latest version of each file
+        self.ids: Dict[str, int] = {}
+
+    def add(self, rel_filename: str, version: FileVersion) -> int:
+        """Returns the id of the file as it was at the given version, adding it to the table if needed."""
+        file_id = self.ids.get(rel_filename)
+        if file_id is None or self.versions[file_id] != version:
+            file_id = len(self.names)
+            self.names.append(rel_filename)
+            self.versions.append(version)
+            self.ids[rel_filename] = file_id
+        return file_id
+
+    def stat_current(self, block: "TextBlock") -> Optional[os.stat_result]:
+        """Returns the stat of the block's file if the file hasn't changed since the block was found in it, so
+        the block's offsets can be trusted, or None if it has changed (or is gone)."""
+        try:
+            stat = os.stat(self.source_folder + self.names[block.file_id])
+        except FileNotFoundError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != self.versions[block.file_id]:
+            return None
+        return stat
+
+    def read_block(self, block: "TextBlock") -> str:
+        """Reads the content of a block from its file, through the content cache. Raises ProjectChangedError if
+        the file changed since the block was found in it."""
+        rel_filename: str = self.names[block.file_id]
+        path: str = self.source_folder + rel_filename
+        stat: Optional[os.stat_result] = self.stat_current(block)
+        if stat is None:
+            raise ProjectChangedError(
+                f"{rel_filename} changed since the project was scanned, so block {block.name} can't be read. "
+                + "Rescan the project."
+            )
+        data: bytes = ContentCache.get_instance().read_bytes(path, stat)[block.start : block.end]
+
+        if block.excluded is not None:
+            kept: List[bytes] = []
+            pos = 0
+            for ex_start, ex_end in block.excluded:
+                kept.append(data[pos : ex_start - block.start])
+                pos = ex_end - block.start
+            kept.append(data[pos:])
+            data = b"".join(kept)
+
+        content: str = data.decode("utf-8")
+        # Same newlines we'd get from reading the file in text mode
+        if "\r" in content:
+            content = content.replace("\r\n", "\n").replace("\r", "\n")
+        return content
 
 
-@dataclass
 class TextBlock:
-    """Represents a block of text in a file."""
-
-    rel_filename: Optional[str]
-    name: str
-    content: str
-    dirty: bool = False
-
-    # Blocks will remain updateable only if there's no block_off/block_on tags inside the block.
-    updateable: bool = True
-
-    #constructor function
-    def __init__(self, rel_filename: Optional[str], name: str, content: str, dirty: bool = False, updateable: bool = True):
-        self.rel_filename = rel_filename
-        self.name = name
-        self.content = content
-        self.dirty = dirty
-        self.updateable = updateable
\ No newline at end of file
+    """Represents a block of text in a file.
+
+    A block only records where it is in its file, and its content is read from disk when it's asked for, so
+    that indexing a large project doesn't keep the text of every block in memory. Only blocks that have been
+    edited (which is what makes a block dirty) hold their content.
+    """
+
+    __slots__ = (
+        "files",
+        "file_id",
+        "name",
+        "start",
+        "end",
+        "excluded",
+        "updateable",
+        "tagged",
+        "edited",
+    )
+
+    def __init__(
+        self,
+        files: FileTable,
+        file_id: int,
+        name: str,
+        start: int,
+        end: int,
+        excluded: Optional[Sequence[Sequence[int]]] = None,
+        updateable: bool = True,
+        tagged: bool = True,
+    ):
+        self.files: FileTable = files
+        self.file_id: int = file_id
+        self.name: str = name
+        # Byte offsets of the content, which is the lines between the block_begin and block_end lines
+        self.start: int = start
+        self.end: int = end
+        self.excluded: Optional[Tuple[Tuple[int, int], ...]] = (
+            tuple((s, e) for s, e in excluded) if excluded else None
+        )
+        # Blocks will remain updateable only if there's no block_off/block_on tags inside the block.
+        self.updateable: bool = updateable
+        # False for a symbol (a class, function, or method) rather than a named block. Those have no tags around
+        # them, so they can only be found in their file by their offsets.
+        self.tagged: bool = tagged
+        # New content set by an edit, or None if the block hasn't been edited
+        self.edited: Optional[str] = None
+
+    @property
+    def rel_filename(self) -> str:
+        """The file name, relative to the source folder."""
+        return self.files.names[self.file_id]
+
+    @property
+    def content(self) -> str:
+        """The edited content if there is one, otherwise the content as it is in the file."""
+        if self.edited is not None:
+            return self.edited
+        return self.files.read_block(self)
+
+    @property
+    def dirty(self) -> bool:
+        """True if the block has been edited, and needs to be written back to its file."""
+        return self.edited is not None
+
+    def with_content(self, content: str) -> "TextBlock":
+        """Returns an edited copy of this block. Edits never modify a block in place, because blocks can be
+        shared with the index that other agent runs read from."""
+        block = TextBlock(
+            self.files,
+            self.file_id,
+            self.name,
+            self.start,
+            self.end,
+            self.excluded,
+            self.updateable,
+            self.tagged,
+        )
+        block.edited = content
+        return block
+
+    def __repr__(self) -> str:
+        return f"TextBlock({self.name!r}, {self.rel_filename!r}, {self.start}:{self.end}, dirty={self.dirty})"
+
+
+@dataclass
+class ScanStats:
+    """Counters collected during a project scan, so we can compare cold and warm scans."""
+
+    files_total: int = 0
+    # Files that had to be read and parsed for block tags
+    files_parsed: int = 0
+    # Files whose blocks were taken from the manifest without parsing
+    files_reused: int = 0
+    # Changed files found to contain no blocks without having to parse them
+    files_untagged: int = 0
+    # Binary files, files over the size limit, and files that aren't UTF-8
+    files_skipped: int = 0
+    elapsed_ms: float = 0.0
+
+    def summary(self) -> str:
+        """Returns a one line summary of the scan."""
+        return (
+            f"Scanned {self.files_total} files ({self.files_parsed} parsed, {self.files_reused} reused, "
+            f"{self.files_untagged} untagged, {self.files_skipped} skipped) in {self.elapsed_ms:.1f} ms"
+        )
+
+
+class BlockOverlay(MutableMapping[str, TextBlock]):
+    """A private, copy-on-write view of a shared (read-only) set of blocks. Reads fall through to the shared
+    blocks, while blocks set or deleted through the overlay only change the overlay, so each agent run can edit
+    blocks without copying the whole index, and without other runs seeing its edits.
+    """
+
+    def __init__(self, base: Mapping[str, TextBlock]):
+        self.base: Mapping[str, TextBlock] = base
+        self.changes: Dict[str, TextBlock] = {}
+        self.deleted: Set[str] = set()
+
+    def __getitem__(self, name: str) -> TextBlock:
+        block = self.changes.get(name)
+        if block is not None:
+            return block
+        if name in self.deleted:
+            raise KeyError(name)
+        return self.base[name]
+
+    def __setitem__(self, name: str, block: TextBlock):
+        self.changes[name] = block
+        self.deleted.discard(name)
+
+    def __delitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.changes.pop(name, None)
+        if name in self.base:
+            self.deleted.add(name)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.changes or (name in self.base and name not in self.deleted)
+
+    def __iter__(self) -> Iterator[str]:
+        for name in self.base:
+            if name not in self.deleted:
+                yield name
+        for name in self.changes:
+            if name not in self.base:
+                yield name
+
+    def __len__(self) -> int:
+        return (
+            len(self.base)
+            - len(self.deleted)
+            + sum(1 for name in self.changes if name not in self.base)
+        )
+
+    def dirty_blocks(self) -> List[TextBlock]:
+        """Returns the blocks edited through this overlay, without looking at the shared blocks."""
+        return [block for block in self.changes.values() if block.dirty]
+
+    def copy(self) -> "BlockOverlay":
+        """Returns an overlay on the same shared blocks with a copy of this one's edits, which later edits to
+        this one don't change. It costs as much as the edits, not as much as all the blocks."""
+        overlay = BlockOverlay(self.base)
+        overlay.changes = dict(self.changes)
+        overlay.deleted = set(self.deleted)
+        return overlay
+
+
+class ProjectSnapshot(NamedTuple):
+    """The blocks, files and folders of the project at one point in time. The structure is immutable (`blocks`
+    is a read-only mapping, and blocks are never edited in place), so any number of agent runs can share one.
+
+    The content isn't frozen though, since blocks read theirs from the files when asked. Each block has the
+    version of its file it was found in (see FileTable), so once a file changes, its blocks in older snapshots
+    raise ProjectChangedError rather than returning what's at their offsets now. A newer snapshot has them.
+    """
+
+    # Goes up by one every time the project changes
+    version: int
+    blocks: Mapping[str, TextBlock]
+    file_names: Tuple[str, ...]
+    folder_names: Tuple[str, ...]
+    # When the snapshot was taken (time.time())
+    created: float
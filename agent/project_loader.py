@@ -1,98 +1,514 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Any, Iterable, Mapping, MutableMapping
 
 import os
-from agent.models import TextBlock
+import json
+import time
+from types import MappingProxyType
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from agent.models import TextBlock, FileTable, ScanStats, ProjectSnapshot, BlockOverlay
 from agent.app_config import AppConfig
 from agent.utils import Utils
-from agent.tags import TAG_BLOCK_BEGIN, TAG_BLOCK_END, TAG_BLOCK_OFF, TAG_BLOCK_ON
+from agent.file_scanner import FileScanner, FileScanResult, ScanTask
+from agent.content_cache import ContentCache
+from agent.project_walker import ProjectWalker
+from agent.prompt_tags import PromptRefs
+from agent.search_index import SearchIndex
+from agent.symbol_index import SymbolIndex, Symbol
+
+# Bump this whenever the layout of the manifest entries changes, so stale manifests get discarded
+MANIFEST_VERSION = 3
+
+# Number of files handed to a worker process at a time. Threads ignore this.
+PROCESS_CHUNK_SIZE = 64
+
+# A snapshot copies all the blocks once the blocks changed since the last full copy are more than this
+# fraction of them. Until then it only copies the changes.
+SNAPSHOT_COPY_FRACTION = 0.25
 
 
 class ProjectLoader:
-    # Dictionary to store TextBlock objects keyed by 'name'
-    blocks: Dict[str, TextBlock] = {}
-    # All filen names encountered during the scan, relative to the source folder
-    file_names: List[str] = []
-    folder_names: List[str] = []
+    def __init__(
+        self,
+        st,
+        source_folder_len: int,
+        manifest_file: Optional[str] = None,
+        scan_workers: int = 0,
+        scan_pool: str = "thread",
+        max_file_size: int = 2000000,
+        collect_errors: bool = False,
+        search_index_file: Optional[str] = None,
+        symbol_index_file: Optional[str] = None,
+    ):
+        """If `manifest_file` is given, the per-file scan results are persisted there, so that the next scan
+        only has to re-parse the files that changed since the last one. An index of which file each block is
+        in is persisted next to it, for `load_referenced`.
+
+        If `scan_workers` is more than 1 the files are scanned in parallel, on a pool of threads or processes
+        depending on `scan_pool` ("thread" or "process").
+
+        Files larger than `max_file_size` bytes are skipped, as are binary files.
 
-    def __init__(self, st, source_folder_len: int):
+        If `collect_errors` is True errors are collected into `errors` instead of failing the app, which is what
+        background users of the loader need.
+
+        If `search_index_file` is given, a search index of the files and blocks is kept there, and updated along
+        with every scan. Likewise for `symbol_index_file` and the index of classes, functions, and methods.
+        """
         self.source_folder_len = source_folder_len
         self.st = st
+        self.manifest_file: Optional[str] = manifest_file
+        # Maps each block name to the file it's in, so a prompt's blocks can be found without a scan
+        self.block_index_file: Optional[str] = (
+            os.path.splitext(manifest_file)[0] + "_blocks.json" if manifest_file else None
+        )
+        self.scan_workers: int = scan_workers
+        self.scan_pool: str = scan_pool
+        self.max_file_size: int = max_file_size
+        self.collect_errors: bool = collect_errors
+        # Per-file entries from the previous scan, keyed by relative file name
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        self.search_index: Optional[SearchIndex] = (
+            SearchIndex(search_index_file) if search_index_file else None
+        )
+        self.symbol_index: Optional[SymbolIndex] = (
+            SymbolIndex(symbol_index_file) if symbol_index_file else None
+        )
+        # Files changed since the search and symbol indexes were last updated, with their new manifest entries
+        # (None if removed)
+        self.index_pending: Dict[str, Optional[Dict[str, Any]]] = {}
+        self.reset()
+
+    def reset(self, scan_dir: str = ""):
+        self.scan_dir: str = scan_dir
+        # The files that contain blocks. Blocks read their content through this.
+        self.files = FileTable(scan_dir)
+        self.errors: List[str] = []
+        # TextBlock objects keyed by 'name'. This is our own dictionary, or an overlay on a shared snapshot.
+        self.blocks: MutableMapping[str, TextBlock] = {}
+        # All file names encountered during the scan, relative to the source folder
+        self.file_names: List[str] = []
+        self.folder_names: List[str] = []
+        # Per-file entries built up by the current scan
+        self.new_manifest: Dict[str, Dict[str, Any]] = {}
+        self.manifest_dirty: bool = False
+        self.stats = ScanStats()
+
+    def load_manifest(self, scan_dir: str):
+        """Loads the manifest written by the previous scan of `scan_dir`, if there is one."""
+        self.manifest = {}
+        if self.manifest_file is None or not os.path.isfile(self.manifest_file):
+            return
+        try:
+            with Utils.open_file(self.manifest_file) as file:
+                data = json.load(file)
+        except (IOError, ValueError) as e:
+            print(f"Ignoring unreadable manifest {self.manifest_file}: {e}")
+            return
+
+        # A manifest from another source folder (or an older layout) is of no use to us
+        if data.get("version") == MANIFEST_VERSION and data.get("source_folder") == scan_dir:
+            self.manifest = data.get("files", {})
+
+    def save_manifest(self, scan_dir: str):
+        """Writes the manifest and the block index for the current scan, if anything changed since the last
+        one.
+        """
+        if self.manifest_file is None or self.block_index_file is None:
+            return
+        # Files that were deleted since the last scan also count as a change
+        if (
+            not self.manifest_dirty
+            and len(self.new_manifest) == len(self.manifest)
+            and os.path.isfile(self.block_index_file)
+        ):
+            return
+
+        data = {
+            "version": MANIFEST_VERSION,
+            "source_folder": scan_dir,
+            "files": self.new_manifest,
+        }
+        Utils.ensure_folder_exists(self.manifest_file)
+        Utils.write_file(self.manifest_file, json.dumps(data))
+
+        index = {
+            "version": MANIFEST_VERSION,
+            "source_folder": scan_dir,
+            "blocks": {name: block.rel_filename for name, block in self.blocks.items()},
+        }
+        Utils.write_file(self.block_index_file, json.dumps(index))
+
+    def load_block_index(self, scan_dir: str) -> Optional[Dict[str, str]]:
+        """Loads the block index written by the last full scan of `scan_dir`, or returns None if there isn't a
+        usable one.
+        """
+        if self.block_index_file is None or not os.path.isfile(self.block_index_file):
+            return None
+        try:
+            with Utils.open_file(self.block_index_file) as file:
+                data = json.load(file)
+        except (IOError, ValueError) as e:
+            print(f"Ignoring unreadable block index {self.block_index_file}: {e}")
+            return None
+
+        if data.get("version") != MANIFEST_VERSION or data.get("source_folder") != scan_dir:
+            return None
+        return data.get("blocks")
 
-    def reset(self):
-        self.blocks = {}
-        self.file_names = []
-        self.folder_names = []
+    def fail(self, msg: str):
+        """Reports an error in the project, either by failing the app or by collecting it."""
+        if self.collect_errors:
+            print(f"Error: {msg}")
+            self.errors.append(msg)
+        else:
+            Utils.fail_app(msg, self.st)
+
+    def add_block(self, block: TextBlock):
+        """Adds a block to `blocks`, enforcing that block names are unique across all files."""
+        if block.name in self.blocks:
+            self.fail(
+                f"Duplicate Block Name {block.name}. Block Names must be unique across all files."
+            )
+        else:
+            self.blocks[block.name] = block
+
+    def add_result(self, result: FileScanResult):
+        """Merges the scan result for one file into the project. Results must be added in walk order, so
+        that which of two duplicate blocks gets reported doesn't depend on which worker finished first.
+        """
+        self.new_manifest[result.rel_filename] = result.entry
+        if result.changed:
+            self.manifest_dirty = True
+
+        if result.skipped is not None:
+            self.stats.files_skipped += 1
+            # Only mention it the first time, not on every scan
+            if result.changed:
+                print(f"Skipped {result.rel_filename}: {result.skipped}")
+            return
+
+        self.file_names.append(result.rel_filename)
+        self.stats.files_total += 1
+        if result.parsed:
+            self.stats.files_parsed += 1
+        elif result.untagged:
+            self.stats.files_untagged += 1
+        else:
+            self.stats.files_reused += 1
+
+        for error in result.errors:
+            self.fail(error)
+        if result.blocks:
+            file_id: int = self.files.add(
+                result.rel_filename, (result.entry["size"], result.entry["mtime_ns"])
+            )
+            for name, start, end, excluded, updateable in result.blocks:
+                self.add_block(
+                    TextBlock(self.files, file_id, name, start, end, excluded, updateable)
+                )
 
     def visit_file(self, path: str):
         """Visits a file and extracts text blocks into `blocks`. So we're just
         scanning the files for the block_begin and block_end tags, and extracting the content between them
-        and saving that text for later use
-        """
+        and saving that text for later use.
 
+        If the manifest says the file hasn't changed since the last scan we take its blocks from there instead.
+        """
         # get the file name relative to the source folder
         relative_file_name: str = path[self.source_folder_len :]
-        self.file_names.append(relative_file_name)
+        self.add_result(
+            FileScanner.scan_file(
+                path,
+                relative_file_name,
+                self.manifest.get(relative_file_name),
+                self.max_file_size,
+                ContentCache.get_instance(),
+            )
+        )
 
-        # Open the file using 'with' which ensures the file is closed after reading
-        with Utils.open_file(path) as file:
-            block: Optional[TextBlock] = None
-            block_on: bool = True
+    def collect_files(self, scan_dir: str) -> List[ScanTask]:
+        """Walks the directory collecting the folder names, and returns a scan task for each file we need to
+        visit. The walker sorts both, so the scan order is the same on every machine.
+        """
+        tasks: List[ScanTask] = []
+        cache: Optional[ContentCache] = self.scan_cache()
 
-            for line in file:  # NOTE: There's no way do to typesafety in loop vars
-                # Print each line; using end='' to avoid adding extra newline
-                trimmed: str = line.strip()
+        walker = ProjectWalker(
+            scan_dir, AppConfig.ext_set, AppConfig.include_globs, AppConfig.exclude_globs
+        )
 
-                if Utils.is_tag_line(trimmed, TAG_BLOCK_BEGIN):
-                    name: Optional[str] = Utils.parse_name_from_tag_line(
-                        trimmed, TAG_BLOCK_BEGIN
+        # Walk through all directories and files in the directory
+        for dirpath, filenames in walker.walk():
+            # Get the relative path of the directory, root folder is the source folder and will be "" (empty string) here
+            # as the relative path of the source folder is the root folder
+            short_dir: str = dirpath[self.source_folder_len :]
+            self.folder_names.append(short_dir)
+
+            for filename in filenames:
+                # build the full path
+                path: str = os.path.join(dirpath, filename)
+                relative_file_name: str = path[self.source_folder_len :]
+                tasks.append(
+                    (
+                        path,
+                        relative_file_name,
+                        self.manifest.get(relative_file_name),
+                        self.max_file_size,
+                        cache,
                     )
+                )
+        return tasks
+
+    def scan_cache(self) -> Optional[ContentCache]:
+        """The content cache the scan fills, which worker processes can't share."""
+        if self.scan_workers > 1 and self.scan_pool == "process":
+            return None
+        return ContentCache.get_instance()
 
-                    if name in self.blocks:
-                        Utils.fail_app(
-                            f"Duplicate Block Name {name}. Block Names must be unique across all files.",
-                            self.st,
-                        )
-                    else:
-                        # n is a non-optional string
-                        n = name if name is not None else ""
-                        block = TextBlock(relative_file_name, n, "", False)
-                        self.blocks[n] = block
-                elif Utils.is_tag_line(trimmed, TAG_BLOCK_END):
-                    if block is None:
-                        Utils.fail_app(
-                            f"""Encountered {TAG_BLOCK_END} without a corresponding {TAG_BLOCK_BEGIN}""",
-                            self.st,
-                        )
-                    block = None
-                elif Utils.is_tag_line(trimmed, TAG_BLOCK_OFF):
-                    if block is not None:
-                        block.updateable = False
-                        block_on = False
-                elif Utils.is_tag_line(trimmed, TAG_BLOCK_ON):
-                    if block is not None:
-                        block_on = True
-                else:
-                    if block is not None and block_on:
-                        block.content += line
+    def create_executor(self) -> Optional[Executor]:
+        """Creates the worker pool for a parallel scan, or returns None for a serial scan."""
+        if self.scan_workers <= 1:
+            return None
+        if self.scan_pool == "process":
+            return ProcessPoolExecutor(max_workers=self.scan_workers)
+        return ThreadPoolExecutor(max_workers=self.scan_workers)
 
     def scan_directory(self, scan_dir: str):
         """Scans the directory for files with the specified extensions. The purpose of this scan
         is to build up the 'blocks' dictionary with the content of the blocks in the files, and also
         to collect all the filenames into `file_names`
         """
-        self.reset()
-        # Walk through all directories and files in the directory
-        for dirpath, _, filenames in os.walk(scan_dir):
-            # Get the relative path of the directory, root folder is the source folder and will be "" (empty string) here
-            # as the relative path of the source folder is the root folder
-            short_dir: str = dirpath[self.source_folder_len :]
+        start = time.perf_counter()
+        self.reset(scan_dir)
+        self.load_manifest(scan_dir)
+        tasks = self.collect_files(scan_dir)
 
-            # If not, add it to the set and list
-            self.folder_names.append(short_dir)
+        executor = self.create_executor()
+        if executor is None:
+            results: Iterable[FileScanResult] = map(FileScanner.scan_file_task, tasks)
+            for result in results:
+                self.add_result(result)
+        else:
+            with executor:
+                # Executor.map yields results in task order, regardless of which worker finishes first
+                results = executor.map(
+                    FileScanner.scan_file_task, tasks, chunksize=PROCESS_CHUNK_SIZE
+                )
+                for result in results:
+                    self.add_result(result)
+
+        self.save_manifest(scan_dir)
+        if self.search_index is not None:
+            self.search_index.update(scan_dir, self.new_manifest)
+        if self.symbol_index is not None:
+            self.symbol_index.update(scan_dir, self.new_manifest)
+        self.index_pending = {}
+        # From here on the manifest describes the project as it is now, which incremental updates rely on
+        self.manifest = self.new_manifest
+        self.stats.elapsed_ms = (time.perf_counter() - start) * 1000
+        print(self.stats.summary())
+
+    def load_referenced(self, scan_dir: str, refs: PromptRefs) -> bool:
+        """Loads only what a prompt refers to, instead of scanning the whole directory. Blocks are found
+        through the block index, and only the files they're in (plus the referenced files, and the files in the
+        referenced folders) are read.
+
+        Returns False if the block index is missing or stale, in which case nothing useful was loaded and the
+        caller needs to do a full scan instead.
+        """
+        start = time.perf_counter()
+        self.reset(scan_dir)
+
+        # Block names grouped by the file the index says they're in
+        block_files: Dict[str, List[str]] = {}
+        if refs.blocks:
+            index: Optional[Dict[str, str]] = self.load_block_index(scan_dir)
+            if index is None:
+                print("No block index, so doing a full scan")
+                return False
+            for name in refs.blocks:
+                relative_file_name: Optional[str] = index.get(name)
+                # Symbols that were inserted into earlier prompts look just like blocks
+                if relative_file_name is None and self.is_current_symbol(scan_dir, name):
+                    continue
+                # Possibly a block added since the last full scan
+                if relative_file_name is None:
+                    print(f"Block {name} not in the block index, so doing a full scan")
+                    return False
+                block_files.setdefault(relative_file_name, []).append(name)
+
+        for name in refs.symbols:
+            if not self.is_current_symbol(scan_dir, name):
+                print(f"Symbol {name} not in the symbol index, or changed since, so doing a full scan")
+                return False
+
+        walker = ProjectWalker(
+            scan_dir, AppConfig.ext_set, AppConfig.include_globs, AppConfig.exclude_globs
+        )
+        for relative_file_name in sorted(block_files):
+            path: str = scan_dir + relative_file_name
+            # The file was deleted or renamed since the last full scan
+            if not os.path.isfile(path) or not walker.is_path_included(path, False):
+                print(f"Block index is stale for {relative_file_name}, so doing a full scan")
+                return False
+            self.load_file(path)
+
+        # A block that has moved to another file since the last full scan
+        for name in refs.blocks:
+            if name not in self.blocks and self.add_symbol(scan_dir, name) is None:
+                print(f"Block index is stale for block {name}, so doing a full scan")
+                return False
+
+        for relative_file_name in sorted(refs.files):
+            path = scan_dir + relative_file_name
+            # Otherwise the file isn't part of the project, and the tag is left as it is, same as with a scan
+            if os.path.isfile(path) and walker.is_path_included(path, False):
+                self.load_file(path)
+
+        for folder_name in sorted(refs.folders):
+            path = scan_dir + folder_name
+            if os.path.isdir(path) and (
+                folder_name == "" or walker.is_path_included(path, True)
+            ):
+                for dirpath, filenames in walker.walk(path):
+                    self.folder_names.append(dirpath[self.source_folder_len :])
+                    for filename in filenames:
+                        self.load_file(os.path.join(dirpath, filename))
+
+        self.stats.elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"Loaded only the referenced files. {self.stats.summary()}")
+        return True
 
+    def is_current_symbol(self, scan_dir: str, name: str) -> bool:
+        """True if the symbol index has the symbol, and its file hasn't changed since it was indexed."""
+        if self.symbol_index is None:
+            return False
+        self.symbol_index.load(scan_dir)
+        symbol: Optional[Symbol] = self.symbol_index.lookup(name)
+        return symbol is not None and self.symbol_index.is_current(symbol)
+
+    def load_file(self, path: str):
+        """Scans a file for `load_referenced`, unless it's already been loaded."""
+        relative_file_name: str = path[self.source_folder_len :]
+        if relative_file_name not in self.new_manifest:
+            self.add_result(
+                FileScanner.scan_file(
+                    path,
+                    relative_file_name,
+                    None,
+                    self.max_file_size,
+                    ContentCache.get_instance(),
+                )
+            )
+
+    def update_file(self, path: str):
+        """Rescans a single file that was created or modified, replacing whatever we had for it. This is how
+        the index is kept current from filesystem events without a full scan.
+        """
+        relative_file_name: str = path[self.source_folder_len :]
+        entry: Optional[Dict[str, Any]] = self.manifest.get(relative_file_name)
+        self.remove_file(relative_file_name)
+        self.add_result(
+            FileScanner.scan_file(
+                path, relative_file_name, entry, self.max_file_size, ContentCache.get_instance()
+            )
+        )
+        self.index_pending[relative_file_name] = self.new_manifest.get(relative_file_name)
+
+    def remove_file(self, relative_file_name: str):
+        """Removes a file, and the blocks in it, from the project."""
+        entry: Optional[Dict[str, Any]] = self.manifest.pop(relative_file_name, None)
+        if entry is None:
+            return
+        self.index_pending[relative_file_name] = None
+        for span in entry["blocks"]:
+            block: Optional[TextBlock] = self.blocks.get(span[0])
+            # Only if it's ours. A duplicate name in another file may have been kept instead.
+            if block is not None and block.rel_filename == relative_file_name:
+                del self.blocks[span[0]]
+        if relative_file_name in self.file_names:
+            self.file_names.remove(relative_file_name)
+
+    def add_folder(self, path: str, walker: ProjectWalker):
+        """Adds a folder that was created or moved into the project, and everything in it."""
+        for dirpath, filenames in walker.walk(path):
+            short_dir: str = dirpath[self.source_folder_len :]
+            if short_dir not in self.folder_names:
+                self.folder_names.append(short_dir)
             for filename in filenames:
-                if Utils.should_include_file(AppConfig.ext_set, filename):
-                    # build the full path
-                    path: str = os.path.join(dirpath, filename)
-                    # Call the visitor function for each file
-                    self.visit_file(path)
+                self.update_file(os.path.join(dirpath, filename))
+
+    def remove_folder(self, short_dir: str):
+        """Removes a folder that was deleted or moved out of the project, and everything that was in it."""
+        prefix: str = short_dir + "/"
+        for relative_file_name in [f for f in self.manifest if f.startswith(prefix)]:
+            self.remove_file(relative_file_name)
+        self.folder_names = [
+            f for f in self.folder_names if f != short_dir and not f.startswith(prefix)
+        ]
+
+    def update_indexes(self):
+        """Applies the files that changed since the last scan to the search and symbol indexes."""
+        if not self.index_pending:
+            return
+        if self.search_index is not None:
+            self.search_index.update_files(self.scan_dir, self.index_pending)
+        if self.symbol_index is not None:
+            self.symbol_index.update_files(self.scan_dir, self.index_pending)
+        self.index_pending = {}
+
+    def add_symbol(self, scan_dir: str, name: str) -> Optional[TextBlock]:
+        """Adds the symbol with the fully qualified name to `blocks`, so it can be put in a prompt and updated
+        just like a named block. Returns None if there's no such symbol, or its file changed since it was
+        indexed (so its offsets can't be trusted).
+        """
+        block: Optional[TextBlock] = self.blocks.get(name)
+        if block is not None or self.symbol_index is None:
+            return block
+        self.symbol_index.load(scan_dir)
+        symbol: Optional[Symbol] = self.symbol_index.lookup(name)
+        if symbol is None or not self.symbol_index.is_current(symbol):
+            return None
+        # Loaded from a snapshot we don't have a file table of our own yet
+        if self.files.source_folder != scan_dir:
+            self.files = FileTable(scan_dir)
+        # The version of the file the symbol index parsed, which `is_current` just checked
+        entry: Dict[str, Any] = self.symbol_index.files[symbol.rel_filename]
+        file_id: int = self.files.add(symbol.rel_filename, (entry["size"], entry["mtime_ns"]))
+        block = TextBlock(self.files, file_id, name, symbol.start, symbol.end, tagged=False)
+        self.blocks[name] = block
+        return block
+
+    def snapshot(self, version: int) -> ProjectSnapshot:
+        """Returns an immutable snapshot of the project as it is now. Later changes to this loader don't
+        affect it, and blocks of files that change later can't be read from it (see ProjectSnapshot).
+
+        The blocks are copy on write. The first snapshot takes our dictionary as is, and from then on our
+        blocks are an overlay on it, so the next snapshot only has to copy what changed since. Once that's
+        more than SNAPSHOT_COPY_FRACTION of the blocks we copy them all into a new dictionary to start over.
+        """
+        blocks: Mapping[str, TextBlock] = self.blocks
+        if isinstance(self.blocks, BlockOverlay):
+            changed: int = len(self.blocks.changes) + len(self.blocks.deleted)
+            if changed <= len(self.blocks.base) * SNAPSHOT_COPY_FRACTION:
+                blocks = self.blocks.copy()
+            else:
+                blocks = dict(self.blocks)
+        # Nothing changes the blocks under an overlay, so the snapshot can share them
+        if not isinstance(blocks, BlockOverlay):
+            self.blocks = BlockOverlay(blocks)
+        return ProjectSnapshot(
+            version,
+            MappingProxyType(blocks),
+            tuple(self.file_names),
+            tuple(self.folder_names),
+            time.time(),
+        )
+
+    def use_snapshot(self, snapshot: ProjectSnapshot):
+        """Loads the project from a shared snapshot instead of scanning it. Rather than copying the blocks we
+        put a private overlay on top of them, which is where this run's edits go.
+        """
+        self.blocks = BlockOverlay(snapshot.blocks)
+        self.file_names = list(snapshot.file_names)
+        self.folder_names = list(snapshot.folder_names)
@@ -1,25 +1,21 @@
 """Injects data into files."""
 
-import os
-import re
-from typing import List, Dict, Optional
-from agent.models import TextBlock
+from typing import List, Dict, Mapping, Optional, Tuple
+from agent.models import TextBlock, BlockOverlay
+from agent.answer_parser import AnswerParser, AnswerSection
+from agent.block_splicer import BlockSplicer
+from agent.content_cache import ContentCache
+from agent.edit_transaction import EditTransaction
 from agent.string_utils import StringUtils
-from agent.tags import (
-    TAG_BLOCK_BEGIN,
-    TAG_BLOCK_END,
-    TAG_FILE_BEGIN,
-    TAG_FILE_END,
-)
+from agent.tags import TAG_FILE_BEGIN
 from agent.utils import RefactorMode, Utils
 from agent.app_config import AppConfig
+from agent.project_walker import ProjectWalker
 
 
 class ProjectMutator:
     """Performs all project mutations that the AI has requested."""
 
-    blocks: Dict[str, TextBlock] = {}
-
     def __init__(
         self,
         st,
@@ -28,9 +24,12 @@ class ProjectMutator:
         ai_answer: str,
         ts: str,
         suffix: Optional[str],
-        blocks: Dict[str, TextBlock],
+        blocks: Mapping[str, TextBlock],
+        transaction: EditTransaction,
     ):
-        """Initializes the ProjectMutator object."""
+        """Initializes the ProjectMutator object. Edits are staged in `transaction`, and nothing is written to
+        disk until the caller commits it. To apply the answer while it streams in, pass an empty `ai_answer`, and
+        feed the answer to `parser` instead."""
         self.st = st
         self.mode: str = mode
         self.source_folder: str = source_folder
@@ -39,7 +38,18 @@ class ProjectMutator:
         self.suffix: Optional[str] = suffix
         self.ts: str = ts
         self.ran = False
-        self.blocks = blocks
+        self.blocks: Mapping[str, TextBlock] = blocks
+        self.transaction: EditTransaction = transaction
+        # The files the AI answer gives in full, keyed by relative file name
+        self.new_files: Dict[str, str] = {}
+        # Feed the answer to this while it streams in, to stage its files as soon as each one has arrived
+        self.parser = AnswerParser(self.add_section)
+        self.walker = ProjectWalker(
+            self.source_folder,
+            AppConfig.ext_set,
+            AppConfig.include_globs,
+            AppConfig.exclude_globs,
+        )
 
     def run(self):
         """Performs all the project mutations which may be new files, updated files, or updated blocks in files."""
@@ -50,126 +60,123 @@ class ProjectMutator:
         self.process_project()
 
 
-    def visit_file(self, filename: str):
-        """Visit the file, to run all code modifications on the file"""
+    def visit_file(
+        self, filename: str, new_content: Optional[str], blocks: List[TextBlock]
+    ):
+        """Visit the file, to run all code modifications on the file. `new_content` is the content the AI
+        answer gave for the whole file, if any, otherwise `blocks` are the dirty blocks in the file.
+        """
 
-        # we need content to be mutable in the methods we pass it to so we hold in a dict
-        content: List[str] = [""]
+        out_file: str = (
+            StringUtils.add_filename_suffix(filename, self.suffix)
+            if self.suffix
+            else filename
+        )
         try:
-            # Read the entire file content
-            content[0] = Utils.read_file(filename)
-            modified: bool = False
-
-            # Check if we have a diff for this file
-            rel_filename: str = filename[self.source_folder_len :]
-            new_content: Optional[str] = None
-
-            if self.mode == RefactorMode.REFACTOR.value:
-                new_content = self.parse_modified_file(self.ai_answer, rel_filename)
+            # The file as the tools may already have changed it. We only ever update existing files here,
+            # new files get created by the tools.
+            data: Optional[bytes] = self.transaction.read(filename)
+            if data is None:
+                raise FileNotFoundError(filename)
 
             if new_content is not None:
-                content[0] = new_content
-                modified = True
-            # else if no new content, so we try any block updates
-            else:
-                if self.mode == RefactorMode.REFACTOR.value:
-                    for name, block in self.blocks.items():
-                        if block.dirty:
-                            if self.replace_block(content, block, name):
-                                modified = True
-
-            if modified:
+                self.transaction.stage_text(out_file, new_content)
                 print(f"Updated File: {filename}")
-
-            # Write the modified content back to the file
-            if modified:
-                out_file: str = (
-                    StringUtils.add_filename_suffix(filename, self.suffix)
-                    if self.suffix
-                    else filename
+            # else if no new content, so we try any block updates, all in one pass over the file
+            elif blocks:
+                new_data: bytes = self.splice_symbols(
+                    filename, data, [block for block in blocks if not block.tagged]
                 )
-                Utils.write_file(out_file, content[0])
+                new_data, replaced = BlockSplicer.splice(
+                    new_data, {block.name: block.content for block in blocks if block.tagged}
+                )
+                if new_data != data:
+                    self.transaction.stage(out_file, new_data)
+                    print(f"Updated File: {filename}")
 
         except FileNotFoundError:
             print(f"The file {filename} does not exist.")
         except IOError:
             print("An error occurred while reading or writing to the file.")
 
-    def parse_modified_file(self, ai_answer: str, rel_filename: str) -> Optional[str]:
-        """Extract the new content for the given file from the AI answer."""
-
-        if f"""{TAG_FILE_BEGIN} {rel_filename}""" not in ai_answer:
-            return None
-
-        # Scan all the lines in content one by one and extract the new content
-        new_content: List[str] = []
-        started: bool = False
-
-        for line in ai_answer.splitlines():
-            if started:
-                if Utils.is_tag_and_name_line(line, TAG_FILE_END, rel_filename):
-                    started = False
-                    break
-                new_content.append(line)
-            elif Utils.is_tag_and_name_line(line, TAG_FILE_BEGIN, rel_filename):
-                if len(new_content) > 0:
-                    Utils.fail_app(
-                        f"Error: {TAG_FILE_BEGIN} {rel_filename} exists multiple times in ai response. The LLM itself is failing.",
-                        self.st,
-                    )
-                started = True
-
+    def splice_symbols(self, filename: str, data: bytes, symbols: List[TextBlock]) -> bytes:
+        """Replaces the source of the updated symbols, which we find by their offsets. The offsets are only
+        good for the file as it was scanned, so if the file changed on disk since the scan, or anything else in
+        this run changed it first, the symbols are left alone. Of a symbol and one nested in it, like a class and one of its methods, only
+        the outer one is replaced.
+        """
+        if not symbols:
+            return data
+        if data != ContentCache.get_instance().read_bytes(filename):
+            print(f"Warning: {filename} was already changed, so symbols in it were not updated")
+            return data
+        # Or it changed on disk since the scan
+        if any(block.files.stat_current(block) is None for block in symbols):
+            print(
+                f"Warning: {filename} changed since the project was scanned, so symbols in it were not updated. "
+                + "Rescan the project."
+            )
+            return data
+
+        spans: List[Tuple[int, int, str]] = []
+        for block in sorted(symbols, key=lambda b: (b.start, -b.end)):
+            if spans and block.start < spans[-1][1]:
+                print(f"Warning: {block.name} is inside another updated symbol, so it was not updated")
+                continue
+            spans.append((block.start, block.end, block.content))
+        return BlockSplicer.splice_spans(data, spans)
+
+    def add_section(self, section: AnswerSection):
+        """Called by `parser` with each file or block as soon as the AI answer has given all of it. Files are
+        staged right away, while the rest of the answer is still arriving. Blocks are updated with the tool
+        instead, so the ones in the answer are only shown."""
+        if section.tag != TAG_FILE_BEGIN or self.mode != RefactorMode.REFACTOR.value:
+            return
+        if not self.add_modified_file(self.new_files, section.name, section.lines):
+            return
+
+        path: str = self.source_folder + section.name
+        # Same as before, we only ever modify files that are part of the project
+        if not self.walker.is_path_included(path, False):
+            print(f"Ignoring {section.name} in the AI answer, as it's not part of the project.")
+            return
+        self.visit_file(path, self.new_files[section.name], [])
+
+    def add_modified_file(self, files: Dict[str, str], rel_filename: str, new_content: List[str]) -> bool:
+        """Adds the content of one file parsed from the AI answer to `files`. Returns False if it's empty."""
         if len(new_content) == 0:
-            return None
-
-        ret: str = "\n".join(new_content)
-        return ret
-
-    def replace_block(self, content: List[str], block: TextBlock, name: str) -> bool:
-        """Process the replacement for the given block. This is what does the actual
-        replacement of a named block of code in the file
+            return False
+        if rel_filename in files:
+            Utils.fail_app(
+                f"Error: {TAG_FILE_BEGIN} {rel_filename} exists multiple times in ai response. The LLM itself is failing.",
+                self.st,
+            )
+        files[rel_filename] = "\n".join(new_content)
+        return True
+
+    def dirty_blocks(self) -> List[TextBlock]:
+        """Returns the blocks the AI has updated."""
+        if isinstance(self.blocks, BlockOverlay):
+            # Only the overlay can hold edits, so there's no need to look at the shared blocks under it
+            return self.blocks.dirty_blocks()
+        return [block for block in self.blocks.values() if block.dirty]
 
-        We replace the first element of the dict content with the new content, so we're treating 'content'
-        as a mutable object.
+    def process_project(self):
+        """Applies the AI's edits. Rather than visiting every file in the project we only visit the files the
+        AI answer gives new content for, and the files containing blocks that were updated. When the answer
+        was streamed through `parser` its files have been staged already.
         """
+        if self.mode != RefactorMode.REFACTOR.value:
+            return
 
-        if f"{TAG_BLOCK_BEGIN} {name}" not in content[0]:
-            return False
+        self.parser.feed(self.ai_answer)
+        self.parser.close()
 
-        found: bool = False
-        lines = content[0].splitlines()
-        new_lines = []
-        in_block = False
-        comment_pattern = r"(//|--|#)"
-
-        for line in lines:
-            trimmed = line.strip()
-            if in_block:
-                if re.match(rf"{comment_pattern} {TAG_BLOCK_END}$", trimmed):
-                    in_block = False
-                    new_lines.append(block.content)
-                    new_lines.append(line)
-                    found = True
-            elif re.match(rf"{comment_pattern} {TAG_BLOCK_BEGIN} {name}$", trimmed):
-                in_block = True
-                new_lines.append(line)
-            else:
-                new_lines.append(line)
-
-        if found:
-            content[0] = "\n".join(new_lines)
-
-        return found
+        # Dirty blocks grouped by the file they're in. A file the answer gave in full replaces its blocks.
+        block_files: Dict[str, List[TextBlock]] = {}
+        for block in self.dirty_blocks():
+            if block.rel_filename not in self.new_files:
+                block_files.setdefault(block.rel_filename, []).append(block)
 
-    def process_project(self):
-        """Scans the directory for files with the specified extensions."""
-
-        # Walk through all directories and files in the directory
-        for dirpath, _, filenames in os.walk(self.source_folder):
-            for filename in filenames:
-                # Check the file extension
-                if Utils.should_include_file(AppConfig.ext_set, filename):
-                    # build the full path
-                    path: str = os.path.join(dirpath, filename)
-                    # Call the visitor function for each file
-                    self.visit_file(path)
+        for rel_filename in sorted(block_files):
+            self.visit_file(self.source_folder + rel_filename, None, block_files[rel_filename])
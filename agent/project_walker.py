@@ -0,0 +1,262 @@
+"""Walks the project tree, pruning folders and files excluded by .gitignore files and the configured globs."""
+
+import os
+import re
+from typing import Dict, Iterator, List, NamedTuple, Optional, Pattern, Set, Tuple
+
+GITIGNORE_FILE = ".gitignore"
+
+# Never worth walking into, whatever the ignore files say
+ALWAYS_PRUNED: Set[str] = {".git"}
+
+
+class IgnoreRule(NamedTuple):
+    """One line of a .gitignore file (or one configured glob), compiled to a regex."""
+
+    regex: Pattern[str]
+    negated: bool
+    # Rules ending in a slash only match folders
+    dir_only: bool
+
+
+class IgnoreRules:
+    """The rules from one .gitignore file (or the configured globs), which apply to the paths under `base`.
+    `base` is relative to the project root, using forward slashes, and is "" for the root itself.
+    """
+
+    def __init__(self, base: str, rules: List[IgnoreRule]):
+        self.base: str = base
+        self.prefix: str = base + "/" if base else ""
+        self.rules: List[IgnoreRule] = rules
+
+    @staticmethod
+    def translate(pattern: str) -> str:
+        """Translates a gitignore style glob into a regex. `*` and `?` don't match slashes, `**` does."""
+        res: List[str] = []
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            if c == "*":
+                if pattern.startswith("**/", i):
+                    # Zero or more folders
+                    res.append("(?:.*/)?")
+                    i += 3
+                    continue
+                if pattern.startswith("**", i):
+                    res.append(".*")
+                    i += 2
+                    continue
+                res.append("[^/]*")
+            elif c == "?":
+                res.append("[^/]")
+            elif c == "[":
+                end = pattern.find("]", i + 2)
+                if end == -1:
+                    res.append(re.escape(c))
+                else:
+                    chars = pattern[i + 1 : end].replace("\\", "\\\\")
+                    if chars.startswith("!"):
+                        chars = "^" + chars[1:]
+                    res.append(f"[{chars}]")
+                    i = end
+            elif c == "\\" and i + 1 < n:
+                i += 1
+                res.append(re.escape(pattern[i]))
+            else:
+                res.append(re.escape(c))
+            i += 1
+        return "".join(res)
+
+    @staticmethod
+    def compile_rule(line: str) -> Optional[IgnoreRule]:
+        """Compiles one line of a .gitignore file, or returns None for blank lines and comments."""
+        line = line.rstrip("\n\r")
+        # Trailing spaces are ignored unless they're escaped
+        if not line.endswith("\\ "):
+            line = line.rstrip(" ")
+        if line == "" or line.startswith("#"):
+            return None
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if line == "":
+            return None
+
+        # A slash at the start or in the middle anchors the pattern to the folder of the .gitignore file,
+        # otherwise it can match at any depth.
+        if "/" in line:
+            regex = IgnoreRules.translate(line.lstrip("/"))
+        else:
+            regex = "(?:.*/)?" + IgnoreRules.translate(line)
+        return IgnoreRule(re.compile(regex + r"\Z"), negated, dir_only)
+
+    @staticmethod
+    def from_lines(base: str, lines: List[str]) -> "IgnoreRules":
+        """Compiles the lines of a .gitignore file (or a list of globs)."""
+        rules: List[IgnoreRule] = []
+        for line in lines:
+            rule = IgnoreRules.compile_rule(line)
+            if rule is not None:
+                rules.append(rule)
+        return IgnoreRules(base, rules)
+
+    def match(self, rel_path: str, is_dir: bool) -> Optional[bool]:
+        """Returns True if the path is ignored by these rules, False if a negated rule re-includes it, or None
+        if no rule matches it. `rel_path` is relative to the project root. The last matching rule wins.
+        """
+        if self.prefix:
+            if not rel_path.startswith(self.prefix):
+                return None
+            rel_path = rel_path[len(self.prefix) :]
+
+        result: Optional[bool] = None
+        for rule in self.rules:
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.match(rel_path):
+                result = not rule.negated
+        return result
+
+
+class ProjectWalker:
+    """Walks the project tree like `os.walk`, but prunes ignored folders before descending into them, so we
+    never walk through things like `.git`, `node_modules`, or build output just to discard what's in them.
+
+    Folders and files are excluded by the .gitignore files in the project (in every folder, like git does),
+    and by `exclude_globs`. If `include_globs` isn't empty, only files matching one of them are included.
+    Globs use .gitignore syntax, relative to the project root. All of these are compiled once, up front.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        ext_set: Set[str],
+        include_globs: Optional[List[str]] = None,
+        exclude_globs: Optional[List[str]] = None,
+    ):
+        self.root: str = root
+        self.ext_set: Set[str] = ext_set
+        self.includes: Optional[IgnoreRules] = (
+            IgnoreRules.from_lines("", include_globs) if include_globs else None
+        )
+        self.excludes: IgnoreRules = IgnoreRules.from_lines("", exclude_globs or [])
+        # The rules of the .gitignore file in each folder (None if there isn't one), keyed by relative folder
+        self.gitignores: Dict[str, Optional[IgnoreRules]] = {}
+
+    def rel_path(self, path: str) -> str:
+        """Returns the path relative to the root, with forward slashes, and "" for the root itself."""
+        rel = path[len(self.root) :].lstrip("/\\")
+        return rel.replace(os.sep, "/") if os.sep != "/" else rel
+
+    def load_gitignore(self, rel_dir: str) -> Optional[IgnoreRules]:
+        """Loads (and caches) the rules from the .gitignore file in the folder, if it has one."""
+        if rel_dir not in self.gitignores:
+            rules: Optional[IgnoreRules] = None
+            path = os.path.join(self.root, rel_dir, GITIGNORE_FILE)
+            if os.path.isfile(path):
+                with open(path, "r", encoding="utf-8", errors="replace") as file:
+                    rules = IgnoreRules.from_lines(rel_dir, file.readlines())
+            self.gitignores[rel_dir] = rules
+        return self.gitignores[rel_dir]
+
+    def rules_for(self, rel_dir: str) -> List[IgnoreRules]:
+        """Returns the .gitignore rules that apply inside the folder, from the root down."""
+        stack: List[IgnoreRules] = []
+        parts: List[str] = rel_dir.split("/") if rel_dir else []
+        for i in range(len(parts) + 1):
+            rules = self.load_gitignore("/".join(parts[:i]))
+            if rules is not None:
+                stack.append(rules)
+        return stack
+
+    def is_ignored(self, rel_path: str, is_dir: bool, stack: List[IgnoreRules]) -> bool:
+        """Checks a path against the .gitignore rules (deeper files take precedence) and the exclude globs."""
+        ignored: bool = False
+        for rules in stack:
+            result = rules.match(rel_path, is_dir)
+            if result is not None:
+                ignored = result
+        return ignored or self.excludes.match(rel_path, is_dir) is True
+
+    def include_file(self, rel_path: str, filename: str, stack: List[IgnoreRules]) -> bool:
+        """Returns True if the file is one we scan, and isn't excluded."""
+        _, ext = os.path.splitext(filename)
+        if ext.lower() not in self.ext_set:
+            return False
+        if self.includes is not None and not self.is_included(rel_path):
+            return False
+        return not self.is_ignored(rel_path, False, stack)
+
+    def is_included(self, rel_path: str) -> bool:
+        """Checks a file against the include globs. A glob matching any of the file's folders includes it."""
+        assert self.includes is not None
+        if self.includes.match(rel_path, False) is True:
+            return True
+        folder: str = rel_path.rpartition("/")[0]
+        while folder:
+            if self.includes.match(folder, True) is True:
+                return True
+            folder = folder.rpartition("/")[0]
+        return False
+
+    def is_path_included(self, path: str, is_dir: bool) -> bool:
+        """Checks a single path (from a filesystem event, for example) the same way `walk` would, including
+        that none of the folders above it would have been pruned.
+        """
+        rel: str = self.rel_path(path)
+        if rel == "":
+            return is_dir
+        parts: List[str] = rel.split("/")
+
+        for i in range(len(parts) - 1):
+            if parts[i] in ALWAYS_PRUNED:
+                return False
+            folder = "/".join(parts[: i + 1])
+            if self.is_ignored(folder, True, self.rules_for("/".join(parts[:i]))):
+                return False
+
+        stack: List[IgnoreRules] = self.rules_for("/".join(parts[:-1]))
+        if is_dir:
+            return parts[-1] not in ALWAYS_PRUNED and not self.is_ignored(rel, True, stack)
+        return self.include_file(rel, parts[-1], stack)
+
+    def walk(self, top: Optional[str] = None) -> Iterator[Tuple[str, List[str]]]:
+        """Walks the folder `top` (the root by default, otherwise a folder under it) and yields the path of
+        each folder that isn't ignored, along with the sorted names of the files to include in it.
+        """
+        if top is None:
+            top = self.root
+        # The rules in effect in each folder we've visited, so subfolders can extend them
+        stacks: Dict[str, List[IgnoreRules]] = {}
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            rel_dir: str = self.rel_path(dirpath)
+            parent: str = rel_dir.rpartition("/")[0]
+            if parent in stacks:
+                stack = list(stacks[parent])
+                rules = self.load_gitignore(rel_dir)
+                if rules is not None:
+                    stack.append(rules)
+            else:
+                stack = self.rules_for(rel_dir)
+            stacks[rel_dir] = stack
+
+            prefix: str = rel_dir + "/" if rel_dir else ""
+
+            # Pruning in place keeps os.walk from descending into the ignored folders at all. Sorting makes
+            # it visit the rest in the same order on every machine.
+            dirnames[:] = sorted(
+                d
+                for d in dirnames
+                if d not in ALWAYS_PRUNED and not self.is_ignored(prefix + d, True, stack)
+            )
+
+            yield dirpath, [
+                f for f in sorted(filenames) if self.include_file(prefix + f, f, stack)
+            ]
@@ -0,0 +1,226 @@
+"""Marks the start of a prompt for the AI services to cache, and records how many prompt tokens they had cached."""
+
+import json
+import zlib
+import threading
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import httpx
+from langchain_anthropic import ChatAnthropic
+from langchain_core.messages import BaseMessage
+
+# Tells Anthropic to cache the prompt up to and including the content block that has it
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+class PromptUsage(NamedTuple):
+    """The prompt tokens of one response, and how many of them were read from, or written to, the cache of the
+    AI service."""
+
+    # All of them, cached or not
+    input_tokens: int
+    cache_read: int
+    cache_write: int
+
+    @staticmethod
+    def from_usage(usage: Dict[str, int]) -> Optional["PromptUsage"]:
+        """Reads the usage an AI service sent, or returns None if it's not there. OpenAI counts the cached tokens
+        in with the prompt tokens, and caches without being asked, so it never says what it wrote. Anthropic
+        counts the cached tokens apart from the rest."""
+        if "prompt_tokens" in usage:
+            return PromptUsage(usage["prompt_tokens"], usage.get("cached_tokens", 0), 0)
+        if "input_tokens" in usage:
+            read: int = usage.get("cache_read_input_tokens", 0)
+            write: int = usage.get("cache_creation_input_tokens", 0)
+            return PromptUsage(usage["input_tokens"] + read + write, read, write)
+        return None
+
+
+class PromptCacheStats:
+    """How many prompt tokens each AI service read from its cache, and wrote to it, over all the requests of
+    the process. Use `PromptCacheStats.get_instance` to get the one shared instance."""
+
+    instance: Optional["PromptCacheStats"] = None
+    instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.totals: Dict[str, PromptUsage] = {}
+
+    @staticmethod
+    def get_instance() -> "PromptCacheStats":
+        """Returns the stats of this process."""
+        with PromptCacheStats.instance_lock:
+            if PromptCacheStats.instance is None:
+                PromptCacheStats.instance = PromptCacheStats()
+            return PromptCacheStats.instance
+
+    def record(self, service: str, usage: PromptUsage):
+        """Adds the usage of a response from the service."""
+        with self.lock:
+            total: PromptUsage = self.totals.get(service, PromptUsage(0, 0, 0))
+            self.totals[service] = PromptUsage(*(a + b for a, b in zip(total, usage)))
+            self.requests[service] = self.requests.get(service, 0) + 1
+
+    def summary(self) -> str:
+        """Returns a line per service with how much of the prompts it had cached."""
+        with self.lock:
+            lines: List[str] = []
+            for service in sorted(self.totals):
+                total: PromptUsage = self.totals[service]
+                rate: float = total.cache_read / total.input_tokens * 100 if total.input_tokens else 0.0
+                lines.append(
+                    f"Prompt Cache of {service}: {total.cache_read} of {total.input_tokens} prompt tokens read "
+                    + f"from the cache ({rate:.0f}%), {total.cache_write} written ({self.requests[service]} requests)"
+                )
+            return "\n".join(lines)
+
+
+class UsageTap(httpx.SyncByteStream):
+    """Passes the body of a response from an AI service on unchanged, and once it has all arrived (or the
+    response was closed early) records the usage in it. LangChain drops the usage of streamed answers, and
+    never passes on the cached tokens, so we read them from the HTTP responses instead, which works the same
+    for both services, streamed or not.
+    """
+
+    def __init__(self, service: str, response: httpx.Response):
+        self.service: str = service
+        self.stream: Any = response.stream
+        self.content_type: str = response.headers.get("content-type", "")
+        self.body = bytearray()
+        self.recorded: bool = False
+        # The body arrives as it was sent, so we have to decompress it ourselves
+        encoding: str = response.headers.get("content-encoding", "identity").lower()
+        self.decompressor: Any = None
+        if encoding in ("gzip", "deflate"):
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        elif encoding != "identity":
+            self.recorded = True
+
+    @staticmethod
+    def attach(service: str, response: httpx.Response):
+        """An httpx response hook, which taps the body of the JSON and event stream responses."""
+        content_type: str = response.headers.get("content-type", "")
+        if "json" in content_type or "event-stream" in content_type:
+            response.stream = UsageTap(service, response)
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self.stream:
+            if not self.recorded:
+                try:
+                    self.body += self.decompressor.decompress(chunk) if self.decompressor else chunk
+                except zlib.error:
+                    self.recorded = True
+            yield chunk
+        self.record()
+
+    def close(self):
+        self.record()
+        self.stream.close()
+
+    def record(self):
+        """Records the usage in the body, once."""
+        if self.recorded:
+            return
+        self.recorded = True
+        usage: Optional[PromptUsage] = UsageTap.find_usage(
+            self.body.decode("utf-8", "replace"), "event-stream" in self.content_type
+        )
+        if usage is not None:
+            PromptCacheStats.get_instance().record(self.service, usage)
+
+    @staticmethod
+    def find_usage(body: str, events: bool) -> Optional[PromptUsage]:
+        """Finds the usage in a response body, which is JSON, or if `events` is true, server sent events whose
+        data is JSON. A streamed answer can spread the usage over several events (Anthropic sends the prompt
+        tokens at the start, and the answer tokens at the end), so we merge all of them."""
+        docs: List[str] = [body]
+        if events:
+            docs = [line[5:].strip() for line in body.splitlines() if line.startswith("data:")]
+
+        merged: Dict[str, int] = {}
+        for doc in docs:
+            try:
+                event: Any = json.loads(doc)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            message: Any = event.get("message")
+            for usage in (event.get("usage"), message.get("usage") if isinstance(message, dict) else None):
+                if not isinstance(usage, dict):
+                    continue
+                details: Any = usage.get("prompt_tokens_details")
+                if isinstance(details, dict):
+                    usage = {**usage, "cached_tokens": details.get("cached_tokens")}
+                for name, value in usage.items():
+                    if isinstance(value, int):
+                        merged[name] = max(merged.get(name, 0), value)
+        return PromptUsage.from_usage(merged)
+
+
+class CachingChatAnthropic(ChatAnthropic):
+    """ChatAnthropic that marks the parts of the prompt that stay the same from one request to the next, so
+    Anthropic caches them. With `cache_prompt` false it's just ChatAnthropic."""
+
+    cache_prompt: bool = True
+
+    def _format_params(
+        self,
+        *,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        **kwargs: Dict,
+    ) -> Dict:
+        params: Dict = super()._format_params(messages=messages, stop=stop, **kwargs)
+        if self.cache_prompt:
+            CachingChatAnthropic.mark(params)
+        return params
+
+    @staticmethod
+    def mark(params: Dict[str, Any]):
+        """Adds cache breakpoints to the request, of which Anthropic allows four. A breakpoint caches everything
+        before it, and a later request starting with the same content reads it from the cache. Ours go at the
+        end of:
+
+        - the system prompt (which comes after any tools), which is the same for every request of a mode
+        - the user message before the last one, so a long agent conversation still finds its history
+        - the context of the last user message, which is the files and blocks its prompt refers to, so the
+          next question about the same files finds them
+        - the last user message, so the next request of the conversation finds all of this one
+        """
+        system: Any = params.get("system")
+        if isinstance(system, str) and system:
+            params["system"] = [{"type": "text", "text": system, "cache_control": CACHE_CONTROL}]
+
+        # The content lists can be the ones of the messages we were given, so we change copies
+        messages: List[Dict[str, Any]] = [dict(m) for m in params.get("messages", [])]
+        params["messages"] = messages
+        user: List[Dict[str, Any]] = [m for m in messages if m.get("role") == "user"]
+        if len(user) > 1:
+            CachingChatAnthropic.mark_block(user[-2], -1)
+        if user:
+            content: Any = user[-1].get("content")
+            if (
+                isinstance(content, list)
+                and len(content) > 1
+                and isinstance(content[0], dict)
+                and content[0].get("type") == "text"
+            ):
+                CachingChatAnthropic.mark_block(user[-1], 0)
+            CachingChatAnthropic.mark_block(user[-1], -1)
+
+    @staticmethod
+    def mark_block(message: Dict[str, Any], index: int):
+        """Puts a cache breakpoint on a content block of the message."""
+        content: Any = message.get("content")
+        if isinstance(content, str):
+            if content:
+                message["content"] = [{"type": "text", "text": content, "cache_control": CACHE_CONTROL}]
+            return
+        if not isinstance(content, list) or not content or not isinstance(content[index], dict):
+            return
+        content = list(content)
+        content[index] = {**content[index], "cache_control": CACHE_CONTROL}
+        message["content"] = content
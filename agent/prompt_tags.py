@@ -0,0 +1,134 @@
+"""Finds the block(), symbol(), file(), and folder() tags in a prompt, so we know what the prompt refers to before
+loading anything from the project, and expands them with the content they refer to."""
+
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Set
+
+from agent.tag_lexer import TagLexer
+from agent.tags import TAG_BLOCK_BEGIN
+
+# Tags look like `block(MyBlock)`, `symbol(agent.models.TextBlock)`, `file(/src/main.py)`, or `folder(/src/)`
+PROMPT_TAG_PATTERN = re.compile(r"\b(block|symbol|file|folder)\(([^()\n]+)\)")
+
+
+class PromptRefs(NamedTuple):
+    """Everything a prompt refers to. Files and folders are relative to the source folder, like the names in
+    `ProjectLoader.file_names` and `ProjectLoader.folder_names` (so folders have no trailing slash).
+    """
+
+    blocks: Set[str]
+    files: Set[str]
+    folders: Set[str]
+    # Fully qualified names of classes, functions, and methods
+    symbols: Set[str]
+
+    def empty(self) -> bool:
+        """True if the prompt doesn't refer to anything in the project."""
+        return not self.blocks and not self.files and not self.folders and not self.symbols
+
+
+class PromptExpansion(NamedTuple):
+    """The result of expanding the tags in a prompt."""
+
+    prompt: str
+    blocks_inserted: int
+    files_inserted: int
+    folders_inserted: int
+    symbols_inserted: int
+    # The tags that didn't match anything in the project, and were left as they were
+    unknown: List[str]
+
+    def inserted(self) -> bool:
+        """True if anything from the project was inserted into the prompt."""
+        return (
+            self.blocks_inserted + self.files_inserted + self.folders_inserted + self.symbols_inserted > 0
+        )
+
+
+# Renders the content for a tag, given the kind of tag ("block", "symbol", "file" or "folder") and the name in it, or
+# returns None if the name doesn't match anything
+TagRenderer = Callable[[str, str], Optional[str]]
+
+
+class PromptTags:
+    """Finds the block(), symbol(), file(), and folder() tags in a prompt, in a single pass."""
+
+    @staticmethod
+    def scan(prompt: str) -> PromptRefs:
+        """Returns the block names, files, folders, and symbols the prompt refers to."""
+        refs = PromptRefs(set(), set(), set(), set())
+        for match in PROMPT_TAG_PATTERN.finditer(prompt):
+            kind, name = match.group(1), match.group(2)
+            if kind == "block":
+                refs.blocks.add(name)
+            elif kind == "symbol":
+                refs.symbols.add(name)
+            elif kind == "file":
+                refs.files.add(name)
+            # Folder tags end with a slash, and the tag isn't a folder tag without it
+            elif name.endswith("/"):
+                refs.folders.add(name[:-1])
+        return refs
+
+    @staticmethod
+    def expand(prompt: str, render: TagRenderer) -> PromptExpansion:
+        """Replaces every tag in the prompt with what `render` returns for it, in a single pass. The output is
+        built with one join, and content that gets inserted is never itself searched for tags. Tags that
+        `render` doesn't know are left in place and reported.
+        """
+        parts: List[str] = []
+        counts = {"block": 0, "symbol": 0, "file": 0, "folder": 0}
+        unknown: List[str] = []
+        # A tag used more than once only gets rendered once
+        rendered: Dict[str, Optional[str]] = {}
+        pos: int = 0
+
+        for match in PROMPT_TAG_PATTERN.finditer(prompt):
+            kind, name = match.group(1), match.group(2)
+            tag: str = match.group(0)
+            if tag not in rendered:
+                rendered[tag] = None
+                if kind != "folder":
+                    rendered[tag] = render(kind, name)
+                # Folder tags end with a slash, and the tag isn't a folder tag without it
+                elif name.endswith("/"):
+                    rendered[tag] = render(kind, name[:-1])
+            content: Optional[str] = rendered[tag]
+
+            if content is None:
+                if tag not in unknown:
+                    unknown.append(tag)
+                continue
+            parts.append(prompt[pos : match.start()])
+            parts.append(content)
+            pos = match.end()
+            counts[kind] += 1
+
+        parts.append(prompt[pos:])
+        return PromptExpansion(
+            "".join(parts),
+            counts["block"],
+            counts["file"],
+            counts["folder"],
+            counts["symbol"],
+            unknown,
+        )
+
+    @staticmethod
+    def inserted_block_names(texts: List[str]) -> Set[str]:
+        """Returns the names of the blocks that were inserted into earlier prompts, which show up as
+        block_begin lines. The AI can still update those, so they need to be loaded as well.
+        """
+        names: Set[str] = set()
+        for text in texts:
+            if TAG_BLOCK_BEGIN not in text:
+                continue
+            for line in text.splitlines():
+                tag_line = TagLexer.lex(line.strip())
+                if (
+                    tag_line is not None
+                    and tag_line.tag == TAG_BLOCK_BEGIN
+                    and tag_line.name is not None
+                ):
+                    names.add(tag_line.name)
+        return names
@@ -1,16 +1,51 @@
 """Contains the prompt templates for the agent."""
 
 import os
-from typing import List, Optional, Dict, Tuple
+from dataclasses import dataclass, field
+from typing import Optional, Dict, List, Set, Tuple
 from langchain.prompts import PromptTemplate
 from agent.app_config import AppConfig
+from agent.project_walker import ProjectWalker
+from agent.content_cache import ContentCache
+from agent.token_budget import TokenBudget
+from agent.minifier import ContentMinifier
 from agent.string_utils import StringUtils
 from agent.tags import (
     TAG_FILE_BEGIN,
     TAG_FILE_END,
+    MORE_INSTRUCTIONS,
     template_info,
 )
-from agent.utils import Utils
+from agent.utils import RefactorMode
+
+SYSTEM_PROMPT_TEMPLATE = "prompt_templates/agent_system_prompt.txt"
+# Instructions added to the system prompt when refactoring
+FILE_INSTRUCTION_TEMPLATES = [
+    "prompt_templates/file_access_instructions.txt",
+    "prompt_templates/file_edit_instructions.txt",
+]
+# Instructions added to the system prompt when refactoring a project that has blocks
+BLOCK_INSTRUCTION_TEMPLATES = [
+    "prompt_templates/block_access_instructions.txt",
+    "prompt_templates/block_update_instructions.txt",
+]
+
+# A file only gets truncated to fit the prompt if at least this many tokens of it can be kept
+MIN_TRUNCATED_TOKENS = 200
+TRUNCATED_MARKER = "\n... (truncated to fit the prompt)"
+
+
+@dataclass
+class FolderContent:
+    """The content built for a folder, and which of its files made it in."""
+
+    content: str
+    included: List[str] = field(default_factory=list)
+    # Files cut short, or left out entirely, to stay within the token budget
+    truncated: List[str] = field(default_factory=list)
+    dropped: List[str] = field(default_factory=list)
+    # Files that aren't text the prompt can hold (binary, too large, or not UTF-8), which are left out
+    skipped: List[str] = field(default_factory=list)
 
 
 class PromptUtils:
@@ -18,8 +53,13 @@ class PromptUtils:
 
     tplt_file_content_block: Optional[PromptTemplate] = None
 
-    # caches the version of a template file, after core substitutions have been made from template_info
-    template_cache: Dict[str, str] = {}
+    # The version of each template file after the core substitutions from template_info have been made, keyed
+    # by file name, along with the modification time (in ns) of the file it was made from
+    template_cache: Dict[str, Tuple[int, str]] = {}
+
+    # The finished system prompt for each (mode, has_blocks), along with the modification times of the
+    # templates it was built from
+    system_prompt_cache: Dict[Tuple[str, bool], Tuple[Tuple[int, ...], str]] = {}
 
     @staticmethod
     def get_template(file_name: str) -> str:
@@ -27,14 +67,53 @@ class PromptUtils:
         Get the template for the given file name.
         NOTE: Of the file_name contains a slash we use it as is (minus the .txt extension),
         else we assume it's in prompt_templates folder
+
+        The template is read again whenever the file has been modified, so edits show up without a restart.
         """
-        if file_name not in PromptUtils.template_cache:
+        mtime: int = os.stat(file_name).st_mtime_ns
+        cached = PromptUtils.template_cache.get(file_name)
+        if cached is None or cached[0] != mtime:
             pt = PromptTemplate.from_file(file_name)
-            PromptUtils.template_cache[file_name] = (
-                "\n\n" + StringUtils.post_process_template(pt.format(**template_info))
-            )
+            cached = (mtime, "\n\n" + StringUtils.post_process_template(pt.format(**template_info)))
+            PromptUtils.template_cache[file_name] = cached
+        return cached[1]
 
-        return PromptUtils.template_cache[file_name]
+    @staticmethod
+    def system_prompt_templates(mode: str, has_blocks: bool) -> List[str]:
+        """Returns the template files the system prompt is built from, in order."""
+        templates: List[str] = [SYSTEM_PROMPT_TEMPLATE]
+        if mode == RefactorMode.REFACTOR.value:
+            templates += FILE_INSTRUCTION_TEMPLATES
+            if has_blocks:
+                templates += BLOCK_INSTRUCTION_TEMPLATES
+        return templates
+
+    @staticmethod
+    def get_system_prompt(mode: str, has_blocks: bool) -> str:
+        """Returns the system prompt for the mode, and whether the project has any blocks. It's only built
+        again if one of its templates has been modified, and is otherwise exactly the same string every run,
+        which lets the AI providers cache it as a prompt prefix.
+        """
+        # Blocks only make a difference when refactoring
+        has_blocks = has_blocks and mode == RefactorMode.REFACTOR.value
+        templates: List[str] = PromptUtils.system_prompt_templates(mode, has_blocks)
+        mtimes: Tuple[int, ...] = tuple(os.stat(t).st_mtime_ns for t in templates)
+
+        key = (mode, has_blocks)
+        cached = PromptUtils.system_prompt_cache.get(key)
+        if cached is None or cached[0] != mtimes:
+            prompt: str = PromptUtils.get_template(templates[0]) + MORE_INSTRUCTIONS
+            prompt += "".join(PromptUtils.get_template(t) for t in templates[1:])
+            cached = (mtimes, prompt)
+            PromptUtils.system_prompt_cache[key] = cached
+        return cached[1]
+
+    @staticmethod
+    def warm_system_prompts():
+        """Builds the system prompt for every mode ahead of time, so the first run doesn't have to."""
+        for mode in RefactorMode:
+            for has_blocks in (False, True):
+                PromptUtils.get_system_prompt(mode.value, has_blocks)
 
     @staticmethod
     def get_file_content_block(file_name: str, content: str) -> str:
@@ -46,66 +125,114 @@ class PromptUtils:
 """
 
     @staticmethod
-    def build_folder_content(folder_path: str, source_folder_len: int) -> str:
-        """Builds the content of a folder. Which will contain all the filenames and their content."""
+    def build_folder_content(
+        folder_path: str,
+        source_folder_len: int,
+        budget: Optional[TokenBudget] = None,
+        explicit: Optional[Set[str]] = None,
+        minifier: Optional[ContentMinifier] = None,
+        project_files: Optional[Set[str]] = None,
+    ) -> FolderContent:
+        """Builds the content of a folder. Which will contain all the filenames and their content.
+
+        If the `budget` has a limit, only as many files as fit in it are included. Files are picked by priority:
+        the files in `explicit` (those the prompt refers to some other way) first, then the most recently
+        modified ones, and then the smallest ones. A file that doesn't fit is truncated if there's still a
+        reasonable amount of room, and dropped if not. The files that do get included are still listed in
+        folder order.
+
+        If we're given a `minifier` the content of each file goes through it (and it's the minified content
+        that gets counted against the budget).
+
+        If we're given the `project_files` (the files the scan kept) any other file in the folder is one the
+        scan skipped, so it's left out and listed in `skipped`, as is a file that no longer decodes.
+        """
         print(f"Building content for folder: {folder_path}")
 
-        content = f"""
+        header = f"""
 
 Below is the content of the files in the folder named {folder_path} (using {TAG_FILE_BEGIN} and {TAG_FILE_END} tags to delimit the files):
         """
-        for dirpath, _, filenames in os.walk(folder_path):
+        walker = ProjectWalker(
+            folder_path[:source_folder_len],
+            AppConfig.ext_set,
+            AppConfig.include_globs,
+            AppConfig.exclude_globs,
+        )
+        # (relative file name, full path) of every file in the folder, in folder order
+        files: List[Tuple[str, str]] = []
+        for dirpath, filenames in walker.walk(folder_path):
             for filename in filenames:
-                # Check the file extension
-                if Utils.should_include_file(AppConfig.ext_set, filename):
-                    # build the full path
-                    path: str = os.path.join(dirpath, filename)
-                    # get the file name relative to the source folder
-                    file_name: str = path[source_folder_len:]
-                    file_content = Utils.read_file(path)
-                    content += PromptUtils.get_file_content_block(
-                        file_name, file_content
-                    )
-
-        return content
+                # build the full path
+                path: str = os.path.join(dirpath, filename)
+                # get the file name relative to the source folder
+                files.append((path[source_folder_len:], path))
 
-    @staticmethod
-    def insert_files_into_prompt(
-        prompt: str, source_folder: str, file_names: List[str]
-    ) -> Tuple[str, bool]:
-        """
-        Substitute entire file contents into the prompt. Prompts can contain ${FileName} tags,
-        which will be replaced with the content of the file with the name 'FileName'
-        """
-        inserted: bool = False
-        for file_name in file_names:
-            tag: str = f"file({file_name})"
-            if tag in prompt:
-                inserted = True
-                content: str = Utils.read_file(source_folder + file_name)
-                prompt = prompt.replace(
-                    tag, PromptUtils.get_file_content_block(file_name, content)
-                )
-        return prompt, inserted
+        result = FolderContent("")
+        if project_files is not None:
+            result.skipped = [file_name for file_name, _ in files if file_name not in project_files]
+            files = [(file_name, path) for file_name, path in files if file_name in project_files]
+        cache = ContentCache.get_instance()
 
-    @staticmethod
-    def insert_folders_into_prompt(
-        prompt: str, source_folder: str, folder_names: List[str]
-    ) -> Tuple[str, bool]:
-        """
-        Substitute entire folder contents into the prompt. Prompts can contain ${FolderName} tags,
-        which will be replaced with the content of the files inside the folder
-        """
-        source_folder_len: int = len(source_folder)
-        inserted: bool = False
-        for folder_name in folder_names:
-            tag: str = f"folder({folder_name}/)"
-            if tag in prompt:
-                inserted = True
-                # build the content of the folder
-                content: str = PromptUtils.build_folder_content(
-                    source_folder + folder_name,
-                    source_folder_len,
+        def read(file_name: str, path: str) -> Optional[str]:
+            content: Optional[str] = cache.try_read_text(path)
+            if content is None:
+                result.skipped.append(file_name)
+                return None
+            return minifier.minify(file_name, content) if minifier is not None else content
+
+        if budget is None or not budget.limited():
+            parts: List[str] = []
+            for file_name, path in files:
+                file_content: Optional[str] = read(file_name, path)
+                if file_content is not None:
+                    result.included.append(file_name)
+                    parts.append(PromptUtils.get_file_content_block(file_name, file_content))
+            result.content = header + "".join(parts)
+            return result
+
+        budget.charge(header)
+        stats: Dict[str, os.stat_result] = {path: os.stat(path) for _, path in files}
+        explicit = explicit or set()
+        order: List[int] = sorted(
+            range(len(files)),
+            key=lambda i: (
+                files[i][0] not in explicit,
+                -stats[files[i][1]].st_mtime_ns,
+                stats[files[i][1]].st_size,
+            ),
+        )
+
+        # The content of each file we include, keyed by its index in `files`
+        blocks: Dict[int, str] = {}
+        for i in order:
+            file_name, path = files[i]
+            # Once the budget is used up there's no point reading any more files
+            if budget.remaining() <= 0:
+                result.dropped.append(file_name)
+                continue
+
+            file_content = read(file_name, path)
+            if file_content is None:
+                continue
+            block: str = PromptUtils.get_file_content_block(file_name, file_content)
+            if budget.try_charge(block):
+                blocks[i] = block
+                result.included.append(file_name)
+                continue
+
+            room: int = budget.remaining() - budget.counter.count(
+                PromptUtils.get_file_content_block(file_name, TRUNCATED_MARKER)
+            )
+            if room >= MIN_TRUNCATED_TOKENS:
+                block = PromptUtils.get_file_content_block(
+                    file_name, budget.counter.truncate(file_content, room) + TRUNCATED_MARKER
                 )
-                prompt = prompt.replace(tag, content)
-        return prompt, inserted
+                budget.charge(block)
+                blocks[i] = block
+                result.truncated.append(file_name)
+            else:
+                result.dropped.append(file_name)
+
+        result.content = header + "".join(blocks[i] for i in sorted(blocks))
+        return result
@@ -0,0 +1,136 @@
+"""Caches LLM responses on disk, so asking the same thing again doesn't need another round trip."""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import warnings
+from typing import Any, Dict, List, Optional
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+
+# Default for the most bytes of responses the cache keeps on disk
+DEFAULT_RESPONSE_CACHE_SIZE = 200000000
+
+
+class ResponseCache(BaseCache):
+    """A LangChain cache that keeps each response in a file under `folder`, named by the hash of everything
+    that determines the response: the whole message list, and the model configuration, which covers the
+    service, the model, the temperature, and the schemas of any tools bound to the model. Only use it for
+    queries that are deterministic, which in practice means temperature 0.
+
+    Because it caches each call to the model, rather than a whole agent run, tool calls in a cached response
+    are still executed by the agent, so they still stage their edits.
+
+    The total size of the cache is capped, and the least recently used responses (by file modification time,
+    which a hit updates) are deleted to stay under it.
+    """
+
+    def __init__(self, folder: str, max_bytes: int = DEFAULT_RESPONSE_CACHE_SIZE):
+        self.folder: str = folder
+        self.max_bytes: int = max_bytes
+        self.lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        # Sum of how long the cached responses originally took
+        self.saved_ms: float = 0.0
+        # When each missed lookup happened, so we know how long the response took once it arrives
+        self.started: Dict[str, float] = {}
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        """The hash a response is stored by."""
+        return hashlib.sha256((llm_string + "\0" + prompt).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        """Path of the file holding the response with the given key."""
+        return os.path.join(self.folder, key + ".json")
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Returns the cached response, or None on a miss."""
+        key: str = ResponseCache.key(prompt, llm_string)
+        path: str = self.path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                entry: Dict[str, Any] = json.load(file)
+            with warnings.catch_warnings():
+                # `loads` is marked as beta
+                warnings.simplefilter("ignore")
+                generations: List[Generation] = loads(entry["generations"])
+            # Marks it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            generations = []
+        except (IOError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable cached response {path}: {e}")
+            generations = []
+
+        with self.lock:
+            if generations:
+                self.hits += 1
+                self.saved_ms += entry.get("elapsed_ms", 0.0)
+                print(f"Response Cache: hit, saved {entry.get('elapsed_ms', 0.0):.0f} ms")
+                return generations
+            self.misses += 1
+            self.started[key] = time.perf_counter()
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE):
+        """Saves a response we just got."""
+        key: str = ResponseCache.key(prompt, llm_string)
+        with self.lock:
+            started: Optional[float] = self.started.pop(key, None)
+        elapsed_ms: float = (time.perf_counter() - started) * 1000 if started is not None else 0.0
+
+        data: bytes = json.dumps(
+            {"time": time.time(), "elapsed_ms": elapsed_ms, "generations": dumps(return_val)}
+        ).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path: str = self.path(key) + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used responses until the cache is under its cap."""
+        entries: List[Any] = []
+        total: int = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self, **kwargs: Any):
+        """Deletes every cached response."""
+        if not os.path.isdir(self.folder):
+            return
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".json"):
+                os.remove(entry.path)
+
+    def summary(self) -> str:
+        """Returns a one line summary of how well the cache is doing."""
+        with self.lock:
+            lookups: int = self.hits + self.misses
+            rate: float = self.hits / lookups * 100 if lookups else 0.0
+            return (
+                f"Response Cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), "
+                + f"saved {self.saved_ms / 1000:.1f} s"
+            )
+
@@ -0,0 +1,277 @@
+"""On-disk BM25 search index over the files and named blocks of the project, for finding the code a prompt is
+about when it doesn't say."""
+
+import os
+import re
+import math
+import sqlite3
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from agent.content_cache import ContentCache
+
+# Bump this whenever the schema or the tokenizing changes, so old indexes get rebuilt
+SEARCH_INDEX_VERSION = 1
+
+# BM25 parameters, the usual defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Query terms in more than this fraction of the documents say next to nothing about relevance, and would cost
+# the most to look up, so they're ignored. Only once there are enough documents for that to mean anything.
+MAX_TERM_DOC_FRACTION = 0.25
+COMMON_TERM_MIN_DOCS = 100
+
+# Identifiers, which we also split at underscores and camelCase humps
+WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+PART_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY, kind TEXT NOT NULL, name TEXT NOT NULL, file TEXT NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_file ON docs (file);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL, doc INTEGER NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT NOT NULL, kind TEXT NOT NULL, df INTEGER NOT NULL, PRIMARY KEY (term, kind)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS kinds (
+    kind TEXT PRIMARY KEY, docs INTEGER NOT NULL, total_length INTEGER NOT NULL
+);
+"""
+
+
+class SearchHit(NamedTuple):
+    """A file or block that matched a search. `name` is the block name for blocks, and the file for files."""
+
+    kind: str
+    name: str
+    rel_filename: str
+    score: float
+
+
+class SearchIndex:
+    """An inverted index over every file in the project, and every named block, kept in an SQLite database so
+    it lives on disk and a lookup only reads the postings of the terms searched for.
+
+    The index is kept in step with the scan manifest: `update` only tokenizes the files whose size or
+    modification time differ from what's in the index, so after the first build it costs little more than the
+    scan itself. Files and blocks are ranked separately, with BM25, since they're of very different lengths.
+
+    Each method opens its own connection, so the index can be used from any thread, and the database is in
+    WAL mode so searches don't wait for updates.
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file: str = index_file
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens the index, creating it (or rebuilding it, if it's from an older version) as needed."""
+        os.makedirs(os.path.dirname(self.index_file) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.index_file, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(SEARCH_INDEX_VERSION):
+            with conn:
+                for table in ("files", "docs", "postings", "terms", "kinds"):
+                    conn.execute(f"DELETE FROM {table}")
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(SEARCH_INDEX_VERSION),)
+                )
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Opens the index for one transaction, which is committed unless there's an exception."""
+        conn = self.connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        """Splits text into lowercase terms. Identifiers count as themselves and also as their parts, so that
+        `getUserName` and `get_user_name` both match a search for "user".
+        """
+        terms: List[str] = []
+        for word in WORD_PATTERN.findall(text):
+            parts: List[str] = PART_PATTERN.findall(word)
+            if len(parts) > 1 or (parts and parts[0] != word):
+                terms.extend(p.lower() for p in parts if len(p) >= MIN_TERM_LENGTH and not p.isdigit())
+            if MIN_TERM_LENGTH <= len(word) <= MAX_TERM_LENGTH:
+                terms.append(word.lower())
+        return terms
+
+    def update(self, scan_dir: str, manifest: Dict[str, Dict[str, Any]]):
+        """Brings the index up to date with the scan manifest, re-indexing only the files that changed."""
+        with self.transaction() as conn:
+            indexed: Dict[str, Tuple[int, int]] = {
+                row[0]: (row[1], row[2]) for row in conn.execute("SELECT file, size, mtime_ns FROM files")
+            }
+            changed: Dict[str, Optional[Dict[str, Any]]] = {}
+            for rel_filename, entry in manifest.items():
+                # Skipped files aren't part of the project
+                if entry.get("skipped") is not None:
+                    if rel_filename in indexed:
+                        changed[rel_filename] = None
+                elif indexed.get(rel_filename) != (entry["size"], entry["mtime_ns"]):
+                    changed[rel_filename] = entry
+            for rel_filename in indexed:
+                if rel_filename not in manifest:
+                    changed[rel_filename] = None
+
+            if changed:
+                self.apply(conn, scan_dir, changed)
+                print(f"Search index: re-indexed {len(changed)} files")
+
+    def update_files(self, scan_dir: str, entries: Dict[str, Optional[Dict[str, Any]]]):
+        """Re-indexes the given files, with their new manifest entries (None for files that were removed)."""
+        with self.transaction() as conn:
+            self.apply(conn, scan_dir, entries)
+
+    def apply(
+        self, conn: sqlite3.Connection, scan_dir: str, entries: Dict[str, Optional[Dict[str, Any]]]
+    ):
+        """Removes each of the files from the index, and adds back the ones that still exist."""
+        cache = ContentCache.get_instance()
+        for rel_filename, entry in sorted(entries.items()):
+            SearchIndex.remove_file(conn, rel_filename)
+            if entry is None or entry.get("skipped") is not None:
+                continue
+            try:
+                data: bytes = cache.read_bytes(scan_dir + rel_filename)
+            except (IOError, ValueError) as e:
+                print(f"Search index: unable to read {rel_filename}: {e}")
+                continue
+
+            docs: List[Tuple[str, str, List[str]]] = [
+                (
+                    "file",
+                    rel_filename,
+                    SearchIndex.tokenize(rel_filename) + SearchIndex.tokenize(data.decode("utf-8", "replace")),
+                )
+            ]
+            for span in entry["blocks"]:
+                name, start, end = span[0], span[1], span[2]
+                docs.append(
+                    (
+                        "block",
+                        name,
+                        SearchIndex.tokenize(name)
+                        + SearchIndex.tokenize(data[start:end].decode("utf-8", "replace")),
+                    )
+                )
+            for kind, name, terms in docs:
+                SearchIndex.add_doc(conn, kind, name, rel_filename, terms)
+            conn.execute(
+                "INSERT INTO files VALUES (?, ?, ?)", (rel_filename, entry["size"], entry["mtime_ns"])
+            )
+
+    @staticmethod
+    def add_doc(conn: sqlite3.Connection, kind: str, name: str, rel_filename: str, terms: List[str]):
+        """Adds one document, and counts it in the statistics BM25 needs."""
+        counts = Counter(terms)
+        doc: Optional[int] = conn.execute(
+            "INSERT INTO docs (kind, name, file, length) VALUES (?, ?, ?, ?)",
+            (kind, name, rel_filename, len(terms)),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?)", ((term, doc, tf) for term, tf in counts.items())
+        )
+        conn.executemany(
+            "INSERT INTO terms VALUES (?, ?, 1) ON CONFLICT (term, kind) DO UPDATE SET df = df + 1",
+            ((term, kind) for term in counts),
+        )
+        conn.execute(
+            "INSERT INTO kinds VALUES (?, 1, ?) ON CONFLICT (kind) DO UPDATE SET docs = docs + 1, "
+            + "total_length = total_length + excluded.total_length",
+            (kind, len(terms)),
+        )
+
+    @staticmethod
+    def remove_file(conn: sqlite3.Connection, rel_filename: str):
+        """Removes a file, and the blocks in it, from the index."""
+        for doc, kind, length in conn.execute(
+            "SELECT id, kind, length FROM docs WHERE file = ?", (rel_filename,)
+        ).fetchall():
+            conn.execute(
+                "UPDATE terms SET df = df - 1 WHERE kind = ? AND term IN "
+                + "(SELECT term FROM postings WHERE doc = ?)",
+                (kind, doc),
+            )
+            conn.execute(
+                "UPDATE kinds SET docs = docs - 1, total_length = total_length - ? WHERE kind = ?",
+                (length, kind),
+            )
+            conn.execute("DELETE FROM postings WHERE doc = ?", (doc,))
+            conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+        conn.execute("DELETE FROM files WHERE file = ?", (rel_filename,))
+
+    def search(self, query: str, top_k: int, kinds: Iterable[str] = ("file", "block")) -> List[SearchHit]:
+        """Returns the `top_k` best matches for the query of each kind, best first."""
+        query_terms: List[str] = sorted(set(SearchIndex.tokenize(query)))
+        if not query_terms or top_k <= 0:
+            return []
+
+        hits: List[SearchHit] = []
+        with self.transaction() as conn:
+            for kind in kinds:
+                hits.extend(SearchIndex.search_kind(conn, kind, query_terms, top_k))
+        hits.sort(key=lambda hit: -hit.score)
+        return hits
+
+    @staticmethod
+    def search_kind(
+        conn: sqlite3.Connection, kind: str, query_terms: List[str], top_k: int
+    ) -> List[SearchHit]:
+        """Ranks the documents of one kind with BM25."""
+        row = conn.execute("SELECT docs, total_length FROM kinds WHERE kind = ?", (kind,)).fetchone()
+        if row is None or row[0] == 0:
+            return []
+        doc_count: int = row[0]
+        avg_length: float = max(row[1] / doc_count, 1.0)
+
+        marks = ",".join("?" * len(query_terms))
+        idf: Dict[str, float] = {}
+        for term, df in conn.execute(
+            f"SELECT term, df FROM terms WHERE kind = ? AND df > 0 AND term IN ({marks})",
+            [kind, *query_terms],
+        ):
+            if doc_count < COMMON_TERM_MIN_DOCS or df <= doc_count * MAX_TERM_DOC_FRACTION:
+                idf[term] = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+        if not idf:
+            return []
+
+        scores: Dict[int, float] = {}
+        marks = ",".join("?" * len(idf))
+        for term, doc, tf, length in conn.execute(
+            "SELECT p.term, p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc "
+            + f"WHERE p.term IN ({marks}) AND d.kind = ?",
+            [*idf, kind],
+        ):
+            norm: float = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            scores[doc] = scores.get(doc, 0.0) + idf[term] * tf * (BM25_K1 + 1) / norm
+
+        best = sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+        hits: List[SearchHit] = []
+        for doc, score in best:
+            name, rel_filename = conn.execute(
+                "SELECT name, file FROM docs WHERE id = ?", (doc,)
+            ).fetchone()
+            hits.append(SearchHit(kind, name, rel_filename, score))
+        return hits
@@ -0,0 +1,118 @@
+"""Receives an AI answer while it streams in, and passes it on to the log file and the GUI as it arrives."""
+
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, TextIO
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from agent.answer_parser import AnswerParser
+
+# Most often the GUI gets redrawn with the text so far, since redrawing on every token would slow it down
+GUI_REFRESH_SECONDS = 0.1
+
+
+@dataclass
+class QueryTiming:
+    """How long a query took."""
+
+    # Time to the first token of the answer, or None if the answer was empty
+    first_token_ms: Optional[float] = None
+    total_ms: float = 0.0
+    # Number of model calls, and of tool calls, the query needed
+    llm_calls: int = 0
+    tool_calls: int = 0
+
+    def summary(self) -> str:
+        """Returns a one line summary of the timing."""
+        first: str = f"{self.first_token_ms:.0f} ms" if self.first_token_ms is not None else "none"
+        return (
+            f"Query took {self.total_ms:.0f} ms, first token after {first} "
+            + f"({self.llm_calls} model calls, {self.tool_calls} tool calls)"
+        )
+
+
+class StreamHandler(BaseCallbackHandler):
+    """A LangChain callback handler that collects an answer token by token, as the model streams it, along
+    with the progress of any tool calls. Everything is appended to `log` (if given) as it arrives, and `on_text`
+    (if given) is called with all the text so far, at most every GUI_REFRESH_SECONDS. The text is also fed to
+    `parser` (if given), which applies the edits in the answer as they arrive.
+
+    A model that doesn't stream, or a response that came from the cache, arrives all at once when the model call
+    ends, and is handled the same way.
+    """
+
+    def __init__(
+        self,
+        log: Optional[TextIO] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+        parser: Optional[AnswerParser] = None,
+    ):
+        self.log: Optional[TextIO] = log
+        self.on_text: Optional[Callable[[str], None]] = on_text
+        self.parser: Optional[AnswerParser] = parser
+        self.parts: List[str] = []
+        self.started: float = time.perf_counter()
+        self.last_refresh: float = 0.0
+        # The model calls that have streamed tokens, so their end doesn't add the text again
+        self.streamed: Dict[UUID, bool] = {}
+        self.timing = QueryTiming()
+
+    def add_text(self, text: str, token: bool = True):
+        """Adds text to the answer, and passes it on. Only tokens from the model count for the time to the first
+        token, not the text we add ourselves."""
+        if not text:
+            return
+        if token and self.timing.first_token_ms is None:
+            self.timing.first_token_ms = (time.perf_counter() - self.started) * 1000
+        self.parts.append(text)
+        if self.log is not None:
+            self.log.write(text)
+            self.log.flush()
+        if self.parser is not None:
+            self.parser.feed(text)
+        now: float = time.perf_counter()
+        if self.on_text is not None and now - self.last_refresh >= GUI_REFRESH_SECONDS:
+            self.last_refresh = now
+            self.on_text(self.text())
+
+    def text(self) -> str:
+        """All the text so far."""
+        return "".join(self.parts)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        self.streamed[run_id] = True
+        self.add_text(token)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        self.timing.llm_calls += 1
+        if not self.streamed.pop(run_id, False):
+            for generations in response.generations:
+                for generation in generations:
+                    self.add_text(generation.text)
+        self.end_text()
+
+    def end_text(self):
+        """Ends the text of a model call with a newline, so the next one starts on a line of its own."""
+        if self.parts and not self.parts[-1].endswith("\n"):
+            self.add_text("\n", False)
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any
+    ):
+        self.timing.tool_calls += 1
+        self.add_text(f"[Calling tool: {serialized.get('name', 'tool')}]\n", False)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.add_text(f"[Tool failed: {error}]\n", False)
+
+    def finish(self) -> QueryTiming:
+        """Called once the query is done. Shows the final text, and returns the timing."""
+        self.timing.total_ms = (time.perf_counter() - self.started) * 1000
+        if self.parser is not None:
+            self.parser.close()
+        if self.on_text is not None:
+            self.on_text(self.text())
+        return self.timing
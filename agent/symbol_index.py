@@ -0,0 +1,199 @@
+"""Indexes the classes, functions, and methods in the project, so prompts can refer to them with symbol() tags the
+same way they refer to named blocks, without any tags having to be put in the source."""
+
+import os
+import ast
+import json
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from agent.content_cache import ContentCache
+from agent.utils import Utils
+
+# Bump this whenever the layout of the index, or what a parser produces, changes
+SYMBOL_INDEX_VERSION = 1
+
+# A symbol found by a parser: its name within the module (like "Class.method"), and the byte offsets of its
+# source, which is whole lines, including any decorators
+SymbolSpan = Tuple[str, int, int]
+
+# Finds the symbols in the content of one file
+SymbolParser = Callable[[bytes], List[SymbolSpan]]
+
+
+class Symbol(NamedTuple):
+    """Where a symbol is. The name is fully qualified, like `agent.models.TextBlock.content`."""
+
+    name: str
+    rel_filename: str
+    start: int
+    end: int
+
+
+class SymbolIndex:
+    """The symbols of every file with a language we have a parser for, keyed by fully qualified name, so a
+    symbol() tag is resolved with one dictionary lookup.
+
+    Parsers are registered by file extension (see `register_parser`), and the index only ever looks at the
+    files the scan found, so a language also needs its extension in `scan_extensions`. Python is supported out
+    of the box.
+
+    The index is kept in step with the scan manifest, and persisted in `index_file`: only files whose size or
+    modification time changed since they were last parsed get parsed again.
+    """
+
+    # Symbol parsers keyed by (lower case) file extension
+    parsers: Dict[str, SymbolParser] = {}
+
+    def __init__(self, index_file: Optional[str]):
+        self.index_file: Optional[str] = index_file
+        self.scan_dir: str = ""
+        # {"size", "mtime_ns", "symbols"} for every file with a parser, keyed by relative file name
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.symbols: Dict[str, Symbol] = {}
+        self.loaded: bool = False
+
+    @staticmethod
+    def register_parser(ext: str, parser: SymbolParser):
+        """Adds support for another language."""
+        SymbolIndex.parsers[ext.lower()] = parser
+
+    @staticmethod
+    def module_name(rel_filename: str) -> str:
+        """Returns the dotted module name for a file, like `agent.models` for `/agent/models.py`. A package's
+        `__init__` file is the package itself."""
+        path, _ = os.path.splitext(rel_filename.strip("/"))
+        parts: List[str] = path.split("/")
+        if parts[-1] == "__init__" and len(parts) > 1:
+            parts = parts[:-1]
+        return ".".join(parts)
+
+    def load(self, scan_dir: str):
+        """Loads the index saved for `scan_dir`, if it hasn't been loaded already."""
+        if self.loaded and self.scan_dir == scan_dir:
+            return
+        self.scan_dir = scan_dir
+        self.files = {}
+        self.loaded = True
+        if self.index_file is not None and os.path.isfile(self.index_file):
+            try:
+                with Utils.open_file(self.index_file) as file:
+                    data = json.load(file)
+                if data.get("version") == SYMBOL_INDEX_VERSION and data.get("source_folder") == scan_dir:
+                    self.files = data.get("files", {})
+            except (IOError, ValueError) as e:
+                print(f"Ignoring unreadable symbol index {self.index_file}: {e}")
+        self.symbols = {}
+        for rel_filename in sorted(self.files):
+            self.add_symbols(rel_filename)
+
+    def save(self):
+        """Writes the index, for the next process."""
+        if self.index_file is None:
+            return
+        data = {"version": SYMBOL_INDEX_VERSION, "source_folder": self.scan_dir, "files": self.files}
+        Utils.ensure_folder_exists(self.index_file)
+        Utils.write_file(self.index_file, json.dumps(data))
+
+    def add_symbols(self, rel_filename: str):
+        """Adds the symbols of a file to the lookup table. If two files define the same name the first one
+        wins."""
+        module: str = SymbolIndex.module_name(rel_filename)
+        for name, start, end in self.files[rel_filename]["symbols"]:
+            qualified: str = f"{module}.{name}"
+            if qualified not in self.symbols:
+                self.symbols[qualified] = Symbol(qualified, rel_filename, start, end)
+
+    def update(self, scan_dir: str, manifest: Dict[str, Dict[str, Any]]):
+        """Brings the index up to date with the scan manifest, parsing only the files that changed."""
+        self.load(scan_dir)
+        entries: Dict[str, Optional[Dict[str, Any]]] = {}
+        for rel_filename, entry in manifest.items():
+            if entry.get("skipped") is not None or not self.has_parser(rel_filename):
+                continue
+            indexed = self.files.get(rel_filename)
+            if indexed is None or (indexed["size"], indexed["mtime_ns"]) != (
+                entry["size"],
+                entry["mtime_ns"],
+            ):
+                entries[rel_filename] = entry
+        for rel_filename in self.files:
+            if rel_filename not in manifest or manifest[rel_filename].get("skipped") is not None:
+                entries[rel_filename] = None
+        if entries:
+            self.update_files(scan_dir, entries)
+            print(f"Symbol index: re-parsed {len(entries)} files")
+
+    def update_files(self, scan_dir: str, entries: Dict[str, Optional[Dict[str, Any]]]):
+        """Re-parses the given files, with their new manifest entries (None for files that were removed)."""
+        self.load(scan_dir)
+        cache = ContentCache.get_instance()
+        for rel_filename, entry in entries.items():
+            self.files.pop(rel_filename, None)
+            if entry is None or entry.get("skipped") is not None or not self.has_parser(rel_filename):
+                continue
+            _, ext = os.path.splitext(rel_filename)
+            try:
+                symbols = SymbolIndex.parsers[ext.lower()](cache.read_bytes(scan_dir + rel_filename))
+            except (IOError, ValueError, SyntaxError) as e:
+                print(f"Symbol index: unable to parse {rel_filename}: {e}")
+                symbols = []
+            self.files[rel_filename] = {
+                "size": entry["size"],
+                "mtime_ns": entry["mtime_ns"],
+                "symbols": symbols,
+            }
+
+        # Removing a file can uncover a symbol of the same name in another file, so we rebuild the table
+        self.symbols = {}
+        for rel_filename in sorted(self.files):
+            self.add_symbols(rel_filename)
+        self.save()
+
+    def has_parser(self, rel_filename: str) -> bool:
+        """True if we can find the symbols in the file."""
+        _, ext = os.path.splitext(rel_filename)
+        return ext.lower() in SymbolIndex.parsers
+
+    def lookup(self, name: str) -> Optional[Symbol]:
+        """Returns the symbol with the fully qualified name, if there is one."""
+        return self.symbols.get(name)
+
+    def is_current(self, symbol: Symbol) -> bool:
+        """True if the symbol's file hasn't changed since it was parsed, so its offsets can be trusted."""
+        entry = self.files.get(symbol.rel_filename)
+        try:
+            stat = os.stat(self.scan_dir + symbol.rel_filename)
+        except OSError:
+            return False
+        return entry is not None and (entry["size"], entry["mtime_ns"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        )
+
+
+def python_symbols(data: bytes) -> List[SymbolSpan]:
+    """Finds the classes, functions, and methods (including nested ones) in Python source."""
+    tree = ast.parse(data)
+    # Byte offset of the start of each line. The ast counts lines from 1.
+    line_starts: List[int] = [0, 0]
+    for line in data.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+
+    symbols: List[SymbolSpan] = []
+
+    def visit(nodes: List[ast.stmt], prefix: str):
+        for node in nodes:
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                first_line: int = min([node.lineno] + [d.lineno for d in node.decorator_list])
+                last_line: int = node.end_lineno or node.lineno
+                name: str = prefix + node.name
+                symbols.append(
+                    (name, line_starts[first_line], line_starts[min(last_line + 1, len(line_starts) - 1)])
+                )
+                visit(node.body, name + ".")
+
+    visit(tree.body, "")
+    return symbols
+
+
+SymbolIndex.register_parser(".py", python_symbols)
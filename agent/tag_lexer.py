@@ -0,0 +1,81 @@
+"""Tag Lexer Module"""
+
+import re
+from typing import NamedTuple, Optional, Tuple
+
+from agent.tags import (
+    TAG_BLOCK_BEGIN,
+    TAG_BLOCK_END,
+    TAG_BLOCK_OFF,
+    TAG_BLOCK_ON,
+    TAG_FILE_BEGIN,
+    TAG_FILE_END,
+)
+
+TAGS: Tuple[str, ...] = (
+    TAG_BLOCK_BEGIN,
+    TAG_BLOCK_END,
+    TAG_BLOCK_OFF,
+    TAG_BLOCK_ON,
+    TAG_FILE_BEGIN,
+    TAG_FILE_END,
+)
+COMMENT_PREFIXES: Tuple[str, ...] = ("-- ", "// ", "# ", "")
+
+# Every way a tag line can start. Checking these is a single C call, much cheaper than a regex.
+LINE_PREFIXES: Tuple[str, ...] = tuple(c + t for c in COMMENT_PREFIXES for t in TAGS)
+LINE_PREFIXES_BYTES: Tuple[bytes, ...] = tuple(p.encode("utf-8") for p in LINE_PREFIXES)
+
+# None of the tags is a prefix of another, so the order of the alternation doesn't matter
+TAG_LINE_PATTERN = re.compile(
+    r"(-- |// |# |)(" + "|".join(re.escape(t) for t in TAGS) + r")(.*)",
+    re.DOTALL,
+)
+
+
+class TagLine(NamedTuple):
+    """A line classified as a tag line, like `// block_begin MyBlock`"""
+
+    # The comment characters in front of the tag ("-- ", "// ", "# "), or "" if there are none
+    prefix: str
+    # One of the TAG_* constants
+    tag: str
+    # Whatever follows the tag, stripped, or None if nothing does
+    name: Optional[str]
+
+    def matches(self, tag: str, name: Optional[str]) -> bool:
+        """True if this is the given tag followed by exactly the given name (None for no name)."""
+        return self.tag == tag and self.name == name
+
+
+class TagLexer:
+    """Classifies tag lines (block_begin, block_end, block_off, block_on, file_begin, file_end) in one pass.
+
+    Most lines are not tag lines, so `lex` first does a cheap `startswith` check, and only lines that pass
+    it are run through the single precompiled regex that captures the comment prefix, the tag, and the name.
+    Like the `Utils.is_tag_line` checks this replaces, a tag only has to be at the start of the line.
+    """
+
+    @staticmethod
+    def lex(line: str) -> Optional[TagLine]:
+        """Returns the TagLine for the line, or None if it isn't a tag line. Callers that want to allow
+        indentation need to strip the line first.
+        """
+        if not line.startswith(LINE_PREFIXES):
+            return None
+
+        match = TAG_LINE_PATTERN.match(line)
+        if match is None:
+            return None
+
+        rest: str = match.group(3)
+        return TagLine(match.group(1), match.group(2), rest.strip() if rest else None)
+
+    @staticmethod
+    def lex_bytes(line: bytes) -> Optional[TagLine]:
+        """Same as `lex`, for a line of a UTF-8 file that hasn't been decoded. Only lines that pass the prefix
+        check get decoded.
+        """
+        if not line.startswith(LINE_PREFIXES_BYTES):
+            return None
+        return TagLexer.lex(line.decode("utf-8"))
@@ -0,0 +1,98 @@
+"""Counts prompt tokens, and keeps track of how many a prompt still has room for."""
+
+from typing import Dict, Optional
+
+import tiktoken
+
+# Used for models tiktoken doesn't know, such as the Anthropic ones, where it's a close enough estimate
+FALLBACK_ENCODING = "cl100k_base"
+
+# Characters per token, for estimating when no encoding can be loaded at all
+CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    """Counts tokens with the tiktoken encoding for a model. Loading an encoding is slow (and the first time
+    it's downloaded), so each one is loaded once per process and cached.
+
+    If the encoding can't be loaded (e.g. we're offline and it isn't cached yet) we fall back to estimating
+    from the number of characters, rather than failing the run.
+    """
+
+    # Encodings keyed by model name, None if it couldn't be loaded
+    encodings: Dict[str, Optional[tiktoken.Encoding]] = {}
+
+    def __init__(self, model: str):
+        self.encoding: Optional[tiktoken.Encoding] = TokenCounter.get_encoding(model)
+
+    @staticmethod
+    def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+        """Returns the (cached) encoding for the model."""
+        if model not in TokenCounter.encodings:
+            encoding: Optional[tiktoken.Encoding] = None
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+            except (IOError, ValueError) as e:
+                print(f"Unable to load a token encoding for {model}, so estimating token counts: {e}")
+            TokenCounter.encodings[model] = encoding
+        return TokenCounter.encodings[model]
+
+    def count(self, text: str) -> int:
+        """Returns the number of tokens in the text."""
+        if self.encoding is None:
+            return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        # Text from files can contain anything, including what look like special tokens
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Returns as much of the start of the text as fits in `max_tokens` tokens."""
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is None:
+            return text[: max_tokens * CHARS_PER_TOKEN]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[:max_tokens])
+
+
+class TokenBudget:
+    """How many tokens a prompt is allowed, and how many it has used so far. A limit of 0 means no limit."""
+
+    def __init__(self, counter: TokenCounter, limit: int):
+        self.counter: TokenCounter = counter
+        self.limit: int = limit
+        self.used: int = 0
+
+    def limited(self) -> bool:
+        """True if there is a limit."""
+        return self.limit > 0
+
+    def remaining(self) -> int:
+        """Returns how many tokens are left, which is negative if the limit has been exceeded."""
+        return self.limit - self.used
+
+    def fits(self, tokens: int) -> bool:
+        """True if there's room for this many more tokens."""
+        return not self.limited() or tokens <= self.remaining()
+
+    def exceeded(self) -> bool:
+        """True if more tokens were used than the limit allows."""
+        return self.limited() and self.used > self.limit
+
+    def charge(self, text: str) -> int:
+        """Counts the text against the budget, and returns its number of tokens."""
+        tokens: int = self.counter.count(text)
+        self.used += tokens
+        return tokens
+
+    def try_charge(self, text: str) -> bool:
+        """Counts the text against the budget only if there's room for all of it. Returns True if there was."""
+        tokens: int = self.counter.count(text)
+        if not self.fits(tokens):
+            return False
+        self.used += tokens
+        return True
@@ -1,12 +1,11 @@
 """Tools for updating files, creating new files, or updating blocks of text."""
 
-import os
-from typing import Dict, Optional, Type
+from typing import MutableMapping, Optional, Type
 
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import BaseTool
 from agent.models import TextBlock
-from agent.utils import Utils
+from agent.edit_transaction import EditTransaction
 
 
 class UpdateBlockInput(BaseModel):
@@ -35,7 +34,7 @@ class UpdateBlockTool(BaseTool):
     )
     args_schema: Type[BaseModel] = UpdateBlockInput
     return_direct: bool = False
-    blocks: Dict[str, TextBlock] = {}
+    blocks: MutableMapping[str, TextBlock] = {}
 
     def __init__(self, description, blocks):
         super().__init__(description=description)
@@ -54,8 +53,9 @@ class UpdateBlockTool(BaseTool):
         block: Optional[TextBlock] = self.blocks.get(block_name)
         if block is not None:
             if block.updateable:
-                block.content = block_content
-                block.dirty = True
+                # We replace the block with an edited copy (which makes it dirty), rather than editing it in
+                # place, because the block may be shared with the project index.
+                self.blocks[block_name] = block.with_content(block_content)
             else:
                 err = f"Warning: Block not updateable: {block_name}, because it has a block_off tag."
                 print(err)
@@ -86,11 +86,12 @@ class CreateFileTool(BaseTool):
     description = "useful for when you need to create a new file"
     args_schema: Type[BaseModel] = CreateFileInput
     return_direct: bool = False
-    base_path: str = ""
+    transaction: Optional[EditTransaction] = None
 
-    def __init__(self, description, base_path: str):
+    def __init__(self, description, transaction: EditTransaction):
         super().__init__(description=description)
-        self.base_path = base_path
+        # Files are only staged here, and get written when the agent run commits its edits
+        self.transaction = transaction
 
     def _run(
         self,
@@ -101,20 +102,17 @@ class CreateFileTool(BaseTool):
         msg = f"File Created: {file_name} with content: {file_content}"
         print(f"File Created: {file_name}")
 
-        if not file_name.startswith("/"):
-            file_name = "/" + file_name
-        full_file_name = self.base_path + file_name
+        assert self.transaction is not None
+        full_file_name = self.transaction.full_path(file_name)
 
         # if the file already exists print a warning message
-        if os.path.isfile(full_file_name):
+        if self.transaction.exists(full_file_name):
             # TODO: Need to investigate how the LLM and our GUI should report failures in tools to the user
             print(f"Warning: File already exists: {full_file_name}")
             # st.error(f"Error: File already exists: {full_file_name}")
         else:
-            # ensure that folder 'self.base_path' exists
-            Utils.ensure_folder_exists(full_file_name)
-            # write the content to a file only if the file currently does not exist
-            Utils.write_file(full_file_name, file_content)
+            # stage the content only if the file currently does not exist
+            self.transaction.stage_text(full_file_name, file_content)
         return msg
 
 
@@ -127,11 +125,11 @@ class UpdateFileTool(BaseTool):
     )
     args_schema: Type[BaseModel] = UpdateFileInput
     return_direct: bool = False
-    base_path = ""
+    transaction: Optional[EditTransaction] = None
 
-    def __init__(self, description, base_path: str):
+    def __init__(self, description, transaction: EditTransaction):
         super().__init__(description=description)
-        self.base_path = base_path
+        self.transaction = transaction
 
     def _run(
         self,
@@ -141,9 +139,7 @@ class UpdateFileTool(BaseTool):
         """Use the tool."""
         msg = f"File Updated: {file_name} with content: {file_content}"
         print(f"File Updated: {file_name}")
-        if not file_name.startswith("/"):
-            file_name = "/" + file_name
-        full_file_name = self.base_path + file_name
-        Utils.write_file(full_file_name, file_content)
+        assert self.transaction is not None
+        self.transaction.stage_text(self.transaction.full_path(file_name), file_content)
 
         return msg
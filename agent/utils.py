@@ -5,23 +5,12 @@ import re
 import os
 import argparse
 from enum import Enum
-from typing import List, Set, Optional
+from typing import List, Optional
 import streamlit as st
 from langchain.schema import BaseMessage, AIMessage
-from langchain.chat_models.base import BaseChatModel
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-
-from pydantic.v1.types import SecretStr
 
 from agent.app_config import AppConfig
-
-from agent.tags import (
-    TAG_FILE_BEGIN,
-    TAG_FILE_END,
-    TAG_BLOCK_BEGIN,
-    TAG_BLOCK_END,
-)
+from agent.answer_parser import AnswerParser
 
 
 class AIService(Enum):
@@ -51,6 +40,16 @@ class Utils:
 
         return ret
 
+    @staticmethod
+    def get_message_text(message: BaseMessage) -> str:
+        """Returns the text of the message, whether its content is a string or a list of parts."""
+        if isinstance(message.content, str):
+            return message.content
+        return "".join(
+            part if isinstance(part, str) else str(part.get("text", ""))
+            for part in message.content
+        )
+
     @staticmethod
     def clear_agent_state():
         """Clear all agent session state."""
@@ -78,13 +77,6 @@ class Utils:
         with Utils.open_file(filename) as file:
             return file.read()
 
-    @staticmethod
-    def should_include_file(ext_set: Set[str], file_name: str) -> bool:
-        """Returns True if the file should be included in the scan."""
-        # return file_name.endswith(tuple(AppConfig.ext_set)) # <--- AI suggested this. Didn't investigate further
-        _, ext = os.path.splitext(file_name)
-        return ext.lower() in ext_set
-
     @staticmethod
     def has_tag_lines(prompt: str, tag: str) -> bool:
         """Checks if the prompt has this tag line."""
@@ -154,18 +146,16 @@ class Utils:
             os.makedirs(directory)
 
     @staticmethod
-    def sanitize_content(cfg: argparse.Namespace, content) -> str:
-        """Makes an AI response string presentable on screen."""
-
-        # Scan all the lines in content one by one and extract the new content
-        new_content: List[str] = []
-
-        # to support blocks in blocks we use a counter to keep track of how many blocks we're in
-        started_counter: int = 0
+    def sanitize_content(
+        cfg: argparse.Namespace, content, parser: Optional[AnswerParser] = None
+    ) -> str:
+        """Makes an AI response string presentable on screen. If the `parser` that's parsing the response as it
+        streams in is given, the response so far isn't scanned again."""
 
         # of content is a string type. Note: When Anthropic is running tool calls we get here with
         # content being a list of dictionaries. We need to handle that case.
         if not isinstance(content, str):
+            new_content: List[str] = []
             # if type is a list then iteratively print the elements of the list
             if isinstance(content, list):
                 for item in content:
@@ -178,37 +168,13 @@ class Utils:
                         # else:
                         #     TODO: Right here we could print the names of the tools used.
                         #     new_content.append(str(item))
+            return "\n".join(new_content)
 
-        else:
-            for line in content.splitlines():
-                # ENDS
-                if Utils.is_tag_line(line, TAG_FILE_END):
-                    started_counter -= 1
-                elif Utils.is_tag_line(line, TAG_BLOCK_END):
-                    started_counter -= 1
-
-                # BEGINS
-                elif Utils.is_tag_line(line, TAG_FILE_BEGIN):
-                    name: Optional[str] = Utils.parse_name_from_tag_line(
-                        line, TAG_FILE_BEGIN
-                    )
-                    started_counter += 1
-                    if started_counter == 1:
-                        new_content.append(f"File Updated: {name}")
-
-                elif Utils.is_tag_line(line, TAG_BLOCK_BEGIN):
-                    name: Optional[str] = Utils.parse_name_from_tag_line(
-                        line, TAG_BLOCK_BEGIN
-                    )
-                    started_counter += 1
-                    if started_counter == 1:
-                        new_content.append(f"Code Block Updated: {name}")
-
-                elif started_counter == 0:
-                    new_content.append(line)
-
-        ret: str = "\n".join(new_content)
-        return ret
+        if parser is None:
+            parser = AnswerParser()
+            parser.feed(content)
+            parser.close()
+        return parser.display_text()
 
     @staticmethod
     def setup_page(st, cfg: argparse.Namespace, title: str):
@@ -274,31 +240,3 @@ class Utils:
                 title = part
             else:
                 st.image(part)  # Add caption if you want -> , caption=title)
-
-    # Need to make cfg typesafe so we can get rid of all the `type: ignore` comments
-    @staticmethod
-    def create_llm(
-        cfg,
-        ai_service: str,
-        temperature: float,
-    ) -> BaseChatModel:
-        """Creates a language model based on the AI service."""
-        if ai_service == AIService.OPENAI.value:
-            print("Creating OpenAI service")
-            llm = ChatOpenAI(
-                model=cfg.openai_model,
-                temperature=temperature,
-                api_key=cfg.openai_api_key,
-                verbose=True,
-            )
-        elif ai_service == AIService.ANTHROPIC.value:
-            print("Creating Anthropic service")
-            llm = ChatAnthropic(
-                model_name=cfg.anth_model,
-                temperature=temperature,
-                timeout=60,  # timeout in seconds
-                api_key=SecretStr(cfg.anth_api_key),
-            )
-        else:
-            Utils.fail_app(f"Invalid AI Service: {ai_service}")
-        return llm
@@ -8,6 +8,8 @@ from langchain.chat_models.base import BaseChatModel
 
 
 from agent.app_config import AppConfig
+from agent.llm_clients import LLMClients
+from agent.stream_handler import StreamHandler
 from agent.utils import Utils
 
 
@@ -44,11 +46,18 @@ class AppChatbotGUI:
                 return
 
             st.session_state.p_chatbot_messages.append(HumanMessage(content=user_input))
-            with st.spinner("Thinking..."):
-                llm: BaseChatModel = Utils.create_llm(
-                    self.cfg, st.session_state.p_ai_service, 0.7
-                )
-                response = llm.invoke(list(st.session_state.p_chatbot_messages))
+            # The answer is shown here as it streams in
+            placeholder = st.empty()
+            placeholder.caption("Thinking...")
+            handler = StreamHandler(on_text=lambda text: placeholder.markdown(text))
+            llm: BaseChatModel = LLMClients.create_llm(
+                self.cfg, st.session_state.p_ai_service, 0.7, streaming=True
+            )
+            response = llm.invoke(
+                list(st.session_state.p_chatbot_messages), {"callbacks": [handler]}
+            )
+            print(handler.finish().summary())
+            placeholder.empty()
 
             st.session_state.p_chatbot_messages.append(
                 AIMessage(content=response.content)
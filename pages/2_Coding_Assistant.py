@@ -7,6 +7,8 @@ from langchain.schema import HumanMessage, AIMessage, BaseMessage
 
 from agent.app_agent import QuantaAgent
 from agent.app_config import AppConfig
+from agent.index_service import IndexService
+from agent.edit_transaction import EditTransaction
 from agent.prompt_utils import PromptUtils
 from agent.utils import Utils
 
@@ -28,25 +30,39 @@ class AppAgentGUI:
         # handle user input
         user_input = st.session_state.p_agent_user_input
         if user_input:
-            with st.spinner("Thinking..."):
-                agent = QuantaAgent()
-                agent.run(
-                    st.session_state.p_ai_service,
-                    st,
-                    st.session_state.p_mode,
-                    "",
-                    st.session_state.p_agent_messages,
-                    user_input,
-                    0.0,  # Use zero temp for code refactoring
-                )
+            # The answer is shown here as it streams in
+            placeholder = st.empty()
+            placeholder.caption("Thinking...")
+            agent = QuantaAgent()
+            agent.run(
+                st.session_state.p_ai_service,
+                st,
+                st.session_state.p_mode,
+                "",
+                st.session_state.p_agent_messages,
+                user_input,
+                0.0,  # Use zero temp for code refactoring
+                not st.session_state.get("p_bypass_cache", False),
+                lambda text: placeholder.markdown(
+                    Utils.sanitize_content(self.cfg, text, agent.parser)
+                ),
+            )
+            # The answer is in the message history now
+            placeholder.empty()
+
+            if agent.timing is not None:
+                st.session_state.p_query_timing = agent.timing.summary()
 
-                if not st.session_state.p_source_provided:
-                    st.error(
-                        "Warning: No files, folders, or blocks were provided to the AI. "
-                        + "See `Helpful Tips` section below to learn how to provide code context."
-                    )
-                else:
-                    st.session_state.p_agent_user_input = ""
+            if agent.commit_stats is not None:
+                st.session_state.p_commit_summary = agent.commit_stats.summary()
+
+            if not st.session_state.p_source_provided:
+                st.error(
+                    "Warning: No files, folders, or blocks were provided to the AI. "
+                    + "See `Helpful Tips` section below to learn how to provide code context."
+                )
+            else:
+                st.session_state.p_agent_user_input = ""
 
     def show_messages(self):
         """display message history"""
@@ -80,6 +96,42 @@ class AppAgentGUI:
                 st.form_submit_button("Ask AI", on_click=self.ask_ai)
             with col2:
                 st.form_submit_button("Clear", on_click=Utils.clear_agent_state)
+            st.checkbox(
+                "Bypass the response cache (ask the AI again, even if it already answered this exact query)",
+                key="p_bypass_cache",
+            )
+
+    def show_index_status(self):
+        """Show how fresh the project index is, when the index service is enabled."""
+        status = IndexService.get_instance(self.cfg).status()
+        st.caption(
+            f"Project Index: version {status.version}, {status.file_count} files, {status.block_count} blocks, "
+            + f"updated {status.age_seconds:.1f}s ago, last event lag {status.last_event_lag_ms:.0f} ms, "
+            + f"{status.events_pending} events pending"
+        )
+        for error in status.errors:
+            st.error(f"Index Error: {error}")
+
+    def undo_last_run(self):
+        """Puts back the files the last agent run edited."""
+        journal_folder = f"{self.cfg.data_folder}/journal"
+        run_id = EditTransaction.last_run(journal_folder)
+        if run_id is not None:
+            st.session_state.p_undo_problems = EditTransaction.undo(
+                self.cfg.source_folder, journal_folder, run_id
+            )
+        st.session_state.p_commit_summary = ""
+
+    def show_undo(self):
+        """Show what the last agent run wrote, and a button to undo it."""
+        summary = st.session_state.get("p_commit_summary", "")
+        for problem in st.session_state.get("p_undo_problems", []):
+            st.warning(f"Undo: {problem}")
+        st.session_state.p_undo_problems = []
+
+        if summary and EditTransaction.last_run(f"{self.cfg.data_folder}/journal") is not None:
+            st.caption(summary)
+            st.button("Undo Last Edits", on_click=self.undo_last_run)
 
     def run(self):
         """Main function for the Streamlit GUI."""
@@ -87,6 +139,12 @@ class AppAgentGUI:
 
         self.show_messages()
         self.show_form()
+        if st.session_state.get("p_query_timing", ""):
+            st.caption(st.session_state.p_query_timing)
+        self.show_undo()
+
+        if self.cfg.index_service:
+            self.show_index_status()
 
         with st.expander("Helpful Tips. Read this first!"):
             st.markdown(PromptUtils.get_template("config/agent_chat_tips.txt"))
@@ -22,6 +22,7 @@ class Settings:
 * Extensiont to include: {cfg.scan_extensions}
 * Default Update Mode: {cfg.mode}
 * Max Prompt Length: {cfg.max_prompt_length}
+* Scan Workers: {cfg.scan_workers} ({cfg.scan_pool})
 """
 
     def run(self):
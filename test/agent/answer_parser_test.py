@@ -0,0 +1,52 @@
+from agent.answer_parser import AnswerParser, AnswerSection
+from agent.utils import Utils
+
+ANSWER = """Here are the changes:
+file_begin /src/a.py
+# block_begin Inner
+a = 1
+# block_end
+file_end /src/a.py
+block_begin Outer
+block_begin Nested
+x
+block_end
+block_end
+file_begin /src/b.py
+b = 2"""
+
+
+class TestAnswerParser:
+    @staticmethod
+    def test_sections_end_as_they_arrive():
+        sections = []
+        parser = AnswerParser(sections.append)
+        fed = ""
+        # Tiny chunks, like tokens, that split lines anywhere
+        for i in range(0, len(ANSWER), 3):
+            parser.feed(ANSWER[i : i + 3])
+            fed += ANSWER[i : i + 3]
+            # Each section is handed over once its end tag line is complete, not later
+            assert len(sections) == fed.count("_end /src/a.py\n") + fed.count("block_end\nblock_end\n")
+        parser.close()
+
+        assert sections == [
+            AnswerSection("file_begin", "/src/a.py", ["# block_begin Inner", "a = 1", "# block_end"]),
+            AnswerSection("block_begin", "Outer", ["block_begin Nested", "x", "block_end"]),
+            # A missing file_end runs to the end of the answer
+            AnswerSection("file_begin", "/src/b.py", ["b = 2"]),
+        ]
+        assert sections[0].content == "# block_begin Inner\na = 1\n# block_end"
+
+    @staticmethod
+    def test_display_text():
+        expected = "Here are the changes:\nFile Updated: /src/a.py\nCode Block Updated: Outer\nFile Updated: /src/b.py"
+        assert Utils.sanitize_content(None, ANSWER) == expected
+
+        # A parser that has seen the answer gives the same thing without it being scanned again
+        parser = AnswerParser()
+        parser.feed("Here are")
+        assert Utils.sanitize_content(None, "", parser) == "Here are"
+        parser.feed(ANSWER[len("Here are") :])
+        parser.close()
+        assert Utils.sanitize_content(None, "", parser) == expected
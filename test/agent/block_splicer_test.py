@@ -0,0 +1,42 @@
+from agent.block_splicer import BlockSplicer
+
+
+class TestBlockSplicer:
+    @staticmethod
+    def test_splice_replaces_all_blocks_in_one_pass():
+        data = (
+            b"start\r\n"
+            b"# block_begin One\r\n"
+            b"old 1\r\n"
+            b"# block_end\r\n"
+            b"middle\r\n"
+            b"// block_begin Two\r\n"
+            b"old 2\r\n"
+            b"// block_end\r\n"
+            b"block_begin Three\r\n"
+            b"block_end\r\n"
+            b"end"
+        )
+        new_data, replaced = BlockSplicer.splice(
+            data, {"One": "new 1\nmore", "Two": "new 2\n", "Three": "x"}
+        )
+        assert replaced == {"One", "Two"}
+        # Line endings are kept, and tags outside comments are left alone
+        assert new_data == (
+            b"start\r\n"
+            b"# block_begin One\r\n"
+            b"new 1\r\nmore\r\n"
+            b"# block_end\r\n"
+            b"middle\r\n"
+            b"// block_begin Two\r\n"
+            b"new 2\r\n"
+            b"// block_end\r\n"
+            b"block_begin Three\r\n"
+            b"block_end\r\n"
+            b"end"
+        )
+
+    @staticmethod
+    def test_unterminated_block_is_left_alone():
+        data = b"# block_begin One\nold\n"
+        assert BlockSplicer.splice(data, {"One": "new"}) == (data, set())
@@ -0,0 +1,44 @@
+import os
+
+from agent.content_cache import ContentCache
+
+
+def write(path: str, data: bytes, mtime_ns: int):
+    with open(path, "wb") as file:
+        file.write(data)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+class TestContentCache:
+    @staticmethod
+    def test_hits_misses_and_changes(tmp_path):
+        path = str(tmp_path / "a.py")
+        write(path, b"a = 1\r\n", 1_000_000_000)
+        cache = ContentCache(1000)
+
+        assert cache.read_text(path) == "a = 1\n"
+        assert cache.read_bytes(path) == b"a = 1\r\n"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # A new modification time means the file gets read again
+        write(path, b"a = 2\r\n", 2_000_000_000)
+        assert cache.read_bytes(path) == b"a = 2\r\n"
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        write(path, b"s = '\xe9'\n", 3_000_000_000)
+        assert cache.try_read_text(path) is None
+
+    @staticmethod
+    def test_least_recently_used_are_evicted(tmp_path):
+        paths = [str(tmp_path / f"{i}.py") for i in range(3)]
+        for path in paths:
+            write(path, b"x" * 40, 1_000_000_000)
+        cache = ContentCache(100)
+
+        cache.read_bytes(paths[0])
+        cache.read_bytes(paths[1])
+        cache.read_bytes(paths[0])
+        # Only two files fit, so the one used longest ago goes
+        cache.read_bytes(paths[2])
+        assert list(cache.entries) == [paths[0], paths[2]]
+        assert (cache.total_bytes, cache.evictions) == (80, 1)
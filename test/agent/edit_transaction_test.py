@@ -0,0 +1,54 @@
+import os
+
+from agent.edit_transaction import EditTransaction
+
+
+class TestEditTransaction:
+    @staticmethod
+    def test_commit_and_undo(tmp_path):
+        source = str(tmp_path / "src")
+        journal = str(tmp_path / "journal")
+        os.makedirs(source)
+        with open(source + "/a.py", "wb") as file:
+            file.write(b"a = 1\r\n")
+
+        tx = EditTransaction(source, journal, "100")
+        tx.stage_text(tx.full_path("a.py"), "a = 2\n")
+        tx.stage_text(tx.full_path("/b/c.py"), "c = 3\n")
+        # Nothing is written until the commit
+        assert not os.path.exists(source + "/b/c.py")
+        assert tx.read(source + "/b/c.py") == b"c = 3\n"
+
+        stats = tx.commit()
+        assert (stats.files_written, stats.bytes_written) == (2, 12)
+        with open(source + "/a.py", "rb") as file:
+            assert file.read() == b"a = 2\n"
+
+        assert EditTransaction.last_run(journal) == "100"
+        assert EditTransaction.undo(source, journal, "100") == []
+        with open(source + "/a.py", "rb") as file:
+            assert file.read() == b"a = 1\r\n"
+        assert not os.path.exists(source + "/b/c.py")
+        assert EditTransaction.last_run(journal) is None
+
+    @staticmethod
+    def test_commit_keeps_mode_and_symlinks(tmp_path):
+        source = str(tmp_path / "src")
+        os.makedirs(source)
+        with open(source + "/run.sh", "wb") as file:
+            file.write(b"echo 1\n")
+        os.chmod(source + "/run.sh", 0o755)
+        with open(source + "/target.py", "wb") as file:
+            file.write(b"x = 1\n")
+        os.symlink("target.py", source + "/link.py")
+
+        tx = EditTransaction(source, str(tmp_path / "journal"), "100")
+        tx.stage_text(tx.full_path("run.sh"), "echo 2\n")
+        tx.stage_text(tx.full_path("link.py"), "x = 2\n")
+        tx.commit()
+
+        assert os.stat(source + "/run.sh").st_mode & 0o777 == 0o755
+        assert os.path.islink(source + "/link.py")
+        with open(source + "/target.py", "rb") as file:
+            assert file.read() == b"x = 2\n"
+        assert sorted(os.listdir(source)) == ["link.py", "run.sh", "target.py"]
@@ -0,0 +1,97 @@
+import time
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from agent.hedging import HedgedQuery, LatencyStats
+from agent.stream_handler import StreamHandler
+
+
+class SlowChatModel(BaseChatModel):
+    """Streams its answer a word at a time, after a delay, like a service that's slow to start."""
+
+    answer: str
+    first_token_seconds: float
+    token_seconds: float = 0.01
+    fail: bool = False
+    tokens_sent: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "slow"
+
+    def _generate(
+        self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any
+    ) -> ChatResult:
+        time.sleep(self.first_token_seconds)
+        if self.fail:
+            raise ValueError("service unavailable")
+        for word in self.answer.split(" "):
+            if run_manager is not None:
+                run_manager.on_llm_new_token(word + " ")
+            self.tokens_sent.append(word)
+            time.sleep(self.token_seconds)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+
+QUESTION = [HumanMessage(content="question")]
+
+
+class TestHedging:
+    @staticmethod
+    def test_backup_wins_when_primary_is_slow():
+        slow = SlowChatModel(answer="one two three four five six", first_token_seconds=0.3)
+        fast = SlowChatModel(answer="backup answer", first_token_seconds=0.0)
+        handler = StreamHandler()
+        result = HedgedQuery([("openai", slow), ("anth", fast)], 0.05).run(QUESTION, handler)
+
+        assert (result.service, result.message.content, result.hedged) == ("anth", "backup answer", True)
+        assert handler.text() == "backup answer \n"
+        # The slow one is cancelled at its first token
+        time.sleep(0.4)
+        assert len(slow.tokens_sent) <= 1
+
+    @staticmethod
+    def test_no_hedge_when_primary_starts_in_time():
+        primary = SlowChatModel(answer="primary answer", first_token_seconds=0.0, token_seconds=0.1)
+        backup = SlowChatModel(answer="backup answer", first_token_seconds=0.0)
+        result = HedgedQuery([("openai", primary), ("anth", backup)], 0.05).run(QUESTION, StreamHandler())
+
+        # The answer took longer than the delay, but its first token didn't
+        assert (result.service, result.hedged) == ("openai", False)
+        assert backup.tokens_sent == []
+
+    @staticmethod
+    def test_failure_sends_backup_right_away():
+        broken = SlowChatModel(answer="", first_token_seconds=0.0, fail=True)
+        backup = SlowChatModel(answer="backup answer", first_token_seconds=0.0)
+        start = time.perf_counter()
+        result = HedgedQuery([("openai", broken), ("anth", backup)], 5.0).run(QUESTION, StreamHandler())
+        assert result.service == "anth" and time.perf_counter() - start < 1.0
+
+    @staticmethod
+    def test_slow_primary_still_gets_latencies():
+        stats = LatencyStats()
+        for _ in range(3):
+            slow = SlowChatModel(answer="slow answer", first_token_seconds=0.3)
+            fast = SlowChatModel(answer="backup answer", first_token_seconds=0.0)
+            result = HedgedQuery([("openai", slow), ("anth", fast)], 0.05).run(QUESTION, StreamHandler())
+            assert result.service == "anth"
+            assert [service for service, _ in result.cancelled] == ["openai"]
+            stats.record_result(result)
+
+        # The primary never won, but how long it ran before it lost still counts, as at least the delay
+        assert stats.percentile("openai", 50) >= 50
+        assert stats.percentile("anth", 50) < stats.percentile("openai", 50)
+        assert stats.summary().splitlines()[1].endswith("(3 queries, 3 cancelled)")
+
+    @staticmethod
+    def test_percentiles():
+        stats = LatencyStats()
+        for ms in range(100, 0, -1):
+            stats.record("openai", float(ms))
+        assert [stats.percentile("openai", p) for p in (50, 95, 99, 100)] == [50.0, 95.0, 99.0, 100.0]
+        assert stats.percentile("anth", 95) is None
+        assert stats.summary() == "Latency of openai: p50 50 ms, p95 95 ms, p99 99 ms (100 queries)"
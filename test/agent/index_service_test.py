@@ -0,0 +1,152 @@
+import os
+import time
+import shutil
+import argparse
+
+import pytest
+
+from agent.app_config import AppConfig
+from agent.index_service import IndexService
+from agent.models import BlockOverlay, ProjectChangedError
+
+
+def write(path: str, name: str, body: str = "x = 1"):
+    """Writes a Python file holding one block."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(f"# block_begin {name}\n{body}\n# block_end\n")
+
+
+def create_service(tmp_path) -> IndexService:
+    """Creates the service for a project in tmp_path, and does the initial scan, without watching for events."""
+    cfg = argparse.Namespace(
+        source_folder=str(tmp_path / "prj"),
+        data_folder=str(tmp_path / "data"),
+        scan_workers=0,
+        scan_pool="thread",
+        max_scan_file_size=2000000,
+        auto_context=False,
+        symbol_index=False,
+    )
+    service = IndexService(cfg)
+    with service.lock:
+        service.loader.scan_directory(service.source_folder)
+        service.publish()
+    return service
+
+
+class TestIndexService:
+    @staticmethod
+    def test_applies_events(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        write(root + "/a.py", "A")
+        write(root + "/b.py", "B")
+        service = create_service(tmp_path)
+        loader = service.loader
+        assert sorted(loader.blocks) == ["A", "B"]
+
+        write(root + "/new.py", "New")
+        assert service.apply_event("created", root + "/new.py", None, False)
+        assert loader.blocks["New"].rel_filename == "/new.py"
+
+        write(root + "/a.py", "A", "x = 2")
+        assert service.apply_event("modified", root + "/a.py", None, False)
+        assert loader.blocks["A"].content == "x = 2\n"
+
+        os.remove(root + "/b.py")
+        assert service.apply_event("deleted", root + "/b.py", None, False)
+        assert "B" not in loader.blocks
+
+        os.makedirs(root + "/sub")
+        os.rename(root + "/new.py", root + "/sub/moved.py")
+        assert service.apply_event("moved", root + "/new.py", root + "/sub/moved.py", False)
+        assert loader.blocks["New"].rel_filename == "/sub/moved.py"
+        assert loader.blocks["New"].content == "x = 1\n"
+
+        # A file type that isn't part of the project changes nothing
+        with open(root + "/notes.txt", "w", encoding="utf-8") as file:
+            file.write("notes")
+        assert not service.apply_event("created", root + "/notes.txt", None, False)
+
+        shutil.rmtree(root + "/sub")
+        assert service.apply_event("deleted", root + "/sub", None, True)
+        assert sorted(loader.blocks) == ["A"]
+        assert sorted(loader.manifest) == ["/a.py"]
+        assert loader.file_names == ["/a.py"]
+        assert "/sub" not in loader.folder_names
+
+        with service.lock:
+            service.publish()
+        snapshot = service.get_snapshot()
+        assert (snapshot.version, list(snapshot.blocks), snapshot.file_names) == (2, ["A"], ("/a.py",))
+
+    @staticmethod
+    def test_old_snapshot_does_not_read_new_content(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        write(root + "/a.py", "A")
+        service = create_service(tmp_path)
+        old = service.get_snapshot()
+        assert old.blocks["A"].content == "x = 1\n"
+
+        # The new content is longer, so the old offsets would cut it in the wrong place
+        write(root + "/a.py", "A", "value = 'changed'")
+        with service.lock:
+            assert service.apply_event("modified", root + "/a.py", None, False)
+            service.publish()
+
+        with pytest.raises(ProjectChangedError):
+            old.blocks["A"].content
+        assert service.get_snapshot().blocks["A"].content == "value = 'changed'\n"
+
+    @staticmethod
+    def test_failed_batch_is_reported(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        write(root + "/a.py", "A")
+        service = create_service(tmp_path)
+
+        def fail(*args):
+            raise ValueError("bad event")
+
+        write(root + "/b.py", "B")
+        with monkeypatch.context() as patch:
+            patch.setattr(service, "apply_event", fail)
+            service.apply_batch([("created", root + "/b.py", None, False, time.time())])
+        assert service.status().errors == ["Index Service: failed to apply 1 events: bad event"]
+
+        # The next batch is applied as usual
+        service.apply_batch([("created", root + "/b.py", None, False, time.time())])
+        assert sorted(service.get_snapshot().blocks) == ["A", "B"]
+        assert service.status().events_applied == 2
+
+    @staticmethod
+    def test_snapshots_copy_only_what_changed(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        for i in range(8):
+            write(root + f"/m{i}.py", f"B{i}")
+        service = create_service(tmp_path)
+        blocks = service.loader.blocks
+        assert isinstance(blocks, BlockOverlay)
+        first = service.get_snapshot()
+
+        # Two changes are a quarter of the blocks, which are still shared rather than copied
+        write(root + "/m0.py", "B0", "x = 2")
+        service.apply_batch([("modified", root + "/m0.py", None, False, time.time())])
+        os.remove(root + "/m1.py")
+        service.apply_batch([("deleted", root + "/m1.py", None, False, time.time())])
+        assert service.loader.blocks is blocks and sorted(blocks.changes) == ["B0"]
+        second = service.get_snapshot()
+        assert len(second.blocks) == 7 and second.blocks["B0"].content == "x = 2\n"
+
+        # A third is too many, so they're all copied and the overlay starts over
+        write(root + "/m2.py", "B2", "x = 2")
+        service.apply_batch([("modified", root + "/m2.py", None, False, time.time())])
+        assert service.loader.blocks is not blocks and not service.loader.blocks.changes
+        assert sorted(service.get_snapshot().blocks) == ["B0", "B2", "B3", "B4", "B5", "B6", "B7"]
+
+        # Older snapshots keep the blocks they had
+        assert len(first.blocks) == 8 and "B1" in first.blocks
+        assert second.blocks["B2"] is first.blocks["B2"]
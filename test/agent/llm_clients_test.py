@@ -0,0 +1,119 @@
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.messages import HumanMessage
+
+from agent.llm_clients import LLMClients
+
+OPENAI_ANSWER = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-test",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+OPENAI_CHUNKS = [
+    {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+    }
+    for delta, reason in (({"role": "assistant", "content": "hi"}, None), ({}, "stop"))
+]
+
+ANTHROPIC_ANSWER = {
+    "id": "msg_1",
+    "type": "message",
+    "role": "assistant",
+    "model": "claude-test",
+    "content": [{"type": "text", "text": "hello"}],
+    "stop_reason": "end_turn",
+    "stop_sequence": None,
+    "usage": {"input_tokens": 1, "output_tokens": 1},
+}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers like the AI services do, and counts the connections it gets."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        StandInHandler.connections += 1
+
+    def send(self, body: bytes, content_type: str = "application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/messages"):
+            self.send(json.dumps(ANTHROPIC_ANSWER).encode("utf-8"))
+        elif request.get("stream"):
+            events = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in OPENAI_CHUNKS) + "data: [DONE]\n\n"
+            self.send(events.encode("utf-8"), "text/event-stream")
+        else:
+            self.send(json.dumps(OPENAI_ANSWER).encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestLLMClients:
+    @staticmethod
+    def test_reuses_connections(monkeypatch):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        cfg = argparse.Namespace(
+            openai_model="gpt-test",
+            anth_model="claude-test",
+            openai_api_key="key",
+            anth_api_key="key",
+            openai_base_url=url + "/v1",
+            anth_base_url=url,
+            llm_timeout=10,
+            llm_clients=2,
+            prompt_cache=True,
+        )
+        clients = LLMClients()
+        monkeypatch.setattr(LLMClients, "instance", clients)
+        StandInHandler.connections = 0
+        question = [HumanMessage(content="question")]
+        try:
+            # Warming opens the connection before the first query
+            thread = clients.warm(cfg, "openai")
+            assert thread is not None
+            thread.join()
+            assert StandInHandler.connections == 1
+            assert clients.warm(cfg, "openai") is None
+
+            for temperature in (0.0, 0.0, 0.7, 0.0):
+                llm = LLMClients.create_llm(cfg, "openai", temperature, streaming=temperature > 0)
+                assert llm.invoke(question).content == "hi"
+            assert LLMClients.create_llm(cfg, "anth", 0.0).invoke(question).content == "hello"
+
+            # One connection per service, however many queries and models there were
+            assert StandInHandler.connections == 2
+            # A model for each temperature was created once (warming created the first), and the oldest was dropped
+            assert (clients.created, clients.reused, len(clients.models)) == (3, 4, 2)
+        finally:
+            clients.close()
+            server.shutdown()
+            server.server_close()
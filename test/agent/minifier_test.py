@@ -0,0 +1,33 @@
+from agent.minifier import ContentMinifier
+from agent.token_budget import TokenCounter
+
+LICENSE = "# Copyright Example\n# Licensed under MIT\n# See LICENSE\n\n"
+
+
+class TestContentMinifier:
+    @staticmethod
+    def test_replaces_duplicates_and_headers(monkeypatch):
+        monkeypatch.setitem(TokenCounter.encodings, "estimate", None)
+        minifier = ContentMinifier({"duplicates", "headers"}, TokenCounter("estimate"))
+
+        assert minifier.minify("/a.py", LICENSE + "a = 1\n") == LICENSE + "a = 1\n"
+        assert minifier.minify("/b.py", LICENSE + "b = 2\n") == "(same header as /a.py)\nb = 2\n"
+        assert minifier.minify("/c.py", LICENSE + "a = 1\n") == "(identical to /a.py)"
+        assert minifier.tokens_saved > 0
+
+    @staticmethod
+    def test_strips_comments_but_keeps_tags():
+        minifier = ContentMinifier({"comments", "whitespace"})
+        content = (
+            "/* header\n   more */\nlet a = 1; // trailing\n\n\n"
+            + "// block_begin MyBlock\nlet b = 2;   \n// block_end\n// note\n"
+        )
+        assert minifier.minify("/x.js", content) == (
+            "let a = 1; // trailing\n\n// block_begin MyBlock\nlet b = 2;\n// block_end"
+        )
+
+    @staticmethod
+    def test_refactoring_only_dedupes():
+        minifier = ContentMinifier.for_mode(["comments", "duplicates", "bogus"], True, None)
+        assert minifier is not None and minifier.stages == {"duplicates"}
+        assert ContentMinifier.for_mode(["whitespace"], True, None) is None
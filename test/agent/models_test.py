@@ -0,0 +1,54 @@
+import os
+from types import MappingProxyType
+
+import pytest
+
+from agent.models import BlockOverlay, FileTable, ProjectChangedError, TextBlock
+
+
+class TestBlockOverlay:
+    @staticmethod
+    def test_edits_stay_in_the_overlay():
+        files = FileTable("")
+        file_id = files.add("/a.py", (0, 0))
+        shared = MappingProxyType(
+            {name: TextBlock(files, file_id, name, 0, 0) for name in ("one", "two")}
+        )
+        overlay = BlockOverlay(shared)
+
+        overlay["one"] = shared["one"].with_content("edited")
+        overlay["three"] = TextBlock(files, file_id, "three", 0, 0)
+        del overlay["two"]
+
+        assert overlay["one"].content == "edited"
+        assert not shared["one"].dirty
+        assert "two" in shared and "two" not in overlay
+        assert list(overlay) == ["one", "three"]
+        assert len(overlay) == 2
+        assert overlay.dirty_blocks() == [overlay["one"]]
+
+
+class TestFileTable:
+    @staticmethod
+    def test_block_of_changed_file_is_not_read(tmp_path):
+        path = tmp_path / "a.py"
+        path.write_text("# caf\u00e9\nx = 1\n", encoding="utf-8")
+        stat = os.stat(path)
+        files = FileTable(str(tmp_path))
+        block = TextBlock(files, files.add("/a.py", (stat.st_size, stat.st_mtime_ns)), "b", 8, 14)
+        assert block.content == "x = 1\n"
+
+        # An offset that now lands inside a multi-byte character would fail to decode, or read the wrong text
+        path.write_text("# \u00e9\u00e9\u00e9\u00e9\u00e9\nx = 1\n", encoding="utf-8")
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        with pytest.raises(ProjectChangedError):
+            block.content
+
+        # Scanning the new version gives it a new id, and the old block still knows it's stale
+        stat = os.stat(path)
+        assert files.add("/a.py", (stat.st_size, stat.st_mtime_ns)) != block.file_id
+        with pytest.raises(ProjectChangedError):
+            block.content
+        path.unlink()
+        with pytest.raises(ProjectChangedError):
+            block.content
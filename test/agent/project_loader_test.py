@@ -0,0 +1,121 @@
+import os
+
+from agent.app_config import AppConfig
+from agent.project_loader import ProjectLoader
+from agent.tag_lexer import TagLexer
+
+
+def write(root: str, rel_filename: str, data: bytes):
+    """Writes a file of the project, making its folder if needed."""
+    path = root + rel_filename
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def block(name: str, body: str = "x = 1") -> bytes:
+    """A Python file holding one block."""
+    return f"# block_begin {name}\n{body}\n# block_end\n".encode("utf-8")
+
+
+def touch(path: str):
+    """Moves the modification time of the file forward, without changing its content."""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+class TestProjectLoader:
+    @staticmethod
+    def test_rescan_reuses_unchanged_files(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        manifest = str(tmp_path / "data/scan_manifest.json")
+        write(root, "/a.py", block("A"))
+        write(root, "/b.py", block("B"))
+        write(root, "/c.py", block("C"))
+
+        loader = ProjectLoader(None, len(root), manifest)
+        loader.scan_directory(root)
+        assert (loader.stats.files_parsed, loader.stats.files_reused) == (3, 0)
+
+        # Nothing changed, so every file's blocks come from the manifest
+        loader = ProjectLoader(None, len(root), manifest)
+        loader.scan_directory(root)
+        assert (loader.stats.files_parsed, loader.stats.files_reused) == (0, 3)
+
+        # Only the edited file is read again. The touched one has the same hash, so it isn't parsed.
+        write(root, "/a.py", block("A", "x = 2"))
+        touch(root + "/b.py")
+        loader = ProjectLoader(None, len(root), manifest)
+        loader.scan_directory(root)
+        assert (loader.stats.files_parsed, loader.stats.files_reused) == (1, 2)
+        assert loader.blocks["A"].content == "x = 2\n"
+        assert loader.blocks["B"].content == "x = 1\n"
+
+        # The touched file's new modification time was saved, so it's trusted without hashing next time
+        assert loader.new_manifest["/b.py"]["mtime_ns"] == os.stat(root + "/b.py").st_mtime_ns
+        loader = ProjectLoader(None, len(root), manifest)
+        loader.scan_directory(root)
+        assert (loader.stats.files_parsed, loader.stats.files_reused) == (0, 3)
+        assert not loader.manifest_dirty
+
+    @staticmethod
+    def test_parallel_scan_matches_serial(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        for i in range(20):
+            write(root, f"/pkg{i % 3}/m{i:02}.py", block(f"B{i:02}") + block(f"C{i:02}"))
+        # The same block name in two files, which must be reported for the same file every time
+        write(root, "/pkg0/dup.py", block("B05"))
+
+        results = []
+        for workers, pool in ((0, "thread"), (4, "thread"), (4, "process")):
+            loader = ProjectLoader(None, len(root), scan_workers=workers, scan_pool=pool, collect_errors=True)
+            loader.scan_directory(root)
+            results.append(
+                (
+                    [(name, b.rel_filename, b.start, b.end) for name, b in loader.blocks.items()],
+                    loader.file_names,
+                    loader.errors,
+                )
+            )
+
+        assert results[1] == results[0] and results[2] == results[0]
+        blocks, _, errors = results[0]
+        assert len(blocks) == 40
+        assert errors == ["Duplicate Block Name B05. Block Names must be unique across all files."]
+        # The first one found in walk order is kept
+        assert dict((name, rel) for name, rel, _, _ in blocks)["B05"] == "/pkg0/dup.py"
+
+    @staticmethod
+    def test_skips_files_that_are_not_text(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        write(root, "/binary.py", b"\0\1\2" + block("Binary"))
+        write(root, "/big.py", block("Big", "x = 1" * 100))
+        write(root, "/latin1.py", block("Latin", "s = '\xe9'").replace(b"\xc3\xa9", b"\xe9"))
+        write(root, "/plain.py", b"x = 1\n" * 20)
+        # Without tags it isn't parsed, but still has to be text its content can go into prompts as
+        write(root, "/plain_latin1.py", b"s = '\xe9'\n")
+        write(root, "/tagged.py", block("Tagged"))
+
+        # Every line the lexer sees
+        lexed = []
+        lex_bytes = TagLexer.lex_bytes
+        monkeypatch.setattr(TagLexer, "lex_bytes", lambda line: lexed.append(line) or lex_bytes(line))
+
+        loader = ProjectLoader(None, len(root), max_file_size=200)
+        loader.scan_directory(root)
+        assert loader.file_names == ["/plain.py", "/tagged.py"]
+        assert list(loader.blocks) == ["Tagged"]
+        assert {rel: entry.get("skipped") for rel, entry in loader.new_manifest.items()} == {
+            "/big.py": "larger than 200 bytes",
+            "/binary.py": "binary file",
+            "/latin1.py": "not UTF-8 encoded",
+            "/plain.py": None,
+            "/plain_latin1.py": "not UTF-8 encoded",
+            "/tagged.py": None,
+        }
+        assert (loader.stats.files_skipped, loader.stats.files_untagged, loader.stats.files_parsed) == (4, 1, 1)
+        # Only the lines of the tagged file were lexed
+        assert lexed == [b"# block_begin Tagged", b"x = 1", b"# block_end"]
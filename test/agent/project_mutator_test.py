@@ -0,0 +1,66 @@
+import os
+
+from agent.app_config import AppConfig
+from agent.edit_transaction import EditTransaction
+from agent.project_mutator import ProjectMutator
+
+
+class TestProjectMutator:
+    @staticmethod
+    def test_stages_files_in_answer(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        os.makedirs(root + "/src")
+        for name in ("a.py", "b.py", "d.py", "empty.py"):
+            with open(f"{root}/src/{name}", "w", encoding="utf-8") as file:
+                file.write("old\n")
+
+        answer = """Here are the changes:
+
+file_begin /src/a.py
+a = 1
+file_end /src/a.py
+
+file_begin /src/b.py
+file_begin /src/c.py
+b = 2
+file_end /src/b.py
+
+file_begin /src/empty.py
+file_end /src/empty.py
+
+file_begin /src/d.py
+d = 4"""
+        tx = EditTransaction(root, str(tmp_path / "journal"), "0")
+        mutator = ProjectMutator(None, "refactor", root, answer, "0", None, {}, tx)
+        mutator.run()
+        assert mutator.new_files == {
+            "/src/a.py": "a = 1",
+            # Only the matching file_end ends a file
+            "/src/b.py": "file_begin /src/c.py\nb = 2",
+            # A missing file_end runs to the end of the answer
+            "/src/d.py": "d = 4",
+        }
+        assert tx.read(root + "/src/b.py") == b"file_begin /src/c.py\nb = 2"
+        assert tx.read(root + "/src/d.py") == b"d = 4"
+        # An empty file in the answer leaves the file alone
+        assert tx.read(root + "/src/empty.py") == b"old\n"
+
+    @staticmethod
+    def test_stages_files_while_streaming(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        os.makedirs(root)
+        for name in ("a.py", "b.py"):
+            with open(f"{root}/{name}", "w", encoding="utf-8") as file:
+                file.write("old\n")
+
+        tx = EditTransaction(root, str(tmp_path / "journal"), "0")
+        mutator = ProjectMutator(None, "refactor", root, "", "0", None, {}, tx)
+        mutator.parser.feed("file_begin /a.py\nnew a\nfile_end /a.py\nfile_begin /b.py\nnew")
+        # The first file is staged while the second is still arriving
+        assert tx.read(root + "/a.py") == b"new a"
+        assert tx.read(root + "/b.py") == b"old\n"
+        mutator.parser.feed(" b\nfile_end /b.py\n")
+        mutator.run()
+        assert tx.read(root + "/b.py") == b"new b"
@@ -0,0 +1,109 @@
+import os
+from typing import List
+
+from agent.project_walker import IgnoreRules, ProjectWalker
+
+
+def make_files(root: str, files: List[str]):
+    for name in files:
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("x\n")
+
+
+def walked_files(walker: ProjectWalker, top=None) -> List[str]:
+    ret: List[str] = []
+    for dirpath, filenames in walker.walk(top):
+        for filename in filenames:
+            ret.append(walker.rel_path(os.path.join(dirpath, filename)))
+    return ret
+
+
+class TestIgnoreRules:
+    @staticmethod
+    def test_unanchored_pattern_matches_at_any_depth():
+        rules = IgnoreRules.from_lines("", ["*.log"])
+        assert rules.match("a.log", False) is True
+        assert rules.match("src/deep/a.log", False) is True
+        assert rules.match("a.py", False) is None
+
+    @staticmethod
+    def test_anchored_pattern():
+        rules = IgnoreRules.from_lines("", ["/build"])
+        assert rules.match("build", True) is True
+        assert rules.match("src/build", True) is None
+
+    @staticmethod
+    def test_dir_only_pattern():
+        rules = IgnoreRules.from_lines("", ["out/"])
+        assert rules.match("out", True) is True
+        assert rules.match("out", False) is None
+
+    @staticmethod
+    def test_negation_last_match_wins():
+        rules = IgnoreRules.from_lines("", ["*.py", "!keep.py"])
+        assert rules.match("a.py", False) is True
+        assert rules.match("keep.py", False) is False
+
+    @staticmethod
+    def test_double_star():
+        rules = IgnoreRules.from_lines("", ["docs/**/*.md"])
+        assert rules.match("docs/a.md", False) is True
+        assert rules.match("docs/x/y/a.md", False) is True
+        assert rules.match("src/docs/a.md", False) is None
+
+    @staticmethod
+    def test_comments_and_blank_lines():
+        rules = IgnoreRules.from_lines("", ["# comment", "", "   "])
+        assert rules.rules == []
+
+    @staticmethod
+    def test_rules_are_relative_to_their_folder():
+        rules = IgnoreRules.from_lines("src", ["/gen"])
+        assert rules.match("src/gen", True) is True
+        assert rules.match("gen", True) is None
+
+
+class TestProjectWalker:
+    @staticmethod
+    def test_gitignore_prunes_folders(tmp_path):
+        root = str(tmp_path)
+        make_files(root, ["a.py", "node_modules/lib.js", "src/b.py", "src/gen/c.py", ".git/x.py"])
+        with open(os.path.join(root, ".gitignore"), "w", encoding="utf-8") as file:
+            file.write("node_modules/\n")
+        with open(os.path.join(root, "src", ".gitignore"), "w", encoding="utf-8") as file:
+            file.write("/gen\n")
+
+        walker = ProjectWalker(root, {".py", ".js"})
+        assert walked_files(walker) == ["a.py", "src/b.py"]
+
+    @staticmethod
+    def test_extensions_and_globs(tmp_path):
+        root = str(tmp_path)
+        make_files(root, ["a.py", "a.txt", "src/b.py", "src/b_test.py", "dist/c.py"])
+
+        walker = ProjectWalker(root, {".py"}, ["src/"], ["dist/", "*_test.py"])
+        assert walked_files(walker) == ["src/b.py"]
+
+    @staticmethod
+    def test_walking_a_subfolder_applies_parent_gitignore(tmp_path):
+        root = str(tmp_path)
+        make_files(root, ["src/a.py", "src/a.gen.py"])
+        with open(os.path.join(root, ".gitignore"), "w", encoding="utf-8") as file:
+            file.write("*.gen.py\n")
+
+        walker = ProjectWalker(root, {".py"})
+        assert walked_files(walker, os.path.join(root, "src")) == ["src/a.py"]
+
+    @staticmethod
+    def test_is_path_included(tmp_path):
+        root = str(tmp_path)
+        make_files(root, ["src/a.py", "build/b.py"])
+
+        walker = ProjectWalker(root, {".py"}, None, ["build/"])
+        assert walker.is_path_included(os.path.join(root, "src", "a.py"), False)
+        assert walker.is_path_included(os.path.join(root, "src"), True)
+        assert not walker.is_path_included(os.path.join(root, "build", "b.py"), False)
+        assert not walker.is_path_included(os.path.join(root, "src", "a.txt"), False)
+        assert not walker.is_path_included(os.path.join(root, ".git", "x.py"), False)
@@ -0,0 +1,178 @@
+import gzip
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from agent.app_ai import AppAI
+from agent.llm_clients import LLMClients
+from agent.prompt_cache import CACHE_CONTROL, PromptCacheStats, PromptUsage
+
+ANTHROPIC_EVENTS = [
+    {
+        "type": "message_start",
+        "message": {
+            "id": "msg_1",
+            "type": "message",
+            "role": "assistant",
+            "content": [],
+            "model": "claude-test",
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": 10,
+                "cache_read_input_tokens": 1000,
+                "cache_creation_input_tokens": 200,
+                "output_tokens": 1,
+            },
+        },
+    },
+    {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+    {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "hello"}},
+    {"type": "content_block_stop", "index": 0},
+    {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": 5}},
+    {"type": "message_stop"},
+]
+
+OPENAI_CHUNKS = [
+    {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": reason}],
+    }
+    for delta, reason in (({"role": "assistant", "content": "hi"}, None), ({}, "stop"))
+] + [
+    # Only sent when the request asks for the usage
+    {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [],
+        "usage": {
+            "prompt_tokens": 2000,
+            "completion_tokens": 1,
+            "total_tokens": 2001,
+            "prompt_tokens_details": {"cached_tokens": 1536},
+        },
+    }
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Streams answers like the AI services do, with the usage they send, and keeps the requests it got."""
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def send(self, events: str, encoding: str = "identity"):
+        body: bytes = events.encode("utf-8")
+        if encoding == "gzip":
+            body = gzip.compress(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubHandler.requests.append(request)
+        if self.path.endswith("/messages"):
+            events = "".join(
+                f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in ANTHROPIC_EVENTS
+            )
+            self.send(events, "gzip")
+        else:
+            chunks = OPENAI_CHUNKS if request.get("stream_options", {}).get("include_usage") else OPENAI_CHUNKS[:2]
+            self.send("".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_stub(monkeypatch):
+    """Starts the stub server, and returns it with the config of services using it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    cfg = argparse.Namespace(
+        openai_model="gpt-test",
+        anth_model="claude-test",
+        openai_api_key="key",
+        anth_api_key="key",
+        openai_base_url=url + "/v1",
+        anth_base_url=url,
+        llm_timeout=10,
+        llm_clients=2,
+        prompt_cache=True,
+    )
+    monkeypatch.setattr(LLMClients, "instance", LLMClients())
+    monkeypatch.setattr(PromptCacheStats, "instance", PromptCacheStats())
+    StubHandler.requests = []
+    return server, cfg
+
+
+def stop_stub(server):
+    LLMClients.get_instance().close()
+    server.shutdown()
+    server.server_close()
+
+
+class TestPromptCache:
+    @staticmethod
+    def test_marks_anthropic_breakpoints(monkeypatch):
+        server, cfg = run_stub(monkeypatch)
+        question = HumanMessage(content=AppAI.human_content("the code", "second question"))
+        messages = [
+            SystemMessage(content="instructions"),
+            HumanMessage(content="first question"),
+            AIMessage(content="first answer"),
+            question,
+        ]
+        try:
+            llm = LLMClients.create_llm(cfg, "anth", 0.0, streaming=True)
+            assert llm.invoke(messages).content == "hello"
+        finally:
+            stop_stub(server)
+
+        request = StubHandler.requests[0]
+        assert request["system"] == [{"type": "text", "text": "instructions", "cache_control": CACHE_CONTROL}]
+        first, _, last = request["messages"]
+        # The end of the history, the context, and the end of the question
+        assert first["content"] == [{"type": "text", "text": "first question", "cache_control": CACHE_CONTROL}]
+        assert [block.get("cache_control") for block in last["content"]] == [CACHE_CONTROL, CACHE_CONTROL]
+        assert [block["text"] for block in last["content"]] == ["the code", "second question"]
+        # The messages themselves are left as they were
+        assert all("cache_control" not in block for block in question.content)
+
+        # The usage was spread over the events of the stream, which was compressed
+        assert PromptCacheStats.get_instance().totals["anth"] == PromptUsage(1210, 1000, 200)
+
+    @staticmethod
+    def test_openai_prefix_stays_the_same(monkeypatch):
+        server, cfg = run_stub(monkeypatch)
+        messages = [
+            SystemMessage(content="instructions"),
+            HumanMessage(content=AppAI.human_content("the code", "first question")),
+        ]
+        try:
+            llm = LLMClients.create_llm(cfg, "openai", 0.0, streaming=True)
+            messages.append(llm.invoke(messages))
+            messages.append(HumanMessage(content=AppAI.human_content("the code", "second question")))
+            llm.invoke(messages)
+        finally:
+            stop_stub(server)
+
+        first, second = StubHandler.requests
+        # Everything sent the first time is sent again, byte for byte, at the start of the second request
+        assert json.dumps(second["messages"][:2]) == json.dumps(first["messages"])
+        assert second["messages"][3]["content"][0] == {"type": "text", "text": "the code"}
+        assert first["stream_options"] == {"include_usage": True}
+        assert PromptCacheStats.get_instance().totals["openai"] == PromptUsage(4000, 3072, 0)
+        assert "3072 of 4000 prompt tokens read from the cache (77%)" in PromptCacheStats.get_instance().summary()
@@ -0,0 +1,42 @@
+from agent.prompt_tags import PromptTags
+
+
+class TestPromptTags:
+    @staticmethod
+    def test_scan():
+        refs = PromptTags.scan(
+            "Compare block(MyBlock) with file(/src/a.py), folder(/src/lib/), folder(/src) and symbol(a.B.c)"
+        )
+        assert refs.blocks == {"MyBlock"}
+        assert refs.symbols == {"a.B.c"}
+        assert refs.files == {"/src/a.py"}
+        # Without the trailing slash it isn't a folder tag
+        assert refs.folders == {"/src/lib"}
+        assert PromptTags.scan("No tags here (really)").empty()
+
+    @staticmethod
+    def test_inserted_block_names():
+        texts = [
+            "Look at this:\n\nblock_begin First\nx = 1\nblock_end\n",
+            "file_begin /a.py\n# block_begin Second\ny = 2\n# block_end\nfile_end /a.py\n",
+            "nothing inserted",
+        ]
+        assert PromptTags.inserted_block_names(texts) == {"First", "Second"}
+
+    @staticmethod
+    def test_expand():
+        known = {("block", "A"): "<a>", ("file", "/f.py"): "<f file(/g.py)>", ("folder", "/src"): "<src>"}
+        calls = []
+
+        def render(kind, name):
+            calls.append((kind, name))
+            return known.get((kind, name))
+
+        expansion = PromptTags.expand(
+            "block(A) then file(/f.py), folder(/src/), block(A), block(B) and folder(/src)", render
+        )
+        # Inserted content is not expanded again, and each tag is only rendered once
+        assert expansion.prompt == "<a> then <f file(/g.py)>, <src>, <a>, block(B) and folder(/src)"
+        assert calls == [("block", "A"), ("file", "/f.py"), ("folder", "/src"), ("block", "B")]
+        assert (expansion.blocks_inserted, expansion.files_inserted, expansion.folders_inserted) == (2, 1, 1)
+        assert expansion.unknown == ["block(B)", "folder(/src)"]
@@ -0,0 +1,106 @@
+import os
+import shutil
+
+from agent.app_config import AppConfig
+from agent.project_loader import ProjectLoader
+from agent.prompt_utils import PromptUtils
+from agent.token_budget import TokenBudget, TokenCounter
+from agent.utils import RefactorMode
+
+
+def write(path: str, size: int, mtime: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("x" * size)
+    os.utime(path, (mtime, mtime))
+
+
+class TestBuildFolderContent:
+    @staticmethod
+    def test_packs_files_by_priority(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path)
+        write(root + "/src/old_small.py", 400, 1000)
+        write(root + "/src/old_big.py", 4000, 1000)
+        write(root + "/src/new.py", 2000, 2000)
+        write(root + "/src/explicit.py", 2000, 500)
+
+        # Count tokens by the character estimate, so the test doesn't depend on loading an encoding
+        monkeypatch.setitem(TokenCounter.encodings, "estimate", None)
+        counter = TokenCounter("estimate")
+        budget = TokenBudget(counter, 1300)
+        folder = PromptUtils.build_folder_content(
+            root + "/src", len(root), budget, {"/src/explicit.py"}
+        )
+
+        assert folder.included == ["/src/explicit.py", "/src/new.py", "/src/old_small.py"]
+        assert folder.truncated == []
+        assert folder.dropped == ["/src/old_big.py"]
+        assert not budget.exceeded()
+        # Included files are still listed in folder order
+        assert folder.content.index("/src/explicit.py") < folder.content.index("/src/new.py")
+
+        budget = TokenBudget(counter, 1000)
+        folder = PromptUtils.build_folder_content(root + "/src", len(root), budget)
+        assert folder.included == ["/src/new.py", "/src/old_small.py"]
+        assert folder.truncated == ["/src/old_big.py"]
+        assert folder.dropped == ["/src/explicit.py"]
+        assert "truncated to fit the prompt" in folder.content
+        assert not budget.exceeded()
+
+    @staticmethod
+    def test_leaves_out_files_the_scan_skipped(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path)
+        write(root + "/src/text.py", 10, 1000)
+        write(root + "/src/changed.py", 10, 1000)
+        with open(root + "/src/latin1.py", "wb") as file:
+            file.write(b"s = '\xe9'\n")
+        with open(root + "/src/binary.py", "wb") as file:
+            file.write(b"\0\1\2")
+
+        loader = ProjectLoader(None, len(root))
+        loader.scan_directory(root)
+        # It was text when the scan saw it
+        with open(root + "/src/changed.py", "wb") as file:
+            file.write(b"s = '\xe9'\n")
+
+        project_files = set(loader.file_names)
+        folder = PromptUtils.build_folder_content(root + "/src", len(root), project_files=project_files)
+        assert folder.included == ["/src/text.py"]
+        assert folder.skipped == ["/src/binary.py", "/src/latin1.py", "/src/changed.py"]
+        assert "latin1" not in folder.content and "changed" not in folder.content
+
+        # The same with a budget, which reads the files in another order
+        monkeypatch.setitem(TokenCounter.encodings, "estimate", None)
+        budget = TokenBudget(TokenCounter("estimate"), 1000)
+        folder = PromptUtils.build_folder_content(root + "/src", len(root), budget, project_files=project_files)
+        assert folder.included == ["/src/text.py"]
+        assert "/src/changed.py" in folder.skipped
+
+
+class TestSystemPrompt:
+    @staticmethod
+    def test_cached_until_template_changes(tmp_path, monkeypatch):
+        monkeypatch.setattr(PromptUtils, "template_cache", {})
+        monkeypatch.setattr(PromptUtils, "system_prompt_cache", {})
+        # Run from a copy of the templates, so we can modify them
+        shutil.copytree("prompt_templates", tmp_path / "prompt_templates")
+        monkeypatch.chdir(tmp_path)
+
+        PromptUtils.warm_system_prompts()
+        prompt = PromptUtils.get_system_prompt(RefactorMode.REFACTOR.value, True)
+        assert PromptUtils.get_system_prompt(RefactorMode.REFACTOR.value, True) is prompt
+        assert len(prompt) > len(PromptUtils.get_system_prompt(RefactorMode.REFACTOR.value, False))
+        # Blocks make no difference unless refactoring
+        assert PromptUtils.get_system_prompt(
+            RefactorMode.NONE.value, True
+        ) is PromptUtils.get_system_prompt(RefactorMode.NONE.value, False)
+
+        path = tmp_path / "prompt_templates" / "block_update_instructions.txt"
+        path.write_text("Updated instructions.", encoding="utf-8")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        updated = PromptUtils.get_system_prompt(RefactorMode.REFACTOR.value, True)
+        assert updated != prompt
+        assert updated.endswith("\n\nUpdated instructions.")
@@ -0,0 +1,30 @@
+import os
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+
+from agent.response_cache import ResponseCache
+
+
+class TestResponseCache:
+    @staticmethod
+    def test_hits_and_eviction(tmp_path):
+        cache = ResponseCache(str(tmp_path / "responses"))
+        llm = GenericFakeChatModel(
+            messages=iter([AIMessage(content="first"), AIMessage(content="second")]), cache=cache
+        )
+
+        assert llm.invoke([HumanMessage(content="question")]).content == "first"
+        # Same query, so it's answered from the cache without calling the model
+        assert llm.invoke([HumanMessage(content="question")]).content == "first"
+        assert llm.invoke([HumanMessage(content="other question")]).content == "second"
+        assert (cache.hits, cache.misses) == (1, 2)
+
+        # Survives the process, and evicts the least recently used response first
+        files = sorted(os.listdir(tmp_path / "responses"))
+        assert len(files) == 2
+        size = max(os.path.getsize(tmp_path / "responses" / f) for f in files)
+        small = ResponseCache(str(tmp_path / "responses"), size)
+        os.utime(tmp_path / "responses" / files[0], ns=(0, 0))
+        small.evict()
+        assert os.listdir(tmp_path / "responses") == files[1:]
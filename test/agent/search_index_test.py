@@ -0,0 +1,63 @@
+import os
+
+from agent.app_config import AppConfig
+from agent.project_loader import ProjectLoader
+from agent.search_index import SearchIndex
+
+
+def write(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(content)
+
+
+class TestSearchIndex:
+    @staticmethod
+    def test_tokenize():
+        assert SearchIndex.tokenize("getUserName(user_id, 42)") == [
+            "get",
+            "user",
+            "name",
+            "getusername",
+            "user",
+            "id",
+            "user_id",
+        ]
+
+    @staticmethod
+    def test_ranks_and_updates_with_the_scan(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        write(
+            root + "/billing.py",
+            "# block_begin ChargeCard\ndef charge_card(invoice):\n    return invoice.total\n# block_end\n"
+            + "def refund(payment):\n    pass\n",
+        )
+        write(root + "/users.py", "def load_user(user_id):\n    return find_user(user_id)\n")
+
+        loader = ProjectLoader(
+            None,
+            len(root),
+            str(tmp_path / "data/scan_manifest.json"),
+            search_index_file=str(tmp_path / "data/search_index.db"),
+        )
+        loader.scan_directory(root)
+        index = loader.search_index
+        assert index is not None
+
+        query = "how do we charge the card for an invoice?"
+        assert [hit.name for hit in index.search(query, 5, ("block",))] == ["ChargeCard"]
+        assert [hit.name for hit in index.search(query, 5, ("file",))] == ["/billing.py"]
+        assert index.search("which user", 5, ("file",))[0].name == "/users.py"
+
+        # Changes made after the scan are applied incrementally
+        write(root + "/users.py", "def load_account(account_id):\n    pass\n")
+        os.utime(root + "/users.py", ns=(0, os.stat(root + "/users.py").st_mtime_ns + 10**9))
+        loader.update_file(root + "/users.py")
+        loader.update_indexes()
+        assert index.search("which user", 5) == []
+        assert index.search("account", 5)[0].name == "/users.py"
+
+        loader.remove_file("/users.py")
+        loader.update_indexes()
+        assert index.search("account", 5) == []
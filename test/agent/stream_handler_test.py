@@ -0,0 +1,42 @@
+import io
+import uuid
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+
+from agent.response_cache import ResponseCache
+from agent.stream_handler import StreamHandler
+
+
+class TestStreamHandler:
+    @staticmethod
+    def test_streams_to_log_and_gui(monkeypatch):
+        monkeypatch.setattr("agent.stream_handler.GUI_REFRESH_SECONDS", 0.0)
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content="hello there world")]))
+        log = io.StringIO()
+        shown = []
+        handler = StreamHandler(log, shown.append)
+
+        for _ in llm.stream([HumanMessage(content="question")], {"callbacks": [handler]}):
+            # Each token is in the log as soon as it arrives
+            assert log.getvalue() == handler.text()
+        handler.on_tool_start({"name": "File Updater Tool"}, "{}", run_id=uuid.uuid4())
+        timing = handler.finish()
+
+        assert log.getvalue() == "hello there world\n[Calling tool: File Updater Tool]\n"
+        assert shown[0] == "hello" and shown[-1] == log.getvalue()
+        assert timing.first_token_ms is not None and timing.first_token_ms <= timing.total_ms
+        assert (timing.llm_calls, timing.tool_calls) == (1, 1)
+
+    @staticmethod
+    def test_whole_answers(tmp_path):
+        cache = ResponseCache(str(tmp_path / "responses"))
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content="answer")]), cache=cache)
+
+        # Once from the model without streaming, then from the cache, and each time the answer arrives once
+        for _ in range(2):
+            handler = StreamHandler()
+            llm.invoke([HumanMessage(content="question")], {"callbacks": [handler]})
+            assert handler.text() == "answer\n"
+            assert handler.finish().first_token_ms is not None
+        assert cache.hits == 1
@@ -0,0 +1,99 @@
+import os
+
+from agent.app_config import AppConfig
+from agent.edit_transaction import EditTransaction
+from agent.project_loader import ProjectLoader
+from agent.project_mutator import ProjectMutator
+from agent.symbol_index import SymbolIndex, python_symbols
+
+SOURCE = b"""import os
+
+
+@decorated
+class Shape:
+    def area(self):
+        return 0
+
+    async def draw(self):
+        pass
+
+
+def helper():\r
+    return 1\r
+"""
+
+
+class TestSymbolIndex:
+    @staticmethod
+    def test_python_symbols():
+        symbols = {name: SOURCE[start:end] for name, start, end in python_symbols(SOURCE)}
+        assert list(symbols) == ["Shape", "Shape.area", "Shape.draw", "helper"]
+        assert symbols["Shape"].startswith(b"@decorated\nclass Shape:")
+        assert symbols["Shape.area"] == b"    def area(self):\n        return 0\n"
+        assert symbols["helper"] == b"def helper():\r\n    return 1\r\n"
+        assert SymbolIndex.module_name("/pkg/shapes.py") == "pkg.shapes"
+        assert SymbolIndex.module_name("/pkg/__init__.py") == "pkg"
+
+    @staticmethod
+    def test_symbol_edits_splice_by_offset(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        path = root + "/pkg/shapes.py"
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as file:
+            file.write(SOURCE)
+
+        loader = ProjectLoader(
+            None,
+            len(root),
+            str(tmp_path / "data/scan_manifest.json"),
+            symbol_index_file=str(tmp_path / "data/symbol_index.json"),
+        )
+        loader.scan_directory(root)
+        assert loader.add_symbol(root, "pkg.shapes.Missing") is None
+        area = loader.add_symbol(root, "pkg.shapes.Shape.area")
+        helper = loader.add_symbol(root, "pkg.shapes.helper")
+        assert area is not None and helper is not None
+        assert area.content == "    def area(self):\n        return 0\n"
+
+        # The index is saved, and a new loader can use it without a scan
+        other = ProjectLoader(None, len(root), symbol_index_file=str(tmp_path / "data/symbol_index.json"))
+        assert other.add_symbol(root, "pkg.shapes.Shape.draw") is not None
+
+        loader.blocks[area.name] = area.with_content("    def area(self):\n        return 42")
+        loader.blocks[helper.name] = helper.with_content("def helper():\n    return 2\n")
+        tx = EditTransaction(root, str(tmp_path / "journal"), "1")
+        ProjectMutator(None, "refactor", root, "", "1", None, loader.blocks, tx).run()
+        tx.commit()
+
+        with open(path, "rb") as file:
+            assert file.read() == SOURCE.replace(b"return 0", b"return 42").replace(
+                b"return 1", b"return 2"
+            )
+
+    @staticmethod
+    def test_symbol_edit_of_changed_file_is_refused(tmp_path, monkeypatch):
+        monkeypatch.setattr(AppConfig, "ext_set", {".py"})
+        root = str(tmp_path / "prj")
+        path = root + "/m.py"
+        os.makedirs(root)
+        with open(path, "wb") as file:
+            file.write(b"def foo():\n    return 1\n")
+
+        loader = ProjectLoader(None, len(root), symbol_index_file=str(tmp_path / "data/symbol_index.json"))
+        loader.scan_directory(root)
+        foo = loader.add_symbol(root, "m.foo")
+        assert foo is not None
+
+        # The file changes on disk after the scan, which moves the symbol away from its offsets
+        changed = b"import os\nimport sys\ndef foo():\n    return 1\n"
+        with open(path, "wb") as file:
+            file.write(changed)
+
+        loader.blocks[foo.name] = foo.with_content("def foo():\n    return 2\n")
+        tx = EditTransaction(root, str(tmp_path / "journal"), "1")
+        ProjectMutator(None, "refactor", root, "", "1", None, loader.blocks, tx).run()
+        tx.commit()
+
+        with open(path, "rb") as file:
+            assert file.read() == changed
@@ -0,0 +1,48 @@
+from agent.tag_lexer import TagLexer, TagLine
+
+
+class TestTagLexer:
+    @staticmethod
+    def test_plain_line_is_not_a_tag():
+        assert TagLexer.lex("x = 1  # block_begin Not_A_Tag") is None
+
+    @staticmethod
+    def test_comment_prefixes():
+        assert TagLexer.lex("// block_begin My_Java") == TagLine("// ", "block_begin", "My_Java")
+        assert TagLexer.lex("-- block_begin SQL_Scripts") == TagLine("-- ", "block_begin", "SQL_Scripts")
+        assert TagLexer.lex("# block_begin MyBlock") == TagLine("# ", "block_begin", "MyBlock")
+
+    @staticmethod
+    def test_no_comment_prefix():
+        assert TagLexer.lex("file_begin /utils/add_numbers.py") == TagLine(
+            "", "file_begin", "/utils/add_numbers.py"
+        )
+
+    @staticmethod
+    def test_tag_without_name():
+        assert TagLexer.lex("// block_end") == TagLine("// ", "block_end", None)
+
+    @staticmethod
+    def test_all_tags():
+        for tag in ["block_begin", "block_end", "block_off", "block_on", "file_begin", "file_end"]:
+            tag_line = TagLexer.lex(f"# {tag} name")
+            assert tag_line is not None
+            assert tag_line.tag == tag
+
+    @staticmethod
+    def test_unknown_comment_prefix():
+        assert TagLexer.lex("/* block_begin MyBlock */") is None
+        assert TagLexer.lex("#block_begin MyBlock") is None
+
+    @staticmethod
+    def test_matches():
+        tag_line = TagLexer.lex("file_end /a.py")
+        assert tag_line is not None
+        assert tag_line.matches("file_end", "/a.py")
+        assert not tag_line.matches("file_end", "/b.py")
+        assert not tag_line.matches("file_begin", "/a.py")
+
+    @staticmethod
+    def test_lex_bytes():
+        assert TagLexer.lex_bytes(b"// block_begin My_Java") == TagLine("// ", "block_begin", "My_Java")
+        assert TagLexer.lex_bytes(b"x = 1") is None
@@ -0,0 +1,75 @@
+"""Benchmark of BlockSplicer against the one-block-at-a-time replacement ProjectMutator used to do.
+
+Run from the project root with: `python -m test.bench.block_splice_bench`
+"""
+
+import timeit
+from typing import Dict, List
+
+from agent.block_splicer import BlockSplicer
+from agent.tag_lexer import TagLexer
+from agent.tags import TAG_BLOCK_BEGIN, TAG_BLOCK_END
+
+
+def make_file(block_count: int, lines_per_block: int = 10) -> str:
+    """Builds a file with the given number of blocks, and some code between them."""
+    lines: List[str] = []
+    for b in range(block_count):
+        lines.append(f"def func_{b}(a, b):")
+        lines.append(f"    # block_begin Block_{b}")
+        for i in range(lines_per_block):
+            lines.append(f"    total_{i} = compute(a, b) + {i}")
+        lines.append("    # block_end")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def replace_one_block(content: str, name: str, block_content: str) -> str:
+    """What ProjectMutator.replace_block used to do for each dirty block: split the whole file, rebuild it
+    with the one block replaced, and join it again.
+    """
+    if f"{TAG_BLOCK_BEGIN} {name}" not in content:
+        return content
+    new_lines: List[str] = []
+    in_block = False
+    for line in content.splitlines():
+        tag_line = TagLexer.lex(line.strip())
+        if tag_line is not None and tag_line.prefix == "":
+            tag_line = None
+        if in_block:
+            if tag_line is not None and tag_line.matches(TAG_BLOCK_END, None):
+                in_block = False
+                new_lines.append(block_content)
+                new_lines.append(line)
+        elif tag_line is not None and tag_line.matches(TAG_BLOCK_BEGIN, name):
+            in_block = True
+            new_lines.append(line)
+        else:
+            new_lines.append(line)
+    return "\n".join(new_lines)
+
+
+def replace_per_block(content: str, contents: Dict[str, str]) -> str:
+    for name, block_content in contents.items():
+        content = replace_one_block(content, name, block_content)
+    return content
+
+
+if __name__ == "__main__":
+    block_count = 500
+    content = make_file(block_count)
+    data = content.encode("utf-8")
+    contents = {f"Block_{b}": f"    return {b}" for b in range(block_count)}
+    runs = 3
+
+    per_block_time = min(
+        timeit.repeat(lambda: replace_per_block(content, contents), number=1, repeat=runs)
+    )
+    splice_time = min(
+        timeit.repeat(lambda: BlockSplicer.splice(data, contents), number=1, repeat=runs)
+    )
+
+    print(f"Blocks replaced: {block_count}, file size: {len(data)} bytes")
+    print(f"One block at a time: {per_block_time * 1000:.1f} ms")
+    print(f"BlockSplicer.splice: {splice_time * 1000:.1f} ms")
+    print(f"Speedup:             {per_block_time / splice_time:.1f}x")
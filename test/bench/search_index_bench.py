@@ -0,0 +1,63 @@
+"""Benchmark of SearchIndex on a generated project: the first build, an incremental update, and BM25 lookups.
+
+Run from the project root with: `python -m test.bench.search_index_bench [file_count]`
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+from typing import Any, Dict, List
+
+from agent.search_index import SearchIndex
+
+# Words are used with a Zipf distribution, like identifiers in real code
+VOCABULARY_SIZE = 20000
+WORDS_PER_FILE = 200
+
+
+def make_project(root: str, file_count: int) -> Dict[str, Dict[str, Any]]:
+    """Writes `file_count` small source files, and returns manifest entries for them."""
+    rnd = random.Random(1)
+    words: List[str] = [f"word{n}" for n in range(VOCABULARY_SIZE)]
+    weights: List[float] = [1 / (n + 1) for n in range(VOCABULARY_SIZE)]
+    manifest: Dict[str, Dict[str, Any]] = {}
+    for i in range(file_count):
+        rel_filename = f"/pkg{i // 500}/module_{i}.py"
+        path = root + rel_filename
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        picked = rnd.choices(words, weights, k=WORDS_PER_FILE)
+        lines = [f"    {a} = {b}({c}, {d})\n" for a, b, c, d in zip(*[iter(picked)] * 4)]
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(f"def func_{i}(value):\n" + "".join(lines))
+        stat = os.stat(path)
+        manifest[rel_filename] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "blocks": []}
+    return manifest
+
+
+if __name__ == "__main__":
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with tempfile.TemporaryDirectory() as folder:
+        root = folder + "/prj"
+        manifest = make_project(root, file_count)
+        index = SearchIndex(folder + "/search_index.db")
+
+        start = time.perf_counter()
+        index.update(root, manifest)
+        print(f"Built the index of {file_count} files in {time.perf_counter() - start:.1f} s")
+
+        manifest["/pkg0/module_0.py"] = dict(manifest["/pkg0/module_0.py"], mtime_ns=0)
+        start = time.perf_counter()
+        index.update(root, manifest)
+        print(f"Incremental update of 1 file: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        # Common, middling, and rare words
+        queries = ["word20 word300", "word150 word2000 word9000", "word1000 word15000"]
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            for query in queries:
+                index.search(query, 10)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / (runs * len(queries))
+        print(f"Top 10 lookup: {elapsed_ms:.1f} ms")
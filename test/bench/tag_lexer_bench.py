@@ -0,0 +1,56 @@
+"""Micro-benchmark of TagLexer against the per-line regex calls in Utils it replaced.
+
+Run from the project root with: `python -m test.bench.tag_lexer_bench`
+"""
+
+import timeit
+from typing import List, Optional
+
+from agent.tag_lexer import TagLexer
+from agent.tags import TAG_BLOCK_BEGIN, TAG_BLOCK_END, TAG_BLOCK_OFF, TAG_BLOCK_ON
+from agent.utils import Utils
+
+
+def make_lines(count: int) -> List[str]:
+    """Builds a file's worth of lines, with a block tag roughly every 50 lines, as in a typical project."""
+    lines: List[str] = []
+    for i in range(count):
+        if i % 50 == 0:
+            lines.append(f"# block_begin Block_{i}")
+        elif i % 50 == 49:
+            lines.append("# block_end")
+        else:
+            lines.append(f"    total_{i} = compute(a, b) + {i}  # some comment")
+    return lines
+
+
+def classify_with_utils(lines: List[str]):
+    """The classification ProjectLoader used to do, one regex per tag per line."""
+    for line in lines:
+        trimmed = line.strip()
+        if Utils.is_tag_line(trimmed, TAG_BLOCK_BEGIN):
+            name: Optional[str] = Utils.parse_name_from_tag_line(trimmed, TAG_BLOCK_BEGIN)
+        elif Utils.is_tag_line(trimmed, TAG_BLOCK_END):
+            pass
+        elif Utils.is_tag_line(trimmed, TAG_BLOCK_OFF):
+            pass
+        elif Utils.is_tag_line(trimmed, TAG_BLOCK_ON):
+            pass
+
+
+def classify_with_lexer(lines: List[str]):
+    """The same classification done with TagLexer."""
+    for line in lines:
+        TagLexer.lex(line.strip())
+
+
+if __name__ == "__main__":
+    lines = make_lines(100_000)
+    runs = 5
+    utils_time = min(timeit.repeat(lambda: classify_with_utils(lines), number=1, repeat=runs))
+    lexer_time = min(timeit.repeat(lambda: classify_with_lexer(lines), number=1, repeat=runs))
+
+    print(f"Lines per run: {len(lines)}")
+    print(f"Utils.is_tag_line: {utils_time * 1000:.1f} ms")
+    print(f"TagLexer.lex:      {lexer_time * 1000:.1f} ms")
+    print(f"Speedup:           {utils_time / lexer_time:.1f}x")